@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Writer of GeoPackage files, used by n50osm.py for reviewing data in GIS tools.
+# Features are written to layers (tables) with the standard gpkg R-tree spatial index,
+# using the sqlite3 module only. All features are inserted in one transaction, in
+# batches with prepared statements. Columns are added to a layer as new properties
+# appear, so the set of properties does not need to be known in advance.
+
+
+import sqlite3
+import struct
+import time
+import os
+
+
+srs_id = 4326  # WGS84 coordinates (lon, lat)
+
+batch_size = 10000  # Features inserted per batch
+
+geometry_codes = {"Point": 1, "LineString": 2, "Polygon": 3}  # WKB geometry types
+
+spatial_ref_sys = [
+    (
+        "Undefined cartesian SRS",
+        -1,
+        "NONE",
+        -1,
+        "undefined",
+        "undefined cartesian coordinate reference system",
+    ),
+    (
+        "Undefined geographic SRS",
+        0,
+        "NONE",
+        0,
+        "undefined",
+        "undefined geographic coordinate reference system",
+    ),
+    (
+        "WGS 84 geodetic",
+        4326,
+        "EPSG",
+        4326,
+        'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,'
+        'AUTHORITY["EPSG","7030"]],AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,'
+        'AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,'
+        'AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]',
+        "longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid",
+    ),
+]
+
+# Triggers keeping the R-tree index updated when the file is edited in GIS tools.
+# The ST_ functions are provided by the GIS tools, so the triggers are created after
+# the features have been inserted. Triggers are separated by blank lines.
+
+rtree_triggers = """
+CREATE TRIGGER "rtree_{t}_geom_insert" AFTER INSERT ON "{t}"
+WHEN (new.geom NOT NULL AND NOT ST_IsEmpty(NEW.geom))
+BEGIN
+  INSERT OR REPLACE INTO "rtree_{t}_geom" VALUES (NEW.fid,
+    ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom));
+END;
+
+CREATE TRIGGER "rtree_{t}_geom_update1" AFTER UPDATE OF geom ON "{t}"
+WHEN OLD.fid = NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))
+BEGIN
+  INSERT OR REPLACE INTO "rtree_{t}_geom" VALUES (NEW.fid,
+    ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom));
+END;
+
+CREATE TRIGGER "rtree_{t}_geom_update2" AFTER UPDATE OF geom ON "{t}"
+WHEN OLD.fid = NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))
+BEGIN
+  DELETE FROM "rtree_{t}_geom" WHERE id = OLD.fid;
+END;
+
+CREATE TRIGGER "rtree_{t}_geom_update3" AFTER UPDATE ON "{t}"
+WHEN OLD.fid != NEW.fid AND (NEW.geom NOTNULL AND NOT ST_IsEmpty(NEW.geom))
+BEGIN
+  DELETE FROM "rtree_{t}_geom" WHERE id = OLD.fid;
+  INSERT OR REPLACE INTO "rtree_{t}_geom" VALUES (NEW.fid,
+    ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom));
+END;
+
+CREATE TRIGGER "rtree_{t}_geom_update4" AFTER UPDATE ON "{t}"
+WHEN OLD.fid != NEW.fid AND (NEW.geom ISNULL OR ST_IsEmpty(NEW.geom))
+BEGIN
+  DELETE FROM "rtree_{t}_geom" WHERE id IN (OLD.fid, NEW.fid);
+END;
+
+CREATE TRIGGER "rtree_{t}_geom_delete" AFTER DELETE ON "{t}"
+WHEN old.geom NOT NULL
+BEGIN
+  DELETE FROM "rtree_{t}_geom" WHERE id = OLD.fid;
+END;
+"""
+
+
+# Quote identifier (table or column name) for SQL
+
+
+def quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+# Encode geometry as GeoPackage binary (header with envelope + little endian WKB).
+# Coordinates are given as in GeoJSON. Also returns bbox (min x, max x, min y, max y).
+
+
+def encode_geometry(geometry_type, coordinates):
+    if geometry_type == "Point":
+        points = [coordinates]
+        wkb = struct.pack("<BIdd", 1, geometry_codes["Point"], *coordinates)
+    elif geometry_type == "LineString":
+        points = coordinates
+        wkb = struct.pack("<BII", 1, geometry_codes["LineString"], len(points))
+        wkb += struct.pack("<%id" % (2 * len(points)), *[c for p in points for c in p])
+    else:
+        points = [point for ring in coordinates for point in ring]
+        wkb = struct.pack("<BII", 1, geometry_codes["Polygon"], len(coordinates))
+        for ring in coordinates:
+            wkb += struct.pack("<I", len(ring))
+            wkb += struct.pack("<%id" % (2 * len(ring)), *[c for p in ring for c in p])
+
+    bbox = (
+        min(point[0] for point in points),
+        max(point[0] for point in points),
+        min(point[1] for point in points),
+        max(point[1] for point in points),
+    )
+
+    if geometry_type == "Point":
+        header = struct.pack("<2sBBi", b"GP", 0, 0x01, srs_id)  # No envelope
+    else:
+        header = struct.pack("<2sBBi4d", b"GP", 0, 0x03, srs_id, *bbox)
+
+    return (header + wkb, bbox)
+
+
+# Streaming writer of GeoPackage file.
+# The file is written to a temporary file, which replaces filename when closed.
+
+
+class GeopackageWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.isfile(filename + ".tmp"):
+            os.remove(filename + ".tmp")
+
+        self.db = sqlite3.connect(filename + ".tmp", isolation_level=None)
+        self.db.execute("PRAGMA application_id = 1196444487")  # "GPKG"
+        self.db.execute("PRAGMA user_version = 10200")  # Version 1.2
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("BEGIN")
+
+        self.db.execute(
+            "CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL,"
+            " srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,"
+            " organization_coordsys_id INTEGER NOT NULL,"
+            " definition TEXT NOT NULL, description TEXT)"
+        )
+        self.db.executemany(
+            "INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)",
+            spatial_ref_sys,
+        )
+        self.db.execute(
+            "CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY,"
+            " data_type TEXT NOT NULL, identifier TEXT UNIQUE,"
+            " description TEXT DEFAULT '', last_change DATETIME NOT NULL"
+            " DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),"
+            " min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE,"
+            " srs_id INTEGER REFERENCES gpkg_spatial_ref_sys(srs_id))"
+        )
+        self.db.execute(
+            "CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL,"
+            " column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,"
+            " srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,"
+            " CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),"
+            " CONSTRAINT fk_gc_tn FOREIGN KEY (table_name)"
+            " REFERENCES gpkg_contents(table_name),"
+            " CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id)"
+            " REFERENCES gpkg_spatial_ref_sys (srs_id))"
+        )
+        self.db.execute(
+            "CREATE TABLE gpkg_extensions (table_name TEXT, column_name TEXT,"
+            " extension_name TEXT NOT NULL, definition TEXT NOT NULL,"
+            " scope TEXT NOT NULL,"
+            " CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))"
+        )
+
+        self.layers = {}  # Columns, geometry type, bbox and pending rows per layer
+        self.count = 0
+
+    # Create layer table with R-tree index
+
+    def create_layer(self, name, geometry_type):
+        self.db.execute(
+            "CREATE TABLE %s (fid INTEGER PRIMARY KEY AUTOINCREMENT, geom GEOMETRY)"
+            % quote(name)
+        )
+        self.db.execute(
+            "CREATE VIRTUAL TABLE %s USING rtree(id, minx, maxx, miny, maxy)"
+            % quote("rtree_%s_geom" % name)
+        )
+        self.layers[name] = {
+            "columns": {},  # Column name per lower case property name
+            "geometry_type": geometry_type,
+            "bbox": None,
+            "rows": [],
+            "count": 0,
+        }
+
+    # Add feature to layer, with geometry type, coordinates (as in GeoJSON) and
+    # properties (dict). Layer is created when the first feature is written.
+
+    def write_feature(self, layer_name, geometry_type, coordinates, properties):
+        if not coordinates:
+            return  # Empty geometry
+
+        if layer_name not in self.layers:
+            self.create_layer(layer_name, geometry_type)
+        layer = self.layers[layer_name]
+
+        geometry, bbox = encode_geometry(geometry_type, coordinates)
+
+        if layer["geometry_type"] != geometry_type:
+            layer["geometry_type"] = "Geometry"  # Mixed geometry types
+        if layer["bbox"] is None:
+            layer["bbox"] = bbox
+        else:
+            layer["bbox"] = (
+                min(layer["bbox"][0], bbox[0]),
+                max(layer["bbox"][1], bbox[1]),
+                min(layer["bbox"][2], bbox[2]),
+                max(layer["bbox"][3], bbox[3]),
+            )
+
+        layer["count"] += 1
+        layer["rows"].append((layer["count"], geometry, bbox, properties))
+        self.count += 1
+
+        if len(layer["rows"]) >= batch_size:
+            self.flush(layer_name)
+
+    # Insert pending features of layer.
+    # SQLite column names are case insensitive, so properties which only differ
+    # by case share the same column.
+
+    def flush(self, layer_name):
+        layer = self.layers[layer_name]
+        columns = layer["columns"]
+
+        for row in layer["rows"]:
+            for key in row[3]:
+                if key.lower() not in columns and key.lower() not in ["fid", "geom"]:
+                    columns[key.lower()] = key
+                    self.db.execute(
+                        "ALTER TABLE %s ADD COLUMN %s TEXT"
+                        % (quote(layer_name), quote(key))
+                    )
+
+        index = {}
+        for i, column in enumerate(columns):
+            index[column] = i + 2
+
+        values = []
+        for fid, geometry, bbox, properties in layer["rows"]:
+            row = [fid, geometry] + [None] * len(columns)
+            for key, value in properties.items():
+                if key.lower() in index:
+                    row[index[key.lower()]] = value
+            values.append(row)
+
+        self.db.executemany(
+            "INSERT INTO %s (fid, geom%s) VALUES (?, ?%s)"
+            % (
+                quote(layer_name),
+                "".join(", " + quote(column) for column in columns.values()),
+                ", ?" * len(columns),
+            ),
+            values,
+        )
+        self.db.executemany(
+            "INSERT INTO %s VALUES (?, ?, ?, ?, ?)"
+            % quote("rtree_%s_geom" % layer_name),
+            [(row[0],) + row[2] for row in layer["rows"]],
+        )
+
+        layer["rows"] = []
+
+    # Insert remaining features, register layers and commit
+
+    def close(self):
+        last_change = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+        for name, layer in self.layers.items():
+            self.flush(name)
+            bbox = layer["bbox"]
+            self.db.execute(
+                "INSERT INTO gpkg_contents VALUES (?, 'features', ?, '', ?,"
+                " ?, ?, ?, ?, ?)",
+                (name, name, last_change, bbox[0], bbox[2], bbox[1], bbox[3], srs_id),
+            )
+            self.db.execute(
+                "INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, ?, 0, 0)",
+                (name, layer["geometry_type"].upper(), srs_id),
+            )
+            self.db.execute(
+                "INSERT INTO gpkg_extensions VALUES (?, 'geom', 'gpkg_rtree_index',"
+                " 'http://www.geopackage.org/spec120/#extension_rtree', 'write-only')",
+                (name,),
+            )
+            for trigger in rtree_triggers.strip().split("\n\n"):
+                self.db.execute(trigger.replace("{t}", name.replace('"', '""')))
+
+        self.db.execute("COMMIT")
+        self.db.close()
+        os.replace(self.filename + ".tmp", self.filename)
@@ -0,0 +1,561 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Shared HTTP client for n50osm.py, n50merge.py and municipality.py.
+# Keeps persistent connections per host, asks for gzip/deflate compressed responses,
+# retries failed requests with backoff, rate limits requests per host and collects
+# timing statistics. Proxies are taken from the environment (http_proxy, https_proxy
+# and no_proxy) like urllib.request does. Large responses may be streamed.
+# Errors are raised as urllib.error.HTTPError and URLError, like urllib.request.urlopen
+# does.
+# Responses may be recorded to a fixture folder, and replayed later without network,
+# with configurable latency.
+
+
+import http.client
+import urllib.parse, urllib.error, urllib.request
+import threading
+import time
+import gzip
+import zlib
+import base64
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from io import BytesIO, RawIOBase
+
+
+header = {"User-Agent": "nkamapper/n50osm", "Accept-Encoding": "gzip, deflate"}
+
+timeout = 300  # Seconds before a request times out
+
+max_retry = 4  # Retries after failed request, with backoff 1, 2, 4, 8 seconds
+
+retry_status = [429, 500, 502, 503, 504]  # HTTP status codes which are retried
+
+max_redirect = 5  # Redirects followed per request
+
+pool_size = 8  # Maximum idle connections kept per host
+
+rate_limits = {  # Minimum seconds between requests per host
+    "overpass-api.de": 1.0,
+}
+
+fixture_mode = None  # "record" or "replay" responses in fixture folder
+fixture_folder = None
+replay_latency = 0.0  # Seconds per replayed request, or "recorded" to use recorded time
+temporary_folder = None  # Empty cache folder during record and replay
+
+pools = {}  # Idle connections per (scheme, host, port, proxy)
+next_request = {}  # Earliest time of next request per host (rate limits)
+statistics = {}  # Number of requests, retries, bytes and time per host
+lock = threading.Lock()
+
+
+# Response with decoded body, which may be read as a file
+
+
+class Response(BytesIO):
+    def __init__(self, url, status, reason, headers, body):
+        super().__init__(body)
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def getcode(self):
+        return self.status
+
+
+# Response with body decoded while it is read, for large downloads.
+# The connection is returned to the pool when the complete body has been read, or
+# closed if the response is closed before the end of the body.
+
+
+class StreamResponse(RawIOBase):
+    def __init__(self, url, response, connection, key, statistics):
+        super().__init__()
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.response = response
+        self.connection = connection
+        self.key = key
+        self.statistics = statistics  # Host, retries and start time
+        self.size = 0
+        self.buffer = b""
+
+        encoding = response.headers["Content-Encoding"]
+        if encoding == "gzip":
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decoder = zlib.decompressobj()
+        else:
+            self.decoder = None
+
+    def getcode(self):
+        return self.status
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.buffer and self.response is not None:
+            chunk = self.response.read(65536)
+            self.size += len(chunk)
+            if chunk:
+                self.buffer = self.decode(chunk)
+            else:
+                if self.decoder is not None:
+                    self.buffer = self.decoder.flush()
+                self.finish(True)
+
+        length = min(len(buffer), len(self.buffer))
+        buffer[:length] = self.buffer[:length]
+        self.buffer = self.buffer[length:]
+        return length
+
+    def decode(self, chunk):
+        if self.decoder is None:
+            return chunk
+        try:
+            return self.decoder.decompress(chunk)
+        except zlib.error:
+            if self.size > len(chunk):
+                raise
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)  # Raw deflate
+            return self.decoder.decompress(chunk)
+
+    def finish(self, complete):
+        if self.response is None:
+            return
+        if complete and not self.response.will_close:
+            release_connection(self.key, self.connection)
+        else:
+            self.connection.close()
+        self.response = None
+        host, retries, start_time = self.statistics
+        add_statistics(host, retries, self.size, time.time() - start_time)
+
+    def close(self):
+        self.finish(False)
+        super().close()
+
+
+# Get proxy for url from environment, or None if no proxy should be used
+
+
+def get_proxy(parts):
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if not proxy or urllib.request.proxy_bypass(parts.netloc):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    return proxy
+
+
+# Get header with basic authentication for proxy, if given in proxy url
+
+
+def proxy_header(proxy):
+    parts = urllib.parse.urlsplit(proxy)
+    if parts.username is None:
+        return {}
+    credentials = "%s:%s" % (
+        urllib.parse.unquote(parts.username),
+        urllib.parse.unquote(parts.password or ""),
+    )
+    return {
+        "Proxy-Authorization": "Basic "
+        + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+    }
+
+
+# Get idle connection to host from pool, or a new connection.
+# HTTPS requests through a proxy use a tunnel (CONNECT) to the host.
+# Also returns True if the connection has been used before.
+
+
+def get_connection(key, reuse=True):
+    with lock:
+        if reuse and pools.get(key):
+            return (pools[key].pop(), True)
+
+    scheme, host, port, proxy = key
+    if proxy:
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(
+                proxy_parts.hostname, proxy_parts.port, timeout=timeout
+            )
+            connection.set_tunnel(host, port, headers=proxy_header(proxy))
+        else:
+            connection = http.client.HTTPConnection(
+                proxy_parts.hostname, proxy_parts.port, timeout=timeout
+            )
+    elif scheme == "https":
+        connection = http.client.HTTPSConnection(host, port, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    return (connection, False)
+
+
+# Return connection to pool for later requests to same host
+
+
+def release_connection(key, connection):
+    with lock:
+        if key not in pools:
+            pools[key] = []
+        if len(pools[key]) < pool_size:
+            pools[key].append(connection)
+            return
+
+    connection.close()
+
+
+# Wait until next request to host is permitted by rate limit
+
+
+def wait_rate_limit(host):
+    if host not in rate_limits:
+        return
+
+    with lock:
+        request_time = max(next_request.get(host, 0), time.time())
+        next_request[host] = request_time + rate_limits[host]
+
+    time.sleep(max(request_time - time.time(), 0))
+
+
+# Decode compressed response body
+
+
+def decode(body, encoding):
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    elif encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)  # Raw deflate without header
+    else:
+        return body
+
+
+# Send one request and read the complete response.
+# With stream, the body of a successful response is not read. Instead the response,
+# connection and pool key are returned for a StreamResponse.
+# A pooled connection may have been closed by the server while idle, so the request
+# is sent once more on a new connection if the pooled connection fails.
+
+
+def send(method, url, headers, data, stream=False):
+    parts = urllib.parse.urlsplit(url)
+    proxy = get_proxy(parts)
+    key = (parts.scheme, parts.hostname, parts.port, proxy)
+    target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+    if proxy and parts.scheme == "http":
+        target = urllib.parse.urlunsplit(parts[:4] + ("",))  # Absolute url for proxy
+        headers = dict(headers, **proxy_header(proxy))
+
+    reuse = True
+    while True:
+        connection, reused = get_connection(key, reuse)
+        try:
+            connection.request(method, target, body=data, headers=headers)
+            response = connection.getresponse()
+            if stream and 200 <= response.status < 300:
+                return (
+                    response.status,
+                    response.reason,
+                    response.headers,
+                    None,
+                    (response, connection, key),
+                )
+            body = response.read()
+            break
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            reuse = False
+
+    if response.will_close:
+        connection.close()
+    else:
+        release_connection(key, connection)
+
+    return (response.status, response.reason, response.headers, body, None)
+
+
+# Update statistics for host
+
+
+def add_statistics(host, retries, size, duration):
+    with lock:
+        if host not in statistics:
+            statistics[host] = {"requests": 0, "retries": 0, "bytes": 0, "time": 0.0}
+        stat = statistics[host]
+        stat["requests"] += 1
+        stat["retries"] += retries
+        stat["bytes"] += size
+        stat["time"] += duration
+
+
+# Get number of seconds to wait before retry
+
+
+def retry_delay(retry, headers):
+    if headers is not None and headers["Retry-After"]:
+        if headers["Retry-After"].isdigit():
+            return int(headers["Retry-After"])
+    return 2**retry
+
+
+# Send request and return response, with retries and redirects.
+# With stream, the body of a successful response is decoded while it is read, instead
+# of being read into memory before the response is returned.
+# Raises urllib.error.HTTPError for other status codes than 2xx (including 304 Not
+# Modified), and urllib.error.URLError if the host could not be reached.
+
+
+def request(url, headers=None, method="GET", data=None, stream=False):
+    if fixture_mode == "replay":
+        return replay_request(url, headers, method, data)
+    elif fixture_mode == "record":
+        return record_request(url, headers, method, data)
+    else:
+        return network_request(url, headers, method, data, stream)
+
+
+# Send request to server and return response
+
+
+def network_request(url, headers, method, data, stream=False):
+    request_headers = dict(header)
+    if headers:
+        request_headers.update(headers)
+
+    for redirect in range(max_redirect + 1):
+        host = urllib.parse.urlsplit(url).hostname
+        start_time = time.time()
+
+        for retry in range(max_retry + 1):
+            wait_rate_limit(host)
+            try:
+                status, reason, response_headers, body, streamed = send(
+                    method, url, request_headers, data, stream
+                )
+                error = None
+            except (OSError, http.client.HTTPException) as e:
+                status, response_headers, body, streamed = (None, None, b"", None)
+                error = e
+
+            if (error or status in retry_status) and retry < max_retry:
+                time.sleep(retry_delay(retry, response_headers))
+            else:
+                break
+
+        if streamed:
+            response, connection, key = streamed
+            return StreamResponse(
+                url, response, connection, key, (host, retry, start_time)
+            )
+
+        add_statistics(host, retry, len(body), time.time() - start_time)
+
+        if error:
+            raise urllib.error.URLError(error)
+
+        if status in [301, 302, 303, 307, 308] and response_headers["Location"]:
+            url = urllib.parse.urljoin(url, response_headers["Location"])
+            if status == 303:
+                method, data = ("GET", None)
+        else:
+            break
+
+    body = decode(body, response_headers["Content-Encoding"])
+
+    if not 200 <= status < 300:
+        raise urllib.error.HTTPError(
+            url, status, reason, response_headers, BytesIO(body)
+        )
+
+    return Response(url, status, reason, response_headers, body)
+
+
+# Get lines with request statistics per host
+
+
+def get_statistics():
+    lines = []
+    for host, stat in sorted(statistics.items()):
+        lines.append(
+            "%s: %i requests, %i retries, %.1f MB, %.1f seconds"
+            % (
+                host,
+                stat["requests"],
+                stat["retries"],
+                stat["bytes"] / 1000000,
+                stat["time"],
+            )
+        )
+    return lines
+
+
+# Get filename in fixture folder for request, without extension.
+# Requests are identified by method, url and data.
+
+
+def fixture_filename(url, method, data):
+    key = hashlib.sha1(("%s %s\n" % (method, url)).encode("utf-8"))
+    if data:
+        key.update(data)
+    host = urllib.parse.urlsplit(url).hostname or "local"
+    return os.path.join(fixture_folder, host, key.hexdigest())
+
+
+# Send request to server and save response in fixture folder.
+# Conditional headers are not sent, so that the complete response is recorded.
+# Error responses are recorded too, but not connection errors.
+
+
+def record_request(url, headers, method, data):
+    request_headers = {}
+    for key, value in (headers or {}).items():
+        if key not in ["If-None-Match", "If-Modified-Since"]:
+            request_headers[key] = value
+
+    start_time = time.time()
+    try:
+        response = network_request(url, request_headers, method, data)
+        error = None
+    except urllib.error.HTTPError as e:
+        response = Response(url, e.code, e.reason, e.headers, e.read())
+        error = e
+
+    fixture = {
+        "method": method,
+        "url": url,
+        "status": response.status,
+        "reason": response.reason,
+        "headers": [
+            [key, value]
+            for key, value in response.headers.items()
+            if key not in ["Content-Encoding", "Content-Length", "Transfer-Encoding"]
+        ],
+        "time": time.time() - start_time,
+    }
+
+    filename = fixture_filename(url, method, data)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    file = open(filename + ".body", "wb")
+    file.write(response.getvalue())
+    file.close()
+    file = open(filename + ".json", "w", encoding="utf-8")
+    json.dump(fixture, file, indent=1, ensure_ascii=False)
+    file.close()
+
+    if error:
+        raise urllib.error.HTTPError(
+            url, error.code, error.reason, error.headers, BytesIO(response.getvalue())
+        )
+    return response
+
+
+# Return recorded response from fixture folder, without network.
+# Conditional requests get 304 Not Modified if ETag or Last-Modified match.
+# A missing fixture is reported as an unreachable host.
+
+
+def replay_request(url, headers, method, data):
+    filename = fixture_filename(url, method, data)
+    host = urllib.parse.urlsplit(url).hostname
+
+    if not os.path.isfile(filename + ".json"):
+        raise urllib.error.URLError("No fixture for %s %s" % (method, url))
+
+    file = open(filename + ".json", encoding="utf-8")
+    fixture = json.load(file)
+    file.close()
+    file = open(filename + ".body", "rb")
+    body = file.read()
+    file.close()
+
+    response_headers = http.client.HTTPMessage()
+    for key, value in fixture["headers"]:
+        response_headers[key] = value
+    status = fixture["status"]
+    reason = fixture["reason"]
+
+    headers = headers or {}
+    if status == 200 and (
+        (
+            "If-None-Match" in headers
+            and headers["If-None-Match"] == response_headers["ETag"]
+        )
+        or (
+            "If-Modified-Since" in headers
+            and headers["If-Modified-Since"] == response_headers["Last-Modified"]
+        )
+    ):
+        status, reason, body = (304, "Not Modified", b"")
+
+    if replay_latency == "recorded":
+        latency = fixture["time"]
+    else:
+        latency = replay_latency
+    time.sleep(latency)
+    add_statistics(host, 0, len(body), latency)
+
+    if not 200 <= status < 300:
+        raise urllib.error.HTTPError(
+            url, status, reason, response_headers, BytesIO(body)
+        )
+    return Response(url, status, reason, response_headers, body)
+
+
+# Set up recording or replay of fixtures from program options:
+# -record <folder>, -replay <folder> and -latency <seconds|recorded>.
+
+
+def fixture_options(argv):
+    global fixture_mode, fixture_folder, replay_latency
+
+    for mode in ["record", "replay"]:
+        if "-" + mode in argv:
+            index = argv.index("-" + mode)
+            if index + 1 >= len(argv) or argv[index + 1].startswith("-"):
+                sys.exit("Please provide fixture folder for -%s option\n" % mode)
+            fixture_mode = mode
+            fixture_folder = os.path.expanduser(argv[index + 1])
+
+    if "-latency" in argv:
+        index = argv.index("-latency")
+        if index + 1 < len(argv) and argv[index + 1] == "recorded":
+            replay_latency = "recorded"
+        elif index + 1 < len(argv) and argv[index + 1].replace(".", "").isdigit():
+            replay_latency = float(argv[index + 1])
+        else:
+            sys.exit("Please provide seconds or 'recorded' for -latency option\n")
+
+
+# Get cache folder to use. During record and replay an empty temporary folder is used
+# instead, so that all requests are recorded or replayed. It is removed at exit.
+
+
+def fixture_cache_folder(cache_folder):
+    global temporary_folder
+
+    if fixture_mode is None:
+        return cache_folder
+
+    if temporary_folder is None:
+        temporary_folder = tempfile.TemporaryDirectory(prefix="n50osm-")
+    return temporary_folder.name + "/"
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Registry of Norwegian municipalities, used by n50osm.py and n50merge.py.
+# The registry is loaded in bulk from GeoNorge and cached locally, so that lookups
+# of municipality numbers and names work offline.
+
+
+import urllib.error
+import json
+import sys
+import os
+import time
+import difflib
+import http_client
+
+
+registry_url = "https://ws.geonorge.no/kommuneinfo/v1/fylkerkommuner"  # All in one
+
+municipality_url = "https://ws.geonorge.no/kommuneinfo/v1/kommuner/"
+
+registry_age = 30  # Days before registry is refreshed from GeoNorge
+
+registry = None  # Dict of municipalities, with municipality number as key
+
+
+# Output message
+
+
+def message(output_text):
+    sys.stdout.write(output_text)
+    sys.stdout.flush()
+
+
+# Get filename of name in the format used for files at Kartverket
+# (Norwegian letters transliterated and spaces replaced)
+
+
+def file_name(name):
+    return (
+        name.replace("Æ", "E")
+        .replace("Ø", "O")
+        .replace("Å", "A")
+        .replace("æ", "e")
+        .replace("ø", "o")
+        .replace("å", "a")
+        .replace(" ", "_")
+    )
+
+
+# Create registry entry for municipality
+
+
+def registry_entry(municipality_id, name, county_id, county_name, bbox=None):
+    return {
+        "id": municipality_id,
+        "name": name,
+        "file_name": file_name(name),
+        "county_id": county_id,
+        "county": county_name,
+        "bbox": bbox,  # [[min lon, min lat], [max lon, max lat]] when known
+    }
+
+
+# Load all municipalities from GeoNorge in one request
+
+
+def fetch_registry():
+    file = http_client.request(registry_url)
+    result = json.load(file)
+    file.close()
+
+    municipalities = {}
+    for county in result:
+        for municipality in county["kommuner"]:
+            municipality_id = municipality["kommunenummer"]
+            municipalities[municipality_id] = registry_entry(
+                municipality_id,
+                municipality["kommunenavnNorsk"],
+                county["fylkesnummer"],
+                county["fylkesnavn"],
+            )
+
+    return municipalities
+
+
+# Load registry from cache file, and refresh it from GeoNorge if it is missing,
+# older than registry_age days or if refresh is requested.
+# Known bboxes are kept when the registry is refreshed.
+
+
+def load_registry(cache_folder, refresh=False):
+    global registry
+
+    if registry is not None and not refresh:
+        return registry
+
+    folder = os.path.expanduser(cache_folder)
+    filename = os.path.join(folder, "municipalities.json")
+
+    registry = {}
+    if os.path.isfile(filename):
+        file = open(filename, encoding="utf-8")
+        registry = json.load(file)
+        file.close()
+
+        if (
+            not refresh
+            and registry
+            and time.time() - os.path.getmtime(filename) < registry_age * 24 * 3600
+        ):
+            return registry
+
+    try:
+        municipalities = fetch_registry()
+    except (urllib.error.URLError, ValueError, KeyError) as e:
+        if registry:
+            message("*** Municipality registry not refreshed, using cache: %s\n" % e)
+            return registry
+        raise
+
+    for municipality_id, municipality in municipalities.items():
+        if municipality_id in registry and registry[municipality_id]["bbox"]:
+            municipality["bbox"] = registry[municipality_id]["bbox"]
+
+    registry = municipalities
+    save_registry(cache_folder)
+
+    return registry
+
+
+# Save registry to cache file
+
+
+def save_registry(cache_folder):
+    folder = os.path.expanduser(cache_folder)
+    os.makedirs(folder, exist_ok=True)
+    filename = os.path.join(folder, "municipalities.json")
+
+    file = open(filename + ".tmp", "w", encoding="utf-8")
+    json.dump(registry, file, ensure_ascii=False, indent=1)
+    file.close()
+    os.replace(filename + ".tmp", filename)
+
+
+# Load single municipality from GeoNorge, for municipalities not in the registry.
+# Also gives bbox of municipality. Returns None if not found.
+
+
+def fetch_municipality(municipality_id):
+    try:
+        file = http_client.request(municipality_url + municipality_id)
+    except urllib.error.HTTPError as e:
+        if e.code == 404:  # Not found
+            return None
+        else:
+            raise
+
+    result = json.load(file)
+    file.close()
+
+    bbox = None
+    if "avgrensningsboks" in result and result["avgrensningsboks"]:
+        corners = result["avgrensningsboks"]["coordinates"][0]
+        bbox = [
+            [min(node[0] for node in corners), min(node[1] for node in corners)],
+            [max(node[0] for node in corners), max(node[1] for node in corners)],
+        ]
+
+    return registry_entry(
+        result["kommunenummer"],
+        result["kommunenavnNorsk"],
+        result.get("fylkesnummer", municipality_id[:2]),
+        result.get("fylkesnavn", ""),
+        bbox,
+    )
+
+
+# Find municipalities matching name.
+# First exact match (ignoring case), then names starting with the query, and finally
+# similar names (fuzzy matching).
+
+
+def match_name(query):
+    query = query.strip().lower()
+
+    names = {}  # All names and name variants, lower case
+    for municipality in registry.values():
+        name = municipality["name"].lower()
+        for variant in [name, file_name(name)] + name.split(" - "):
+            names.setdefault(variant, set()).add(municipality["id"])
+
+    if query in names:
+        return sorted(names[query])
+
+    found = set()
+    for name, municipality_ids in names.items():
+        if name.startswith(query):
+            found.update(municipality_ids)
+    if found:
+        return sorted(found)
+
+    for name in difflib.get_close_matches(query, names.keys(), n=5, cutoff=0.8):
+        found.update(names[name])
+    return sorted(found)
+
+
+# Get id and name of municipality from registry.
+# Query is either a 4 digit municipality number or a name.
+
+
+def get_municipality_name(query, cache_folder, refresh=False):
+    load_registry(cache_folder, refresh)
+
+    if query.isdigit():
+        if query not in registry:
+            municipality = fetch_municipality(query)
+            if municipality is None:
+                sys.exit("\tMunicipality '%s' not found\n\n" % query)
+            registry[query] = municipality
+            save_registry(cache_folder)
+        return (query, registry[query]["name"])
+
+    found = match_name(query)
+
+    if len(found) == 1:
+        return (found[0], registry[found[0]]["name"])
+    elif not found:
+        sys.exit("\tMunicipality '%s' not found\n\n" % query)
+    else:
+        municipalities = []
+        for municipality_id in found:
+            municipalities.append(
+                municipality_id + " " + registry[municipality_id]["name"]
+            )
+        sys.exit(
+            "\tMore than one municipality found: %s\n\n" % ", ".join(municipalities)
+        )
+
+
+# Get registry entry of municipality (county, bbox etc.).
+# The bbox is not included in the bulk registry, so it is loaded from GeoNorge
+# the first time it is needed and then kept in the registry.
+
+
+def get_municipality(municipality_id, cache_folder):
+    load_registry(cache_folder)
+
+    if municipality_id in registry and registry[municipality_id]["bbox"]:
+        return registry[municipality_id]
+
+    try:
+        municipality = fetch_municipality(municipality_id)
+    except (urllib.error.URLError, ValueError, KeyError) as e:
+        message("*** Municipality bbox not loaded: %s\n" % e)
+        return registry.get(municipality_id, None)
+
+    if municipality is not None:
+        registry[municipality_id] = municipality
+        save_registry(cache_folder)
+
+    return registry.get(municipality_id, None)
@@ -2,19 +2,18 @@
 # -*- coding: utf8
 
 
-import urllib.request, urllib.parse, urllib.error
-import json
+import urllib.parse
 import sys
 import time
 import math
 import os.path
 from xml.etree import ElementTree as ET
-
+import municipality
+import http_client
+import osmfile
 
 version = "0.1.1"
 
-header = {"User-Agent": "nkamapper/n50osm"}
-
 overpass_api = "https://overpass-api.de/api/interpreter"  # Overpass endpoint
 
 import_folder = (  # Folder containing import highway files (default folder tried first)
@@ -25,6 +24,16 @@ n50_parts = ["coastline", "water", "wood", "landuse"]
 
 bbox_margin = 1  # meters
 
+cache_folder = "~/.cache/n50osm/"  # Folder for cached data between runs (as n50osm)
+
+part_queries = {  # SQL conditions on tags for each part, as in filter_parts()
+    "coastline": "(key = 'natural' AND value = 'coastline') OR key = 'seamark:type'",
+    "water": "(key = 'natural' AND value IN ('water', 'wetland', 'glacier'))"
+    " OR key = 'waterway'",
+    "wood": "key = 'natural' AND value = 'wood'",
+    "landuse": "key IN ('landuse', 'leisure', 'aeroway')",
+}
+
 merge_osm_ways = False
 debug = False
 
@@ -49,107 +58,59 @@ def timeformat(sec):
         return "%i seconds" % sec
 
 
-# Get name or id of municipality from GeoNorge api
+# Add one element to dict data structure, from its type, attributes, refs or members,
+# and tags. Each node is a tuple of (lon, lat), corresponding to GeoJSON format x,y.
+# The XML element is only created when the element is modified.
+# Way coordinates and relation members are resolved by resolve_data() when all
+# elements have been added, since ways may come before their nodes in the file.
+# Returns the new element.
 
 
-def get_municipality_name(query):
-    if query.isdigit():
-        url = "https://ws.geonorge.no/kommuneinfo/v1/kommuner/" + query
-    else:
-        url = "https://ws.geonorge.no/kommuneinfo/v1/sok?knavn=" + urllib.parse.quote(
-            query
-        )
+def add_element(data, nodes, ways, relations):
+    element_type, attributes, members, tags = data
+    element = {"xml": None, "data": data, "removed": False}
 
-    request = urllib.request.Request(url, headers=header)
+    if element_type == "node":
+        element["coord"] = (float(attributes["lon"]), float(attributes["lat"]))
+        nodes[attributes["id"]] = element
 
-    try:
-        file = urllib.request.urlopen(request)
-    except urllib.error.HTTPError as e:
-        if e.code == 404:  # Not found
-            sys.exit("\tMunicipality '%s' not found\n\n" % query)
-        else:
-            raise
-
-    if query.isdigit():
-        result = json.load(file)
-        file.close()
-        municipality_name = result["kommunenavnNorsk"]
-        return (query, municipality_name)
+    elif element_type == "way":
+        element["incomplete"] = False
+        element["nodes"] = list(members)
+        element["coordinates"] = []
+        element["parents"] = set()  # Built in resolve_data()
+        ways[attributes["id"]] = element
 
-    else:
-        result = json.load(file)
-        file.close()
-        if result["antallTreff"] == 1:
-            municipality_id = result["kommuner"][0]["kommunenummer"]
-            municipality_name = result["kommuner"][0]["kommunenavnNorsk"]
-            return (municipality_id, municipality_name)
-        else:
-            municipalities = []
-            for municipality in result["kommuner"]:
-                municipalities.append(
-                    municipality["kommunenummer"]
-                    + " "
-                    + municipalities["kommunenavnNorsk"]
-                )
-            sys.exit(
-                "\tMore than one municipality found: %s\n\n" % ", ".join(municipalities)
-            )
-
-
-# Build dict data structure from XML.
-# Works for both N50 and OSM.
-
-
-def prepare_data(root, tree, nodes, ways, relations):
-    # Create dict of nodes
-    # Each node is a tuple of (lon, lat), corresponding to GeoJSON format x,y
-
-    for node in root.iter("node"):
-        nodes[node.attrib["id"]] = {
-            "xml": node,
-            "coord": (float(node.attrib["lon"]), float(node.attrib["lat"])),
-        }
+    elif element_type == "relation":
+        # Identify relations which are islands
 
-    # Create dict of ways
+        element["members"] = [ref for member_type, ref, role in members]
+        element["island"] = any(
+            key == "place" and value in ["islet", "island"] for key, value in tags
+        )
+        relations[attributes["id"]] = element
 
-    for way in root.iter("way"):
-        way_id = way.attrib["id"]
+    return element
 
-        way_nodes = []
-        way_coordinates = []
-        incomplete = False
 
-        # Get way nodes + determine if way is complete
+# Get coordinates of ways and parents of ways, and remove incomplete relations
 
-        for node in way.iter("nd"):
-            node_id = node.attrib["ref"]
-            if node_id in nodes:
-                way_nodes.append(node_id)
-                way_coordinates.append(nodes[node_id]["coord"])
-            else:
-                incomplete = True
-                way_nodes = []
-                way_coordinates = []
-                break
 
-        ways[way_id] = {
-            "xml": way,
-            "incomplete": incomplete,
-            "nodes": way_nodes,
-            "coordinates": way_coordinates,
-            "parents": set(),  # Built in next loop
-        }
+def resolve_data(nodes, ways, relations):
+    # Get way coordinates + determine if way is complete
 
-    # Create dict of relations
+    for way in ways.values():
+        if all(node_id in nodes for node_id in way["nodes"]):
+            way["coordinates"] = [nodes[node_id]["coord"] for node_id in way["nodes"]]
+        else:
+            way["incomplete"] = True
+            way["nodes"] = []
 
-    for relation in root.iter("relation"):
-        relation_id = relation.attrib["id"]
+    # Get parents of ways
 
+    for relation_id, relation in list(relations.items()):
         incomplete = False
-        members = []
-        for member in relation.iter("member"):
-            way_id = member.attrib["ref"]
-            members.append(way_id)
+        for way_id in relation["members"]:
             if way_id in ways:
                 ways[way_id]["parents"].add(
                     relation_id
@@ -157,27 +118,39 @@ def prepare_data(root, tree, nodes, ways, relations):
             else:
                 incomplete = True
 
-        # Identify relations which are islands
+        if incomplete:  # Do not store incomplete relations
+            del relations[relation_id]
+
+
+# Parse XML file and build dict data structure with one pass over the elements.
+# Each element is released from the XML tree when it has been added, so that only
+# the compact element data is kept. Bounds and meta from Overpass are not kept.
+# Returns root attributes and list of all elements, in file order.
+# Works for both N50 and OSM.
 
-        island = False
-        for tag in relation.iter("tag"):
-            if tag.attrib["k"] == "place" and tag.attrib["v"] in ["islet", "island"]:
-                island = True
-                break
 
-        if not incomplete:  # Do not store incomplete relations
-            relations[relation_id] = {
-                "xml": relation,
-                "members": members,
-                "island": island,
-            }
+def load_data(file, nodes, ways, relations):
+    elements = []
+    context = ET.iterparse(file, events=("start", "end"))
+    event, root = next(context)
+    root_attributes = dict(root.attrib)
+
+    for event, element in context:
+        if event == "end" and element.tag in ["node", "way", "relation"]:
+            data = osmfile.element_data(element)
+            elements.append(add_element(data, nodes, ways, relations))
+            element.clear()
+            root.clear()
+
+    resolve_data(nodes, ways, relations)
+    return (root_attributes, elements)
 
 
 # Load relevant OSM elements for chosen municipality
 
 
 def load_osm():
-    global osm_root, osm_tree
+    global osm_attributes, osm_elements
 
     message("Load existing OSM elements from Overpass ...\n")
 
@@ -190,27 +163,22 @@ def load_osm():
         + "(._;>;<;);out meta;"
     )
 
-    request = urllib.request.Request(
-        overpass_api + "?data=" + urllib.parse.quote(query), headers=header
+    file = http_client.request(
+        overpass_api + "?data=" + urllib.parse.quote(query), stream=True
     )
-    file = urllib.request.urlopen(request)
-    data = file.read()
+    osm_attributes, osm_elements = load_data(file, osm_nodes, osm_ways, osm_relations)
     file.close()
 
-    osm_root = ET.fromstring(data)
-    osm_tree = ET.ElementTree(osm_root)
-
-    prepare_data(osm_root, osm_tree, osm_nodes, osm_ways, osm_relations)
-
     message("\tLoaded %i ways, %i relations\n" % (len(osm_ways), len(osm_relations)))
 
     # Get and display top contributors
 
     users = {}
-    for element in osm_root:
-        if "user" in element.attrib:
-            user = element.attrib["user"]
-            if element.tag in ["way", "relation"]:
+    for element in osm_elements:
+        element_type, attributes, members, tags = element["data"]
+        if "user" in attributes:
+            user = attributes["user"]
+            if element_type in ["way", "relation"]:
                 if user not in users:
                     users[user] = 0
                 users[user] += 1
@@ -228,62 +196,117 @@ def load_osm():
 
 
 def load_n50():
-    global n50_root, n50_tree
+    global n50_elements
 
     message("Load N50 import file elements ...\n")
 
-    if os.path.isfile(filename):
-        file = open(filename)
+    if n50_store:
+        n50_elements = load_store(n50_store, n50_nodes, n50_ways, n50_relations)
     else:
-        file = open(os.path.expanduser(import_folder + filename))
-
-    data = file.read()
-    file.close()
-
-    n50_root = ET.fromstring(data)
-    n50_tree = ET.ElementTree(n50_root)
+        if os.path.isfile(filename):
+            file = osmfile.open_file(filename, "rb")
+        else:
+            file = osmfile.open_file(os.path.expanduser(import_folder + filename), "rb")
 
-    prepare_data(n50_root, n50_tree, n50_nodes, n50_ways, n50_relations)
+        root_attributes, n50_elements = load_data(
+            file, n50_nodes, n50_ways, n50_relations
+        )
+        file.close()
 
-    for element in n50_root:
-        if int(element.attrib["id"]) > 0:
+    for element in n50_elements:
+        if int(element["data"][1]["id"]) > 0:
             sys.exit("\t*** Please do not import existing OSM elements\n")
 
     message("\tLoaded %i ways, %i relations\n" % (len(n50_ways), len(n50_relations)))
 
 
+# Load N50 elements from SQLite element store saved by n50osm.py into dict data
+# structure, without building an XML tree.
+# Returns list of all elements, in the same order as in the OSM file.
+
+
+def load_store(db, nodes, ways, relations):
+    elements = []
+    for element_type in ["node", "way", "relation"]:
+        for seq, attributes, members, tags in osmfile.store_elements(db, element_type):
+            data = (element_type, attributes, members, tags)
+            elements.append((seq, add_element(data, nodes, ways, relations)))
+
+    resolve_data(nodes, ways, relations)
+
+    elements.sort(key=lambda element: element[0])
+    return [element for seq, element in elements]
+
+
+# Create XML element from element type, attributes, refs or members, and tags
+
+
+def create_xml(element_type, attributes, members, tags):
+    element = ET.Element(element_type, attributes)
+    if element_type == "way":
+        for ref in members:
+            ET.SubElement(element, "nd", ref=ref)
+    elif element_type == "relation":
+        for member_type, ref, role in members:
+            ET.SubElement(element, "member", type=member_type, ref=ref, role=role)
+    for key, value in tags:
+        ET.SubElement(element, "tag", k=key, v=value)
+    return element
+
+
+# Get XML element of N50 or OSM element for modification, created from the element
+# data the first time
+
+
+def element_xml(element):
+    if element["xml"] is None:
+        element["xml"] = create_xml(*element["data"])
+    return element["xml"]
+
+
+# Get tags of N50 or OSM element as list of (key, value)
+
+
+def element_tags(element):
+    if element["xml"] is None:
+        return element["data"][3]
+    return [(tag.attrib["k"], tag.attrib["v"]) for tag in element["xml"].iter("tag")]
+
+
+# Write N50 or OSM element to writer, from its XML element if it has been modified
+
+
+def write_element(osm_file, element):
+    if element["xml"] is None:
+        osmfile.write_data(osm_file, element["data"])
+    else:
+        osmfile.write_data(osm_file, osmfile.element_data(element["xml"]))
+
+
 # Filter elements according to given part (coastline, water, wood, landuse/other).
 # Found elements are returned in 'found_elements' parameter (set).
 
 
 def filter_parts(part, n50_elements, found_elements):
     for element_id, element in iter(n50_elements.items()):
-        all_tags = element["xml"].findall("tag")
-        if all_tags != None:
-            for tag in all_tags:
-                key = tag.attrib["k"]
-                value = tag.attrib["v"]
-                if (
-                    part == "coastline"
-                    and (
-                        key == "natural"
-                        and value == "coastline"
-                        or key == "seamark:type"
-                    )
-                    or part == "water"
-                    and (
-                        key == "natural"
-                        and value in ["water", "wetland", "glacier"]
-                        or key == "waterway"
-                    )
-                    or part == "wood"
-                    and key == "natural"
-                    and value == "wood"
-                    or part == "landuse"
-                    and key in ["landuse", "leisure", "aeroway"]
-                ):
-                    found_elements.add(element_id)
-                    break
+        for key, value in element_tags(element):
+            if (
+                part == "coastline"
+                and (key == "natural" and value == "coastline" or key == "seamark:type")
+                or part == "water"
+                and (
+                    key == "natural"
+                    and value in ["water", "wetland", "glacier"]
+                    or key == "waterway"
+                )
+                or part == "wood"
+                and key == "natural"
+                and value == "wood"
+                or part == "landuse"
+                and key in ["landuse", "leisure", "aeroway"]
+            ):
+                found_elements.add(element_id)
+                break
 
 
 # Split N50 import file into parts (coastline, water, wood, landuse/other).
@@ -299,9 +322,6 @@ def split_n50():
         ways = set()
         nodes = set()
 
-        root = ET.Element("osm", version="0.6")
-        tree = ET.ElementTree(root)
-
         # Identify elements to include
 
         filter_parts(part, n50_relations, relations)
@@ -314,45 +334,49 @@ def split_n50():
             for member in n50_relations[relation]["members"]:
                 ways.add(member)
 
-        # Collect additional elements for islands
+        # Collect additional elements for islands.
+        # Repeat until no more islands are found, since an island may be connected
+        # to the part through other islands.
 
         if part in ["coastline", "water"]:
-            for relation_id, relation in iter(n50_relations.items()):
-                if relation["island"]:
-                    for member in relation["members"]:
-                        if member in ways:
-                            relations.add(relation_id)
-                            for island_member in relation["members"]:
-                                ways.add(island_member)
-                            break
+            found = True
+            while found:
+                found = False
+                for relation_id, relation in iter(n50_relations.items()):
+                    if relation["island"] and relation_id not in relations:
+                        for member in relation["members"]:
+                            if member in ways:
+                                relations.add(relation_id)
+                                for island_member in relation["members"]:
+                                    ways.add(island_member)
+                                found = True
+                                break
 
         for way in ways:
             for node in n50_ways[way]["nodes"]:
                 nodes.add(node)
 
-        # Build output tree
-
-        for node in n50_root.iter("node"):
-            if node.attrib["id"] in nodes:
-                root.append(node)
-
-        for way in n50_root.iter("way"):
-            if way.attrib["id"] in ways:
-                root.append(way)
-
-        for relation in n50_root.iter("relation"):
-            if relation.attrib["id"] in relations:
-                root.append(relation)
-
         # Generate file
 
-        root.set("generator", "n50merge v" + version)
-        root.set("upload", "false")
-        indent_tree(root)
+        part_filename = output_filename.replace("merged.osm", part + ".osm")
+        osm_file = osmfile.open_writer(
+            part_filename,
+            {"version": "0.6", "generator": "n50merge v" + version, "upload": "false"},
+        )
 
-        part_filename = output_filename.replace("merged.osm", "") + part + ".osm"
+        for element_type, selected in [
+            ("node", nodes),
+            ("way", ways),
+            ("relation", relations),
+        ]:
+            for element in n50_elements:
+                if (
+                    element["data"][0] == element_type
+                    and element["data"][1]["id"] in selected
+                ):
+                    write_element(osm_file, element)
 
-        tree.write(part_filename, encoding="utf-8", method="xml", xml_declaration=True)
+        osm_file.close()
 
         message(
             "Saved %i elements to file '%s'\n"
@@ -360,66 +384,164 @@ def split_n50():
         )
 
 
-# Identify duplicate ways in existing OSM.
-# Note: WIP. It identifies the ways but it does not merge.
+# Split SQLite element store into parts (coastline, water, wood, landuse/other).
+# Same rules as split_n50(), but only the elements of each part are selected from
+# the store with SQL queries, and written directly to the output file.
 
 
-def merge_osm():
-    message("Merge OSM ways ...\n")
+def split_store(db):
+    message("Splitting N50 element store ...\n")
 
-    count = 0
-    count_down = len(osm_ways)
+    for part in n50_parts:
+        message("\t%-9s: " % part.title())
 
-    ways_list = list(osm_ways.keys())
+        for table in ["part_nodes", "part_ways", "part_relations"]:
+            db.execute("DROP TABLE IF EXISTS %s" % table)
+            db.execute("CREATE TEMP TABLE %s (id INTEGER PRIMARY KEY)" % table)
 
-    for i, way_id1 in enumerate(ways_list):
-        message("\r\t%i " % count_down)
-        way1 = osm_ways[way_id1]
-        count_down -= 1
+        # Identify elements to include
 
-        for way_id2 in ways_list[i + 1 :]:
-            way2 = osm_ways[way_id2]
-            if (
-                (
-                    way1["coordinates"] == way2["coordinates"]
-                    or way1["coordinates"] == way2["coordinates"][::-1]
+        for element_type in ["node", "way", "relation"]:
+            db.execute(
+                "INSERT OR IGNORE INTO part_%ss SELECT id FROM tags"
+                " WHERE type = '%s' AND (%s)"
+                % (element_type, element_type, part_queries[part])
+            )
+
+        count_tagged_nodes = db.execute("SELECT COUNT(*) FROM part_nodes").fetchone()[0]
+
+        db.execute(
+            "INSERT OR IGNORE INTO part_ways SELECT ref FROM members"
+            " WHERE type = 'way' AND relation_id IN (SELECT id FROM part_relations)"
+        )
+
+        # Collect additional elements for islands.
+        # Repeat until no more islands are found, as in split_n50().
+
+        if part in ["coastline", "water"]:
+            found = True
+            while found:
+                found = db.execute(
+                    "INSERT OR IGNORE INTO part_relations SELECT DISTINCT relation_id"
+                    " FROM members WHERE type = 'way'"
+                    " AND ref IN (SELECT id FROM part_ways) AND relation_id IN"
+                    " (SELECT id FROM tags WHERE type = 'relation' AND key = 'place'"
+                    " AND value IN ('islet', 'island'))"
+                ).rowcount
+                db.execute(
+                    "INSERT OR IGNORE INTO part_ways SELECT ref FROM members WHERE"
+                    " type = 'way' AND relation_id IN (SELECT id FROM part_relations)"
                 )
-                and not way1["incomplete"]
-                and not way2["incomplete"]
+
+        db.execute(
+            "INSERT OR IGNORE INTO part_nodes SELECT node_id FROM way_nodes"
+            " WHERE way_id IN (SELECT id FROM part_ways)"
+        )
+
+        # Generate file
+
+        count = count_tagged_nodes
+        for table in ["part_ways", "part_relations"]:
+            count += db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0]
+
+        part_filename = output_filename.replace("merged.osm", part + ".osm")
+        osm_file = osmfile.open_writer(
+            part_filename,
+            {"version": "0.6", "generator": "n50merge v" + version, "upload": "false"},
+        )
+
+        for element_type in ["node", "way", "relation"]:
+            for seq, attributes, members, tags in osmfile.store_elements(
+                db, element_type, "part_%ss" % element_type
             ):
-                count += 1
-                way1["xml"].append(ET.Element("tag", k="MATCH", v=way_id2))
-                way1["xml"].set("action", "modify")
+                if element_type == "node":
+                    osm_file.write_node(attributes, tags)
+                elif element_type == "way":
+                    osm_file.write_way(attributes, members, tags)
+                else:
+                    osm_file.write_relation(attributes, members, tags)
+
+        osm_file.close()
+
+        message("Saved %i elements to file '%s'\n" % (count, part_filename))
+
+
+# Identify duplicate ways in existing OSM.
+# Ways are grouped by their coordinates regardless of direction, so that identical
+# ways are found in one pass. The first way in each group is tagged with a MATCH
+# tag containing the other ways in the group, as a proposal for merging.
+# Note: WIP. It identifies the ways but it does not merge.
+
+
+def merge_osm():
+    message("Merge OSM ways ...\n")
+
+    lap_time = time.time()
 
-    message("\r\tFound %i identical ways\n" % count)
+    groups = {}
+    for way_id, way in iter(osm_ways.items()):
+        if not way["incomplete"]:
+            coordinates = tuple(way["coordinates"])
+            key = min(coordinates, coordinates[::-1])
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(way_id)
+
+    count = 0
+    sizes = {}
+    for group in groups.values():
+        if len(group) > 1:
+            way_xml = element_xml(osm_ways[group[0]])
+            way_xml.append(ET.Element("tag", k="MATCH", v=";".join(group[1:])))
+            way_xml.set("action", "modify")
+            count += len(group) - 1
+            if len(group) not in sizes:
+                sizes[len(group)] = 0
+            sizes[len(group)] += 1
+
+    message("\tFound %i identical ways in %i groups\n" % (count, sum(sizes.values())))
+    for size, groups_count in sorted(sizes.items()):
+        message("\t\t%i ways: %i groups\n" % (size, groups_count))
+    message("\tRun time %s\n" % (timeformat(time.time() - lap_time)))
 
 
-# Merge tags from N50 element into OSM element, if there are no conflicts (e.g. natural=coastline + natural=wood).
+# Merge tags of N50 element (list of (key, value)) into OSM element, if there are no
+# conflicts (e.g. natural=coastline + natural=wood).
 
 
-def merge_tags(n50_xml, osm_xml):
+def merge_tags(n50_element_tags, osm_element):
     n50_tags = {}
-    for tag in n50_xml.findall("tag"):
-        n50_tags[tag.attrib["k"]] = tag.attrib["v"]
+    for key, value in n50_element_tags:
+        n50_tags[key] = value
 
     osm_tags = {}
-    for tag in osm_xml.findall("tag"):
-        key = tag.attrib["k"]
-        value = tag.attrib["v"]
+    for key, value in element_tags(osm_element):
         osm_tags[key] = value
         if key in n50_tags and value != n50_tags[key]:
             return False
 
     for key, value in iter(n50_tags.items()):
         if key not in osm_tags or value != osm_tags[key]:
+            osm_xml = element_xml(osm_element)
             osm_xml.append(ET.Element("tag", k=key, v=value))
             osm_xml.set("action", "modify")
 
     return True
 
 
+# Check if direction of way matters (streams and coastline)
+
+
+def directional_way(way):
+    for key, value in element_tags(way):
+        if key == "waterway" or (key == "natural" and value == "coastline"):
+            return True
+    return False
+
+
 # Merge N50 elements with existing OSM elements.
-# Identical ways (with identical coordinates) will be merged.
+# Identical ways (with identical coordinates, in any direction except for streams and
+# coastline) will be merged.
 # Relations will be merged if all members have been merged.
 # Note that ways which differs only slightly (e.g. one more node, or a few centimeters off) will not be merged.
 
@@ -432,22 +554,42 @@ def merge_n50():
     count_down = len(n50_ways)
     swap_nodes = {}
 
-    # Loop all N50 ways and match against all OSM ways
+    # Index of complete OSM ways by coordinates in both directions, keeping the first
+    # way in case of identical ways (same as the first match in a loop of all OSM ways).
+    # Ways in the same direction are preferred. Streams and coastline are only
+    # indexed in their own direction.
+
+    osm_index = {}
+    for osm_way_id, osm_way in iter(osm_ways.items()):
+        if not osm_way["incomplete"]:
+            osm_index.setdefault(tuple(osm_way["coordinates"]), (osm_way_id, False))
+
+    for osm_way_id, osm_way in iter(osm_ways.items()):
+        if not osm_way["incomplete"] and not directional_way(osm_way):
+            osm_index.setdefault(
+                tuple(reversed(osm_way["coordinates"])), (osm_way_id, True)
+            )
+
+    # Loop all N50 ways and look up identical OSM way
 
     for n50_way_id in list(n50_ways.keys()):
         n50_way = n50_ways[n50_way_id]
         message("\r\t%i " % count_down)
         count_down -= 1
 
-        for osm_way_id, osm_way in iter(osm_ways.items()):
-            if (
-                n50_way["coordinates"] == osm_way["coordinates"]
-                and not n50_way["incomplete"]
-                and not osm_way["incomplete"]
-            ):
+        if not n50_way["incomplete"]:
+            osm_way_id, reverse = osm_index.get(
+                tuple(n50_way["coordinates"]), (None, False)
+            )
+            if reverse and directional_way(n50_way):
+                osm_way_id = None
+
+            if osm_way_id is not None:
+                osm_way = osm_ways[osm_way_id]
+
                 # Check if conflicting tags, for example natural=water + natural=wood. Also update OSM tags.
 
-                if merge_tags(n50_way["xml"], osm_way["xml"]):
+                if merge_tags(element_tags(n50_way), osm_way):
                     # Swap ref if member in relations
 
                     for parent_id in n50_way["parents"]:
@@ -456,7 +598,7 @@ def merge_n50():
                             for i, member in enumerate(parent["members"][:]):
                                 if member == n50_way_id:
                                     parent["members"][i] = osm_way_id
-                                    member_xml = parent["xml"].find(
+                                    member_xml = element_xml(parent).find(
                                         "member[@ref='%s']" % n50_way_id
                                     )
                                     member_xml.set("ref", osm_way_id)
@@ -464,16 +606,17 @@ def merge_n50():
                     # Mark nodes for swapping, in case nodes are used by other ways
 
                     for i in range(len(n50_way["nodes"])):
-                        swap_nodes[n50_way["nodes"][i]] = osm_way["nodes"][i]
+                        if reverse:
+                            swap_nodes[n50_way["nodes"][i]] = osm_way["nodes"][-1 - i]
+                        else:
+                            swap_nodes[n50_way["nodes"][i]] = osm_way["nodes"][i]
 
-                    # Remove merged way from N50 xml
+                    # Remove merged way from N50 output
 
-                    n50_root.remove(n50_way["xml"])
+                    n50_way["removed"] = True
                     del n50_ways[n50_way_id]
                     count_ways += 1
 
-                break
-
     message("\r\t \r")
 
     # Swap affected nodes
@@ -482,7 +625,7 @@ def merge_n50():
         for i, node in enumerate(way["nodes"][:]):
             if node in swap_nodes:
                 way["nodes"][i] = swap_nodes[node]
-                node_xml = way["xml"].find("nd[@ref='%s']" % node)
+                node_xml = element_xml(way).find("nd[@ref='%s']" % node)
                 node_xml.set("ref", swap_nodes[node])
 
     # Delete N50 nodes which have been replaced, unless there is a tag conflict
@@ -499,10 +642,10 @@ def merge_n50():
 
 	"""
     for node in swap_nodes:
-        if n50_nodes[node]["xml"].find("tag") == None or not merge_tags(
-            n50_node_xml, osm_node_xml
+        if not element_tags(n50_nodes[node]) or not merge_tags(
+            element_tags(n50_nodes[node]), osm_nodes[swap_nodes[node]]
         ):
-            n50_root.remove(n50_nodes[node]["xml"])
+            n50_nodes[node]["removed"] = True
             del n50_nodes[node]
 
     # Delete N50 relations which have been replaced by OSM relations, unless there is a tag conflict
@@ -529,8 +672,8 @@ def merge_n50():
                 if parent_id in osm_relations and set(
                     osm_relations[parent_id]["members"]
                 ) == set(n50_relation["members"]):
-                    if merge_tags(n50_relation["xml"], osm_relations[parent_id]["xml"]):
-                        n50_root.remove(n50_relation["xml"])
+                    if merge_tags(element_tags(n50_relation), osm_relations[parent_id]):
+                        n50_relation["removed"] = True
                         del n50_relations[n50_relation_id]
                         count_relations += 1
                         break
@@ -539,43 +682,27 @@ def merge_n50():
     message("\tRun time %s\n" % (timeformat(time.time() - lap_time)))
 
 
-# Indent XML output
-
-
-def indent_tree(elem, level=0):
-    i = "\n" + level * "  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent_tree(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
-
-
-# Output merged N50/OSM tree to file.
+# Output merged N50/OSM elements to file.
+# Remaining N50 elements are saved after the OSM elements.
 
 
 def save_osm():
     message("Saving file ...\n")
 
-    # Merge remaining N50 tree into OSM tree
-    if n50_root:
-        for element in n50_root:
-            osm_root.append(element)
+    root_attributes = dict(osm_attributes)
+    root_attributes["generator"] = "n50merge v" + version
+    root_attributes["upload"] = "false"
 
-    osm_root.set("generator", "n50merge v" + version)
-    osm_root.set("upload", "false")
-    indent_tree(osm_root)
+    osm_file = osmfile.open_writer(output_filename, root_attributes)
 
-    osm_tree.write(
-        output_filename, encoding="utf-8", method="xml", xml_declaration=True
-    )
+    for element in osm_elements:
+        write_element(osm_file, element)
+
+    for element in n50_elements:
+        if not element["removed"]:
+            write_element(osm_file, element)
+
+    osm_file.close()
 
     message("\tSaved to file '%s'\n" % output_filename)
 
@@ -589,29 +716,44 @@ if __name__ == "__main__":
     osm_nodes = {}
     osm_ways = {}
     osm_relations = {}
-    osm_root = None
-    osm_tree = None
+    osm_attributes = {}  # Root attributes of OSM file
+    osm_elements = []  # All OSM elements in file order
 
     n50_nodes = {}
     n50_ways = {}
     n50_relations = {}
-    n50_root = None
-    n50_tree = None
+    n50_store = None  # SQLite element store, if N50 import file is a store
+    n50_elements = []  # All N50 elements in file order
 
     debug = False  # Include debug tags and unused segments
-    osm_merge = False  # Also merge overlapping lines in OSM only
+    osm_merge = "-osm" in sys.argv  # Also identify identical ways in OSM only
 
     # Parse parameters
 
     if len(sys.argv) < 2:
         message("Please provide 1) municipality, and 2) N50 filename.\n")
-        message("Option: -split\n\n")
+        message(
+            "Options: -split, -osm, -pbf, -compress <gz|bz2|xz>, -refresh,"
+            " -record <folder>, -replay <folder>, -latency <seconds>\n\n"
+        )
         sys.exit()
 
+    # Record or replay responses from servers
+
+    http_client.fixture_options(sys.argv)
+    cache_folder = http_client.fixture_cache_folder(cache_folder)
+    if http_client.fixture_mode:
+        message(
+            "Fixtures:\t%s '%s'\n"
+            % (http_client.fixture_mode.capitalize(), http_client.fixture_folder)
+        )
+
     # Get municipality
 
     municipality_query = sys.argv[1]
-    [municipality_id, municipality_name] = get_municipality_name(municipality_query)
+    [municipality_id, municipality_name] = municipality.get_municipality_name(
+        municipality_query, cache_folder, "-refresh" in sys.argv
+    )
     if municipality_id is None:
         sys.exit("Municipality '%s' not found\n" % municipality_query)
     else:
@@ -630,13 +772,45 @@ if __name__ == "__main__":
     else:
         filename = "n50_%s_%s_Arealdekke.osm" % (municipality_id, municipality_name)
 
+    # Also look for compressed file or element store if default filename is not found
+
+    if len(sys.argv) < 3 or ".osm" not in sys.argv[2]:
+        for extension in [""] + list(osmfile.compressors) + [".db"]:
+            if os.path.isfile(filename + extension) or os.path.isfile(
+                os.path.expanduser(import_folder + filename + extension)
+            ):
+                filename += extension
+                break
+
+    # Output file is compressed like input file, unless -compress is given
+
+    output_filename, compression = osmfile.split_compression(filename)
+    if output_filename.endswith(".db"):
+        output_filename = output_filename[:-3]
+    if "-compress" in sys.argv:
+        index = sys.argv.index("-compress")
+        if (
+            index + 1 < len(sys.argv)
+            and "." + sys.argv[index + 1] in osmfile.compressors
+        ):
+            compression = "." + sys.argv[index + 1]
+        else:
+            sys.exit("Please provide gz, bz2 or xz for -compress option\n")
+
     if os.path.isfile(filename) or os.path.isfile(
         os.path.expanduser(import_folder + filename)
     ):
         message("N50 filename: %s\n" % filename)
-        output_filename = filename.replace(".osm", "") + "_merged.osm"
-    elif "-osm" in sys.argv:
-        filename = ""
+        output_filename = output_filename.replace(".osm", "") + "_merged.osm"
+        if filename.endswith(".db"):
+            if os.path.isfile(filename):
+                n50_store = osmfile.open_store(filename)
+            else:
+                n50_store = osmfile.open_store(
+                    os.path.expanduser(import_folder + filename)
+                )
+    elif "-osm" in sys.argv and "-split" not in sys.argv:
+        filename = ""  # Only existing OSM
         output_filename = "n50_%s_%s_merged.osm" % (
             municipality_id,
             municipality_name.replace(" ", "_"),
@@ -644,20 +818,35 @@ if __name__ == "__main__":
     else:
         sys.exit("\t*** File '%s' not found\n\n" % filename)
 
+    if "-pbf" in sys.argv:
+        output_filename += ".pbf"  # Already compressed
+    else:
+        output_filename += compression
+
     message("\n")
 
     # Process data
 
-    load_n50()
-
-    if "-split" in sys.argv:
+    if "-split" in sys.argv and n50_store:
+        split_store(n50_store)
+    elif "-split" in sys.argv:
+        load_n50()
         split_n50()
+    elif not filename:
+        load_osm()
+        merge_osm()
+        save_osm()
     else:
+        load_n50()
         load_osm()
+        if osm_merge:
+            merge_osm()
         merge_n50()
         save_osm()
 
     duration = time.time() - start_time
+    for line in http_client.get_statistics():
+        message("\t%s\n" % line)
     message(
         "\tTotal run time %s (%i ways per second)\n\n"
         % (timeformat(duration), int(len(n50_ways) / duration))
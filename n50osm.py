@@ -2,22 +2,37 @@
 # -*- coding: utf8
 
 
-import urllib.request, urllib.parse, urllib.error
+import urllib.error
 import zipfile
-from io import BytesIO, TextIOWrapper
+from io import TextIOWrapper
 import json
 import csv
 import copy
 import sys
 import time
 import math
+import os
+import pickle
+import gzip
+import shutil
+import tempfile
+import concurrent.futures
+import threading
+import queue
 from xml.etree import ElementTree as ET
 import utm
+import osmfile
+import geopackage
+import municipality
+import http_client
 
+try:
+    import numpy as np  # Optional, used for batch geometry calculations
+except ImportError:
+    np = None
 
-version = "0.7.2"
 
-header = {"User-Agent": "nkamapper/n50osm"}
+version = "0.7.2"
 
 coordinate_decimals = 7
 
@@ -25,6 +40,20 @@ island_size = 100000  # Minimum square meters for place=island vs place=islet
 
 lake_ele_size = 2000  # Minimum square meters for fetching elevation
 
+checkpoint_interval = 60  # Seconds between checkpoints of elevations during a stage
+
+nve_page_size = 1000  # Lakes per page from NVE api
+
+nve_threads = 4  # Concurrent requests to NVE api
+
+nve_lakes_age = 30  # Days before cached NVE lakes are refreshed
+
+ssr_grid_size = 0.01  # Degrees per grid cell in index of SSR place names
+
+cache_folder = "~/.cache/n50osm/"  # Folder for cached data between runs
+
+cache_format = b"N50OSM-CACHE-1\n"  # Header and format version of N50 cache files
+
 data_categories = [
     "AdministrativeOmrader",
     "Arealdekke",
@@ -271,12 +300,19 @@ def tag_object(feature_type, geometry_type, properties, feature):
     return (tags, missing_tags)
 
 
-# Output message
+# Output message.
+# Messages from background fetches are kept until the data is used by a stage.
+# Progress counters (starting with "\r" and without newline) are not kept.
 
 
 def message(output_text):
-    sys.stdout.write(output_text)
-    sys.stdout.flush()
+    thread_id = threading.get_ident()
+    if thread_id in deferred_messages:
+        if not (output_text.startswith("\r") and not output_text.endswith("\n")):
+            deferred_messages[thread_id].append(output_text)
+    else:
+        sys.stdout.write(output_text)
+        sys.stdout.flush()
 
 
 # Format time
@@ -364,57 +400,154 @@ def polygon_centroid(polygon):
         return None
 
 
-# Tests whether point (x,y) is inside a polygon
-# Ray tracing method
+# Prepare polygon for repeated point-in-polygon tests.
+# Edges are indexed in horizontal bands, so that each test only visits the edges
+# which may cross the latitude of the point.
 
 
-def inside_polygon(point, polygon):
-    if polygon[0] == polygon[-1]:
-        x, y = point
-        n = len(polygon)
-        inside = False
-
-        p1x, p1y = polygon[0]
-        for i in range(n):
-            p2x, p2y = polygon[i]
-            if y > min(p1y, p2y):
-                if y <= max(p1y, p2y):
-                    if x <= max(p1x, p2x):
-                        if p1y != p2y:
-                            xints = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-                        if p1x == p2x or x <= xints:
-                            inside = not inside
-            p1x, p1y = p2x, p2y
-
-        return inside
+def prepare_polygon(polygon):
+    prepared = {
+        "closed": polygon[0] == polygon[-1],
+        "bbox": get_bbox(polygon, 0),
+        "edges": [],
+        "bands": [],
+    }
 
-    else:
+    if not prepared["closed"]:
+        return prepared
+
+    # Horizontal edges are never crossed by the ray, so they are left out
+
+    for i in range(1, len(polygon)):
+        if polygon[i - 1][1] != polygon[i][1]:
+            prepared["edges"].append((polygon[i - 1], polygon[i]))
+
+    band_count = max(1, int(math.sqrt(len(prepared["edges"]))))
+    prepared["bands"] = [[] for i in range(band_count)]
+    prepared["band_height"] = (
+        prepared["bbox"][1][1] - prepared["bbox"][0][1]
+    ) / band_count
+
+    for edge in prepared["edges"]:
+        first_band = polygon_band(min(edge[0][1], edge[1][1]), prepared)
+        last_band = polygon_band(max(edge[0][1], edge[1][1]), prepared)
+        for band in range(first_band, last_band + 1):
+            prepared["bands"][band].append(edge)
+
+    return prepared
+
+
+# Get band of prepared polygon for latitude
+
+
+def polygon_band(y, prepared):
+    if prepared["band_height"] == 0:
+        return 0
+    band = int((y - prepared["bbox"][0][1]) / prepared["band_height"])
+    return min(max(band, 0), len(prepared["bands"]) - 1)
+
+
+# Tests whether point (x,y) is inside a prepared polygon
+# Ray tracing method. Returns None if the polygon is not closed.
+
+
+def inside_prepared_polygon(point, prepared):
+    if not prepared["closed"]:
         return None
 
+    x, y = point
+    min_bbox, max_bbox = prepared["bbox"]
+    if not (min_bbox[0] <= x <= max_bbox[0] and min_bbox[1] <= y <= max_bbox[1]):
+        return False
+
+    inside = False
+    for (p1x, p1y), (p2x, p2y) in prepared["bands"][polygon_band(y, prepared)]:
+        if min(p1y, p2y) < y <= max(p1y, p2y) and x <= max(p1x, p2x):
+            xints = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+            if p1x == p2x or x <= xints:
+                inside = not inside
+
+    return inside
+
+
+# Tests a batch of points (list or NumPy array of (x,y)) against a prepared polygon
+# Returns list of results, or a NumPy array of booleans if NumPy is available.
+# With NumPy, all points within bbox are tested against all edges at once, in slices
+# of points to limit memory. Same result as inside_prepared_polygon.
+
+
+def inside_prepared_points(points, prepared):
+    if np is None or not prepared["closed"]:
+        return [inside_prepared_polygon(point, prepared) for point in points]
 
-# Test whether point (x,y) is inside a multipolygon, i.e. not inside inner polygons
+    if "edge_array" not in prepared:
+        prepared["edge_array"] = np.array(prepared["edges"], dtype=float).reshape(-1, 4)
+    p1x, p1y, p2x, p2y = prepared["edge_array"].T
 
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    min_bbox, max_bbox = prepared["bbox"]
+    candidates = np.flatnonzero(
+        (min_bbox[0] <= points[:, 0])
+        & (points[:, 0] <= max_bbox[0])
+        & (min_bbox[1] <= points[:, 1])
+        & (points[:, 1] <= max_bbox[1])
+    )
+
+    result = np.zeros(len(points), dtype=bool)
+    slice_size = max(1, 1000000 // max(len(p1x), 1))
+    for start in range(0, len(candidates), slice_size):
+        index = candidates[start : start + slice_size]
+        x = points[index, 0:1]  # One row per point, one column per edge
+        y = points[index, 1:2]
+        crossing = (
+            (np.minimum(p1y, p2y) < y)
+            & (y <= np.maximum(p1y, p2y))
+            & (x <= np.maximum(p1x, p2x))
+        )
+        xints = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+        crossing &= (p1x == p2x) | (x <= xints)
+        result[index] = np.count_nonzero(crossing, axis=1) % 2 == 1
+
+    return result
 
-def inside_multipolygon(point, multipolygon):
+
+# Prepare multipolygon for repeated point-in-polygon tests, or None if not valid
+
+
+def prepare_multipolygon(multipolygon):
     if (
         type(multipolygon) is list
         and len(multipolygon) > 0
         and type(multipolygon[0]) is list
         and multipolygon[0][0] == multipolygon[0][-1]
     ):
-        inside = inside_polygon(point, multipolygon[0])
-        if inside:
-            for patch in multipolygon[1:]:
-                inside = inside and not inside_polygon(point, patch)
-                if not inside:
-                    break
-
-        return inside
-
+        return [prepare_polygon(patch) for patch in multipolygon]
     else:
         return None
 
 
+# Tests a batch of points against a prepared multipolygon, i.e. inside the outer
+# patch and not inside inner patches. Returns list of results, which are None if
+# the multipolygon is not valid.
+
+
+def inside_prepared_multipolygon(points, prepared):
+    if prepared is None:
+        return [None] * len(points)
+
+    inside = list(inside_prepared_points(points, prepared[0]))
+    for patch in prepared[1:]:
+        if any(inside):
+            inside = [
+                point_inside and not patch_inside
+                for point_inside, patch_inside in zip(
+                    inside, inside_prepared_points(points, patch)
+                )
+            ]
+
+    return inside
+
+
 # Calculate new node with given distance offset in meters
 # Works over short distances
 
@@ -455,6 +588,222 @@ def get_bbox(coordinates, perimeter):
     return [min_node, max_node]
 
 
+# Cached geometry properties of features and segments.
+# The cache is stored in the element together with the coordinates it was calculated
+# from, and the cache of each patch together with the patch. It is recalculated when
+# the coordinates or a patch have been replaced, for example after simplification.
+# Coordinates which are changed in place (node removed or relocated) must be followed
+# by update_geometry. Reversing a line with reverse_geometry keeps the cached bbox.
+# The bbox of lines and segments is always kept, since it is used directly in loops.
+
+
+def geometry_cache(element, i=None):
+    coordinates = element["coordinates"]
+    cache = element.get("geometry")
+    if cache is None or cache["coordinates"] is not coordinates:
+        cache = {"coordinates": coordinates}
+        element["geometry"] = cache
+
+    if i is None:
+        return cache
+
+    patch = coordinates[i]
+    if i not in cache or cache[i]["coordinates"] is not patch:
+        cache[i] = {"coordinates": patch}
+    return cache[i]
+
+
+# Recalculate cached geometry after coordinates have been changed in place
+
+
+def update_geometry(element):
+    element.pop("geometry", None)
+    if element["type"] != "Polygon":
+        element_bbox(element)
+
+
+# Reverse coordinates of line or segment, keeping the cached bbox
+
+
+def reverse_geometry(element):
+    element["coordinates"].reverse()
+
+
+# Get cached bbox of line, or of outer patch of polygon
+
+
+def element_bbox(element):
+    cache = geometry_cache(element)
+    if "bbox" not in cache:
+        cache["bbox"] = get_bbox(element["coordinates"], 0)
+    return cache["bbox"]
+
+
+# Get cached bbox of patch (ring) of polygon
+
+
+def patch_bbox(feature, i):
+    cache = geometry_cache(feature, i)
+    if "bbox" not in cache:
+        cache["bbox"] = get_bbox(feature["coordinates"][i], 0)
+    return cache["bbox"]
+
+
+# Get cached signed area of patch (ring) of polygon, same as polygon_area
+# < 0: Clockwise
+# > 0: Counter-clockwise
+
+
+def patch_area(feature, i):
+    cache = geometry_cache(feature, i)
+    if "area" not in cache:
+        cache["area"] = polygon_area(feature["coordinates"][i])
+    return cache["area"]
+
+
+# Get cached centroid of patch (ring) of polygon, same as polygon_centroid
+
+
+def patch_centroid(feature, i):
+    cache = geometry_cache(feature, i)
+    if "centroid" not in cache:
+        cache["centroid"] = polygon_centroid(feature["coordinates"][i])
+    return cache["centroid"]
+
+
+# Calculate signed area, centroid and bbox of many patches (rings) in one batch.
+# Vertices of all patches are concatenated in a NumPy array, and patch i is given by
+# vertices[offsets[i]:offsets[i+1]].
+# The terms of each patch are summed with bincount, which adds them one by one in
+# vertex order (np.add.reduceat uses pairwise summation), so the results are the
+# same as from polygon_area, polygon_centroid and get_bbox.
+
+
+def patch_kernels(vertices, offsets):
+    lat_dist = math.pi * 6371009.0 / 180.0
+
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1]
+    ends = offsets[1:] - 1  # Last vertex of each patch
+    patch_count = len(starts)
+
+    lon = np.ascontiguousarray(vertices[:, 0])
+    lat = np.ascontiguousarray(vertices[:, 1])
+
+    # Same latitude scaling as polygon_area
+    cos_lat = np.fromiter(
+        map(math.cos, map(math.radians, lat.tolist())), dtype=float, count=len(lat)
+    )
+    y = lat * lat_dist
+    x = lon * lat_dist * cos_lat
+    area_terms = (y[1:] - y[:-1]) * (x[1:] + x[:-1])  # (x2-x1)(y2+y1)
+
+    det_terms = lon[:-1] * lat[1:] - lon[1:] * lat[:-1]  # (x1*y2 - x2*y1)
+    x_terms = (lon[:-1] + lon[1:]) * det_terms
+    y_terms = (lat[:-1] + lat[1:]) * det_terms
+
+    # Leave out terms between last vertex of a patch and first vertex of the next
+
+    patch_index = np.repeat(np.arange(patch_count), np.diff(offsets))[:-1]
+    inside = np.ones(len(patch_index), dtype=bool)
+    inside[ends[:-1]] = False
+    patch_index = patch_index[inside]
+
+    def patch_sums(terms):
+        return np.bincount(
+            patch_index, weights=terms[inside], minlength=patch_count
+        ).tolist()
+
+    area_sums = patch_sums(area_terms)
+    det_sums = patch_sums(det_terms)
+    x_sums = patch_sums(x_terms)
+    y_sums = patch_sums(y_terms)
+
+    closed = ((lon[starts] == lon[ends]) & (lat[starts] == lat[ends])).tolist()
+
+    min_lon = np.minimum.reduceat(lon, starts).tolist()
+    min_lat = np.minimum.reduceat(lat, starts).tolist()
+    max_lon = np.maximum.reduceat(lon, starts).tolist()
+    max_lat = np.maximum.reduceat(lat, starts).tolist()
+
+    areas = []
+    centroids = []
+    bboxes = []
+
+    for i in range(patch_count):
+        bboxes.append([[min_lon[i], min_lat[i]], [max_lon[i], max_lat[i]]])
+
+        if closed[i]:
+            areas.append(int(area_sums[i] / 2.0))
+            det = det_sums[i]
+            if det != 0:
+                centroids.append((x_sums[i] / (3.0 * det), y_sums[i] / (3.0 * det)))
+            else:
+                centroids.append(False)  # Degenerate, use polygon_centroid
+        else:
+            areas.append(0)
+            centroids.append(None)
+
+    return (areas, centroids, bboxes)
+
+
+# Fill geometry cache of all patches of given polygon features in one batch.
+# Without NumPy, the cache is filled patch by patch when needed.
+
+
+def batch_patch_geometry(feature_list):
+    if np is None:
+        return
+
+    patches = []
+    vertices = []
+    offsets = [0]
+
+    for feature in feature_list:
+        if feature["type"] == "Polygon":
+            for i, patch in enumerate(feature["coordinates"]):
+                if len(patch) > 1 and "area" not in geometry_cache(feature, i):
+                    patches.append((feature, i))
+                    vertices.extend(patch)
+                    offsets.append(len(vertices))
+
+    if not patches:
+        return
+
+    areas, centroids, bboxes = patch_kernels(np.array(vertices, dtype=float), offsets)
+
+    for j, (feature, i) in enumerate(patches):
+        cache = geometry_cache(feature, i)
+        cache["area"] = areas[j]
+        cache["bbox"] = bboxes[j]
+        if centroids[j] is not False:
+            cache["centroid"] = centroids[j]
+
+
+# Get area of polygon feature excluding inner patches, same as multipolygon_area
+
+
+def feature_area(feature):
+    multipolygon = feature["coordinates"]
+    if (
+        type(multipolygon) is list
+        and len(multipolygon) > 0
+        and type(multipolygon[0]) is list
+        and multipolygon[0][0] == multipolygon[0][-1]
+    ):
+        area = patch_area(feature, 0)
+        for i in range(1, len(multipolygon)):
+            inner_area = patch_area(feature, i)
+            if inner_area:
+                area -= inner_area
+            else:
+                return None
+        return area
+
+    else:
+        return None
+
+
 # Create feature with one point
 
 
@@ -526,72 +875,28 @@ def parse_coordinates(coord_text):
     return coordinates
 
 
-# Get name or id of municipality from GeoNorge api
-
-
-def get_municipality_name(query):
-    if query.isdigit():
-        url = "https://ws.geonorge.no/kommuneinfo/v1/kommuner/" + query
-    else:
-        url = "https://ws.geonorge.no/kommuneinfo/v1/sok?knavn=" + urllib.parse.quote(
-            query
-        )
-
-    request = urllib.request.Request(url, headers=header)
-
-    try:
-        file = urllib.request.urlopen(request)
-    except urllib.error.HTTPError as e:
-        if e.code == 404:  # Not found
-            sys.exit("\tMunicipality '%s' not found\n\n" % query)
-        else:
-            raise
-
-    if query.isdigit():
-        result = json.load(file)
-        file.close()
-        municipality_name = result["kommunenavnNorsk"]
-        return (query, municipality_name)
-
-    else:
-        result = json.load(file)
-        file.close()
-        if result["antallTreff"] == 1:
-            municipality_id = result["kommuner"][0]["kommunenummer"]
-            municipality_name = result["kommuner"][0]["kommunenavnNorsk"]
-            return (municipality_id, municipality_name)
-        else:
-            municipalities = []
-            for municipality in result["kommuner"]:
-                municipalities.append(
-                    municipality["kommunenummer"]
-                    + " "
-                    + municipalities["kommunenavnNorsk"]
-                )
-            sys.exit(
-                "\tMore than one municipality found: %s\n\n" % ", ".join(municipalities)
-            )
-
-
-# Load conversion CSV table for tagging building types
+# Parse conversion CSV table for tagging building types
 # Format in CSV: "key=value + key=value + ..."
+# The bundled building_types.csv has all tags in the "OSM tag" column, followed by a
+# description column, while the GitHub file has an extra tag column.
 
 
-def load_building_types():
-    # 	file = open("building_types.csv")
-    url = "https://raw.githubusercontent.com/NKAmapper/building2osm/main/building_types.csv"
-    request = urllib.request.Request(url, headers=header)
-    file = urllib.request.urlopen(request)
+def parse_building_types(file):
+    tags = {}
 
     building_csv = csv.DictReader(
-        TextIOWrapper(file, "utf-8"),
+        file,
         fieldnames=["id", "name", "building_tag", "extra_tag"],
         delimiter=";",
     )
-    next(building_csv)
+    csv_header = next(building_csv)
+    extra_column = csv_header["building_tag"] != "OSM tag"
 
     for row in building_csv:
-        tag_string = (row["building_tag"] + "+" + row["extra_tag"]).strip().strip("+")
+        tag_string = row["building_tag"] or ""
+        if extra_column:
+            tag_string += "+" + (row["extra_tag"] or "")
+        tag_string = tag_string.strip().strip("+")
 
         if tag_string:
             osm_tag = {}
@@ -601,9 +906,51 @@ def load_building_types():
                 tag_split = tag_part.split("=")
                 osm_tag[tag_split[0]] = tag_split[1]
 
-            building_tags[row["id"]] = osm_tag
+            tags[row["id"]] = osm_tag
 
+    return tags
+
+
+# Get conversion table for tagging building types.
+# The table is taken from the bundled building_types.csv, or from GitHub when -refresh
+# is given. The parsed table is cached, and the bundled file is only parsed again if
+# it is newer than the cache.
+
+
+def fetch_building_types():
+    filename = cache_filename("building_types.pickle")
+    bundled_filename = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "building_types.csv"
+    )
+
+    if refresh_cache:
+        url = "https://raw.githubusercontent.com/NKAmapper/building2osm/main/building_types.csv"
+        try:
+            file = http_client.request(url)
+            tags = parse_building_types(TextIOWrapper(file, "utf-8"))
+            file.close()
+            save_pickle(filename, {"time": time.time(), "building_tags": tags})
+            return tags
+        except urllib.error.URLError as e:
+            message("\t*** Building types not refreshed from GitHub: %s\n" % e.reason)
+
+    cache = load_pickle(filename)
+    if cache and cache["time"] >= os.path.getmtime(bundled_filename):
+        return cache["building_tags"]
+
+    file = open(bundled_filename, encoding="utf-8-sig")
+    tags = parse_building_types(file)
     file.close()
+    save_pickle(filename, {"time": time.time(), "building_tags": tags})
+
+    return tags
+
+
+# Load conversion table for tagging building types (possibly prefetched)
+
+
+def load_building_types():
+    building_tags.update(prefetched("building_types", fetch_building_types))
 
 
 # Compute length based on coordinates (not in meters)
@@ -619,6 +966,22 @@ def simple_length(coord):
     return length
 
 
+# Compute approximate length of line in meters
+# Simple conversion to planar projection, works for short distances
+
+
+def line_length(coord):
+    lat_dist = math.pi * 6371009.0 / 180.0
+
+    length = 0.0
+    for i in range(len(coord) - 1):
+        dx = (coord[i + 1][0] - coord[i][0]) * math.cos(math.radians(coord[i][1]))
+        dy = coord[i + 1][1] - coord[i][1]
+        length += math.sqrt(dx**2 + dy**2) * lat_dist
+
+    return length
+
+
 # Split patch if self-intersecting or touching polygon
 
 
@@ -658,6 +1021,27 @@ def get_property(top, ns_app):
     return properties
 
 
+# Get name of N50 file for municipality at Kartverket (without extension)
+
+
+def n50_filename(municipality_id, municipality_name):
+    return "Basisdata_%s_%s_25833_N50Kartdata_GML" % (
+        municipality_id,
+        municipality.file_name(municipality_name),
+    )
+
+
+# Get url of N50 zip file at Kartverket
+
+
+def n50_url(filename):
+    return (
+        "https://nedlasting.geonorge.no/geonorge/Basisdata/N50Kartdata/GML/"
+        + filename
+        + ".zip"
+    )
+
+
 # Load N50 topo data from Kartverket
 
 
@@ -675,29 +1059,19 @@ def load_n50_data(municipality_id, municipality_name, data_category):
 
     # Load latest N50 file for municipality from Kartverket
 
-    filename = "Basisdata_%s_%s_25833_N50Kartdata_GML" % (
-        municipality_id,
-        municipality_name,
-    )
-    filename = (
-        filename.replace("Æ", "E")
-        .replace("Ø", "O")
-        .replace("Å", "A")
-        .replace("æ", "e")
-        .replace("ø", "o")
-        .replace("å", "a")
-        .replace(" ", "_")
-    )
+    filename = n50_filename(municipality_id, municipality_name)
     message("\tLoading file '%s'\n" % filename)
 
-    request = urllib.request.Request(
-        "https://nedlasting.geonorge.no/geonorge/Basisdata/N50Kartdata/GML/"
-        + filename
-        + ".zip",
-        headers=header,
-    )
-    file_in = urllib.request.urlopen(request)
-    zip_file = zipfile.ZipFile(BytesIO(file_in.read()))
+    # The zip file is streamed to a temporary file, not held in memory
+
+    response = http_client.request(n50_url(filename), stream=True)
+    file_in = tempfile.TemporaryFile()
+    shutil.copyfileobj(response, file_in)
+    response.close()
+    zip_file = zipfile.ZipFile(file_in)
+
+    if data_category == "BygningerOgAnlegg":
+        load_building_types()  # Prefetched during download
 
     # 	for file_entry in zip_file.namelist():
     # 		message ("\t%s\n" % file_entry)
@@ -705,22 +1079,22 @@ def load_n50_data(municipality_id, municipality_name, data_category):
     filename2 = filename.replace("Kartdata", data_category)  # For example "Arealdekke"
     file = zip_file.open(filename2 + ".gml")
 
-    tree = ET.parse(file)
-    file.close()
-    file_in.close()
-    root = tree.getroot()
-
     ns_gml = "http://www.opengis.net/gml/3.2"
     ns_app = "http://skjema.geonorge.no/SOSI/produktspesifikasjon/N50/20170401"
 
     ns = {"gml": ns_gml, "app": ns_app}
 
-    # Loop features, parse and load into data structure and tag
+    # Loop features while parsing, load into data structure and tag.
+    # Each feature is released from the XML tree when it has been loaded.
 
     message("\tParsing...\n")
 
-    for feature in root:
-        if "featureMember" in feature.tag:
+    context = ET.iterparse(file, events=("start", "end"))
+    event, root = next(context)
+
+    for event, feature in context:
+        if event == "end" and "featureMember" in feature.tag:
+            root.remove(feature)
             feature_type = feature[0].tag[len(ns_app) + 2 :]
             geometry_type = None
             gml_id = feature[0].attrib["{%s}id" % ns_gml]
@@ -842,10 +1216,19 @@ def load_n50_data(municipality_id, municipality_name, data_category):
                     if key not in avoid_tags:
                         entry["tags"]["N50_" + key] = value
 
-            # Add to relevant list
+            # Add to relevant list, or save directly to geojson file
 
             if not (entry["type"] == "LineString" and len(entry["coordinates"]) <= 1):
-                if geometry_type == "grense":
+                if geojson_file and (
+                    geometry_type == "grense"
+                    or not (entry["type"] == "Point" and not entry["tags"])
+                    or debug
+                ):
+                    if geometry_type == "grense":
+                        save_raw_feature(entry, "segments")
+                    else:
+                        save_raw_feature(entry, "features")
+                elif geometry_type == "grense":
                     if feature_type in [
                         "Kystkontur",
                         "HavElvSperre",
@@ -886,6 +1269,9 @@ def load_n50_data(municipality_id, municipality_name, data_category):
             if feature_type == "ElvBekk":
                 stream_count += 1
 
+    file.close()
+    file_in.close()
+
     message("\tObjects loaded:\n")
     for object_type in sorted(object_count):
         if object_type not in auxiliary_objects:
@@ -898,7 +1284,10 @@ def load_n50_data(municipality_id, municipality_name, data_category):
 
     message("\tSource dates: %s - %s\n" % (source_date[0], source_date[1]))
     message("\tUpdate dates: %s - %s\n" % (update_date[0], update_date[1]))
-    message("\t%i feature objects, %i segments\n" % (len(features), len(segments)))
+    if geojson_file:
+        message("\t%i features saved to geojson file\n" % geojson_file.count)
+    else:
+        message("\t%i feature objects, %i segments\n" % (len(features), len(segments)))
     message("\tRun time %s\n" % (timeformat(time.time() - lap)))
 
 
@@ -951,7 +1340,7 @@ def create_border_segments(patch, members, gml_id, match):
                 "extras": {"objekttype": "KantUtsnitt"},
                 "used": 1,
             }
-            [entry["min_bbox"], entry["max_bbox"]] = get_bbox(entry["coordinates"], 0)
+            element_bbox(entry)
             segments.append(entry)
             members.append(len(segments) - 1)
             start_index = end_index
@@ -978,7 +1367,7 @@ def split_polygons():
     # Create bbox for segments and line features
 
     for segment in segments:
-        [segment["min_bbox"], segment["max_bbox"]] = get_bbox(segment["coordinates"], 0)
+        element_bbox(segment)
 
     # Loop all polygons and patches
 
@@ -989,21 +1378,22 @@ def split_polygons():
         if feature["type"] == "Polygon":
             matching_polygon = []
 
-            for patch in feature["coordinates"]:
+            for patch_index, patch in enumerate(feature["coordinates"]):
                 matching_segments = []
                 matched_nodes = 0
                 patch_set = set(patch)
 
                 # Try matching with segments within the polygon's bbox
 
-                [patch_min_bbox, patch_max_bbox] = get_bbox(patch, 0)
+                [patch_min_bbox, patch_max_bbox] = patch_bbox(feature, patch_index)
 
                 for i, segment in enumerate(segments):
+                    [segment_min_bbox, segment_max_bbox] = segment["geometry"]["bbox"]
                     if (
-                        patch_min_bbox[0] <= segment["max_bbox"][0]
-                        and patch_max_bbox[0] >= segment["min_bbox"][0]
-                        and patch_min_bbox[1] <= segment["max_bbox"][1]
-                        and patch_max_bbox[1] >= segment["min_bbox"][1]
+                        patch_min_bbox[0] <= segment_max_bbox[0]
+                        and patch_max_bbox[0] >= segment_min_bbox[0]
+                        and patch_min_bbox[1] <= segment_max_bbox[1]
+                        and patch_max_bbox[1] >= segment_min_bbox[1]
                         and set(segment["coordinates"]) <= patch_set
                     ):
                         # Note: If patch is a closed way, segment may wrap start/end of patch
@@ -1052,7 +1442,7 @@ def split_polygons():
                                 and node1 == len(patch) - 2
                                 and node2 == 0
                             ):
-                                segment["coordinates"].reverse()
+                                reverse_geometry(segment)
                                 segment["extras"]["reversert"] = "yes"
 
                         elif feature["object"] != "Havflate":
@@ -1129,6 +1519,17 @@ def find_islands():
 
     # Loop all inner objects of multipolygon lakes and sea
 
+    water_objects = [
+        "Innsjø",
+        "InnsjøRegulert",
+        "ElvBekk",
+        "Havflate",
+        "FerskvannTørrfall",
+    ]
+    batch_patch_geometry(
+        [feature for feature in features if feature["object"] in water_objects]
+    )
+
     for feature in features:
         if feature["object"] in [
             "Innsjø",
@@ -1150,7 +1551,7 @@ def find_islands():
 
                 # Determine island type based on area
 
-                area = polygon_area(feature["coordinates"][i])
+                area = patch_area(feature, i)
 
                 if abs(area) > island_size:
                     island_type = "island"
@@ -1351,27 +1752,24 @@ def match_nodes():
             nodes.add(feature["coordinates"][-1])
 
     if not no_node:
-        # Create bbox for segments and line features + create temporary list of LineString features
+        # Create bbox for segments (normally already cached)
 
         for segment in segments:
-            [segment["min_bbox"], segment["max_bbox"]] = get_bbox(
-                segment["coordinates"], 0
-            )
+            element_bbox(segment)
 
         # Loop streams to identify intersections with segments
 
         for feature in features:
             if feature["type"] == "LineString" and feature["object"] == "ElvBekk":
-                [feature["min_bbox"], feature["max_bbox"]] = get_bbox(
-                    feature["coordinates"], 0
-                )
+                [feature_min_bbox, feature_max_bbox] = element_bbox(feature)
 
                 for segment in segments:
+                    [segment_min_bbox, segment_max_bbox] = segment["geometry"]["bbox"]
                     if (segment["used"] > 0 or debug) and (
-                        feature["min_bbox"][0] <= segment["max_bbox"][0]
-                        and feature["max_bbox"][0] >= segment["min_bbox"][0]
-                        and feature["min_bbox"][1] <= segment["max_bbox"][1]
-                        and feature["max_bbox"][1] >= segment["min_bbox"][1]
+                        feature_min_bbox[0] <= segment_max_bbox[0]
+                        and feature_max_bbox[0] >= segment_min_bbox[0]
+                        and feature_min_bbox[1] <= segment_max_bbox[1]
+                        and feature_max_bbox[1] >= segment_min_bbox[1]
                     ):
                         intersections = set(feature["coordinates"]).intersection(
                             set(segment["coordinates"])
@@ -1396,6 +1794,10 @@ def match_nodes():
                                     not in intersections
                                 ):
                                     feature["coordinates"].pop(index1)
+                                    update_geometry(feature)
+                                    [feature_min_bbox, feature_max_bbox] = element_bbox(
+                                        feature
+                                    )
                                 else:
                                     lon, lat = node
                                     offset = 10 ** (
@@ -1405,6 +1807,10 @@ def match_nodes():
                                         lon + 4 * offset,
                                         lat + 2 * offset,
                                     )
+                                    update_geometry(feature)
+                                    [feature_min_bbox, feature_max_bbox] = element_bbox(
+                                        feature
+                                    )
                                     # Note: New node used in next test here
 
                                 # Then check if segment node may also be removed
@@ -1417,6 +1823,7 @@ def match_nodes():
                                         not in intersections
                                     ):
                                         segment["coordinates"].pop(index2)
+                                        update_geometry(segment)
 
                             # Else create new common node with "water" segments (or reuse existing common node)
 
@@ -1437,6 +1844,7 @@ def match_nodes():
                 segment["coordinates"][0],
                 segment["coordinates"][-1],
             ]
+            update_geometry(segment)
 
     message(
         "\t%i common nodes, %i nodes removed from streams and auxiliary lines\n"
@@ -1468,12 +1876,10 @@ def get_elevation_old(node):
     if node in elevations:
         return elevations[node]
 
-    request = urllib.request.Request(url, headers=header)
-
     max_retry = 5
     for retry in range(1, max_retry + 1):
         try:
-            file = urllib.request.urlopen(request)
+            file = http_client.request(url)
             if retry > 1:
                 message("\n")
             break
@@ -1539,8 +1945,7 @@ def get_elevation(node):
     if node in elevations:
         return elevations[node]
 
-    request = urllib.request.Request(url, headers=header)
-    file = urllib.request.urlopen(request)
+    file = http_client.request(url)
 
     result = json.load(file)
     file.close()
@@ -1550,6 +1955,9 @@ def get_elevation(node):
     elevations[node] = ele  # Store for possible identical request later
     ele_count += 1
 
+    if time.time() - checkpoint_time > checkpoint_interval:
+        save_checkpoint()  # Keep elevations loaded so far in current stage
+
     if ele is None:
         message(" *** NO ELEVATION: %s \n" % str(result))
     # 		ele = 0.0
@@ -1557,113 +1965,301 @@ def get_elevation(node):
     return ele
 
 
+# Get deadline for elevation api calls in current stage, or None if no time budget.
+# The remaining time budget is shared between current and later stages according to
+# number of api calls needed.
+
+
+def elevation_deadline(stage_calls, later_calls):
+    if ele_budget is None:
+        return None
+
+    remaining = max(ele_budget - ele_time, 0)
+    if stage_calls + later_calls > 0:
+        remaining = remaining * stage_calls / (stage_calls + later_calls)
+
+    return time.time() + remaining
+
+
+# Add fixme tag, keeping any existing fixme text
+
+
+def add_fixme(tags, text):
+    if "fixme" in tags:
+        tags["fixme"] += "; " + text
+    else:
+        tags["fixme"] = text
+
+
 # Turn streams which have uphill direction
+# With time budget, longest streams are checked first
 
 
 def fix_stream_direction():
-    global elevations, ele_count, retry_count
+    global ele_time
 
-    elevations = {}  # Already fetched elevations from api
-    ele_count = 0  # Numbr of api calls during program execution
-    retry_count = 0  # Number of retry to api
     max_error = 1.0  # Meters of elevation difference
 
     lap = time.time()
 
     message("Load elevation data from Kartverket and reverse streams...\n")
 
-    stream_count = 0
-    for feature in features:
+    streams = []
+    for feature in features[:]:  # Copy, features may be changed by other stages
         if feature["object"] == "ElvBekk" and feature["type"] == "LineString":
-            stream_count += 1
+            streams.append(feature)
 
+    stream_count = len(streams)
     message("\t%i streams\n" % stream_count)
 
+    # Prioritize streams and estimate number of lake elevations needed later
+
+    if ele_budget is not None:
+        streams.sort(
+            key=lambda feature: line_length(feature["coordinates"]), reverse=True
+        )
+
+    lake_calls = 0
+    if lake_ele and not no_name:
+        for feature in features[:]:
+            if (
+                feature["object"] in ["Innsjø", "InnsjøRegulert"]
+                and "ele" not in feature["tags"]
+            ):
+                lake_calls += 1
+
+    deadline = elevation_deadline(2 * stream_count, lake_calls)
+
     api_count = stream_count
     reverse_count = 0
+    check_count = 0
 
     # Loop all streams and check elevation difference between first and last nodes
 
-    for feature in features:
-        if feature["object"] == "ElvBekk" and feature["type"] == "LineString":
-            api_count -= 1
+    for feature in streams:
+        api_count -= 1
 
-            message("\r\t%i " % api_count)
+        if deadline is not None and time.time() > deadline:
+            add_fixme(feature["tags"], "Please check direction (elevation not loaded)")
+            continue
 
-            ele_start = get_elevation(feature["coordinates"][0])
-            if ele_start is None:
-                continue
+        message("\r\t%i " % api_count)
+        check_count += 1
 
-            ele_end = get_elevation(feature["coordinates"][-1])
-            if ele_end is None:
-                continue
+        ele_start = get_elevation(feature["coordinates"][0])
+        if ele_start is None:
+            continue
 
-            # Reverse direction of stream if within error margin
+        ele_end = get_elevation(feature["coordinates"][-1])
+        if ele_end is None:
+            continue
 
-            if ele_end - ele_start >= max_error:
-                feature["coordinates"].reverse()
-                reverse_count += 1
-                feature["extras"]["reversert"] = "%.2f" % (ele_end - ele_start)
-            else:
-                feature["extras"]["bekk"] = "%.2f" % (ele_end - ele_start)
+        # Reverse direction of stream if within error margin
+
+        if ele_end - ele_start >= max_error:
+            reverse_geometry(feature)
+            reverse_count += 1
+            feature["extras"]["reversert"] = "%.2f" % (ele_end - ele_start)
+        else:
+            feature["extras"]["bekk"] = "%.2f" % (ele_end - ele_start)
 
-            if abs(ele_end - ele_start) < 2 * max_error:
-                feature["tags"][
-                    "fixme"
-                ] = "Please check direction (%.1fm elevation)" % (ele_end - ele_start)
+        if abs(ele_end - ele_start) < 2 * max_error:
+            feature["tags"]["fixme"] = "Please check direction (%.1fm elevation)" % (
+                ele_end - ele_start
+            )
 
     if retry_count > 0:
         message("\t%i retry to api\n" % retry_count)
 
     duration = time.time() - lap
+    ele_time += duration
     message(
         "\r\t%i streams, %i reversed, %i api calls\n"
         % (stream_count, reverse_count, ele_count)
     )
+    if ele_budget is not None:
+        message(
+            "\t%i of %i streams checked within time budget (%i%%)\n"
+            % (check_count, stream_count, 100 * check_count / max(stream_count, 1))
+        )
     message(
         "\tRun time %s, %.2f streams per second\n"
         % (timeformat(duration), stream_count / duration)
     )
 
 
-# Load place names from SSR within given bbox
+# Get grid cell number of SSR place name index for a longitude or latitude
 
 
-def get_ssr_name(feature, name_categories):
-    global ssr_places, name_count
+def ssr_cell(degrees):
+    return int(math.floor(degrees / ssr_grid_size))
 
-    if feature["type"] == "Point":
-        bbox = get_bbox(
-            feature["coordinates"], 500
-        )  # 500 meters perimeter to each side
-    else:
-        bbox = get_bbox(feature["coordinates"], 0)
 
-    if type(feature["coordinates"][0]) is tuple:
-        polygon = feature["coordinates"]
+# Parse SSR place names from file, keeping only name tags, ssr:stedsnr and ssr:type.
+# Streaming parser, so that only one node is kept in memory at a time.
+
+
+def parse_ssr_places(file):
+    places = []
+
+    context = ET.iterparse(file, events=("start", "end"))
+    event, root = next(context)
+
+    for event, node in context:
+        if event != "end" or node.tag != "node":
+            continue
+
+        entry = {
+            "coordinate": (float(node.get("lon")), float(node.get("lat"))),
+            "tags": {},
+        }
+        for tag in node.iter("tag"):
+            if "name" in tag.get("k") or tag.get("k") in ["ssr:stedsnr", "ssr:type"]:
+                if tag.get("k") == "fixme":
+                    if "multiple name" in tag.get("v"):
+                        entry["tags"]["fixme"] = (
+                            "Multiple name tags, please choose one and add the other to"
+                            " alt_name"
+                        )
+                else:
+                    entry["tags"][tag.get("k")] = tag.get("v")
+
+        places.append(entry)
+        node.clear()
+        root.clear()
+
+    return places
+
+
+# Load SSR place names for municipality.
+# The parsed place names are cached in a pickled sidecar file together with ETag and
+# Last-Modified of the SSR file, and used as long as the SSR file is unchanged on the
+# server and the program version is the same. The SSR file itself is not cached.
+
+
+def load_ssr_places():
+    url = "https://obtitus.github.io/ssr2_to_osm_data/data/%s/%s.osm" % (
+        municipality_id,
+        municipality_id,
+    )
+    sidecar_filename = cache_filename("ssr_%s.pickle" % municipality_id)
+
+    sidecar = load_pickle(sidecar_filename)
+    if sidecar and sidecar.get("version") != version:
+        sidecar = None
+
+    headers = {}
+    if sidecar:
+        if sidecar["etag"]:
+            headers["If-None-Match"] = sidecar["etag"]
+        if sidecar["modified"]:
+            headers["If-Modified-Since"] = sidecar["modified"]
+
+    try:
+        file = http_client.request(url, headers, stream=True)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:  # Not modified
+            message("\tSSR file unchanged, using cache\n")
+            return sidecar["places"]
+        else:
+            raise
+    except urllib.error.URLError as e:
+        if sidecar:
+            message("\t*** SSR file not available, using cache: %s\n" % e.reason)
+            return sidecar["places"]
+        else:
+            raise
+
+    places = parse_ssr_places(file)
+    file.close()
+
+    sidecar = {
+        "version": version,
+        "etag": file.headers["ETag"],
+        "modified": file.headers["Last-Modified"],
+        "places": places,
+    }
+    save_pickle(sidecar_filename, sidecar)
+
+    return places
+
+
+# Build index of SSR place names per SSR type and grid cell.
+# Also split multiple languages + variants of names.
+
+
+def build_ssr_index():
+    global ssr_index
+
+    ssr_index = {}
+
+    for i, place in enumerate(ssr_places):
+        if "name" in place["tags"] and "ssr:type" in place["tags"]:
+            place["names"] = place["tags"]["name"].replace(" - ", ";").split(";")
+            cell = (ssr_cell(place["coordinate"][0]), ssr_cell(place["coordinate"][1]))
+            ssr_type = place["tags"]["ssr:type"]
+            if ssr_type not in ssr_index:
+                ssr_index[ssr_type] = {}
+            if cell not in ssr_index[ssr_type]:
+                ssr_index[ssr_type][cell] = []
+            ssr_index[ssr_type][cell].append(i)
+
+
+# Load place names from SSR within given bbox
+# Optionally with prepared polygon of the feature's outer patch
+
+
+def get_ssr_name(feature, name_categories, prepared=None):
+    global ssr_places, name_count
+
+    if feature["type"] == "Point":
+        bbox = get_bbox(
+            feature["coordinates"], 500
+        )  # 500 meters perimeter to each side
+    else:
+        bbox = element_bbox(feature)
+
+    if type(feature["coordinates"][0]) is tuple:
+        polygon = feature["coordinates"]
     else:
         polygon = feature["coordinates"][0]
 
     found_names = []
     names = []
 
-    # Find name in stored file
+    # Find candidates in grid cells within bbox for each name category.
+    # Candidates are sorted to keep order of stored file.
 
-    for place in ssr_places:
-        if (
-            bbox[0][0] <= place["coordinate"][0] <= bbox[1][0]
-            and bbox[0][1] <= place["coordinate"][1] <= bbox[1][1]
-            and place["tags"]["ssr:type"] in name_categories
-            and place["tags"]["name"] not in names
-            and (
-                feature["type"] == "Point"
-                or inside_polygon(place["coordinate"], polygon)
-            )
-        ):
+    candidates = []
+    for x in range(ssr_cell(bbox[0][0]), ssr_cell(bbox[1][0]) + 1):
+        for y in range(ssr_cell(bbox[0][1]), ssr_cell(bbox[1][1]) + 1):
+            for category in name_categories:
+                if category in ssr_index and (x, y) in ssr_index[category]:
+                    candidates.extend(ssr_index[category][(x, y)])
+    candidates.sort()
+
+    # Find name in stored file.
+    # Places within bbox are tested against the polygon in one batch.
+
+    places = [
+        ssr_places[i]
+        for i in candidates
+        if bbox[0][0] <= ssr_places[i]["coordinate"][0] <= bbox[1][0]
+        and bbox[0][1] <= ssr_places[i]["coordinate"][1] <= bbox[1][1]
+    ]
+
+    if feature["type"] != "Point" and places:
+        if prepared is None:
+            prepared = prepare_polygon(polygon)
+        inside = inside_prepared_points(
+            [place["coordinate"] for place in places], prepared
+        )
+        places = [place for place, place_inside in zip(places, inside) if place_inside]
+
+    for place in places:
+        if place["tags"]["name"] not in names:
             found_names.append(place)
-            names.extend(
-                place["tags"]["name"].replace(" - ", ";").split(";")
-            )  # Split multiple languages + variants
+            names.extend(place["names"])
 
     # Sort and select name
 
@@ -1689,7 +2285,7 @@ def get_ssr_name(feature, name_categories):
         if "name" in feature["tags"] and feature["tags"]["name"] in names:
             name = feature["tags"]["name"]
             for place in found_names:
-                if name in place["tags"]["name"].replace(" - ", ";").split(";"):
+                if name in place["names"]:
                     feature["tags"].update(place["tags"])
                     feature["tags"]["name"] = name  # Add back NVE name
                     feature["extras"]["ssr:type"] = feature["tags"].pop(
@@ -1716,8 +2312,7 @@ def get_ssr_name(feature, name_categories):
         ):
             if "name" in feature["tags"] and (
                 len(alt_names) > 1
-                or feature["tags"]["name"]
-                not in found_names[0]["tags"]["name"].replace(" - ", ";").split(";")
+                or feature["tags"]["name"] not in found_names[0]["names"]
             ):
                 alt_names.insert(0, "%s [NVE]" % feature["tags"]["name"])
 
@@ -1751,49 +2346,18 @@ def get_category_place_names(n50_categories, ssr_categories):
 
 def get_place_names():
     global ssr_places, name_count
-    global elevations, ele_count, retry_count
+    global ele_time
 
     message("Load place names from SSR...\n")
 
-    elevations = {}
-    ele_count = 0
-    retry_count = 0
-
     lap = time.time()
     name_count = 0
-    ssr_places = []
 
     # Load all SSR place names in municipality
 
-    url = "https://obtitus.github.io/ssr2_to_osm_data/data/%s/%s.osm" % (
-        municipality_id,
-        municipality_id,
-    )
-    request = urllib.request.Request(url, headers=header)
-    file = urllib.request.urlopen(request)
-
-    tree = ET.parse(file)
-    file.close()
-    root = tree.getroot()
-
-    for node in root.iter("node"):
-        entry = {
-            "coordinate": (float(node.get("lon")), float(node.get("lat"))),
-            "tags": {},
-        }
-        for tag in node.iter("tag"):
-            if "name" in tag.get("k") or tag.get("k") in ["ssr:stedsnr", "ssr:type"]:
-                if tag.get("k") == "fixme":
-                    if "multiple name" in tag.get("v"):
-                        entry["tags"]["fixme"] = (
-                            "Multiple name tags, please choose one and add the other to"
-                            " alt_name"
-                        )
-                else:
-                    entry["tags"][tag.get("k")] = tag.get("v")
-
-        ssr_places.append(entry)
+    ssr_places = prefetched("ssr_places", load_ssr_places)
 
+    build_ssr_index()
     message("\t%s place names in SSR file\n" % len(ssr_places))
 
     # Get island names
@@ -1833,11 +2397,23 @@ def get_place_names():
         "pytt",
     ]
     lake_ele_count = 0
+    ele_lakes = []  # Lakes which need elevation
+
+    batch_patch_geometry(
+        [
+            feature
+            for feature in features
+            if feature["object"] in ["Innsjø", "InnsjøRegulert"]
+        ]
+    )
 
     for feature in features:
         if feature["object"] in ["Innsjø", "InnsjøRegulert"]:
-            lake_node = get_ssr_name(feature, name_category)
-            area = abs(multipolygon_area(feature["coordinates"]))
+            prepared = prepare_multipolygon(feature["coordinates"])
+            lake_node = get_ssr_name(
+                feature, name_category, prepared[0] if prepared else None
+            )
+            area = abs(feature_area(feature))
             feature["extras"]["areal"] = str(int(area))
 
             # Get lake's elevation if missing, and if lake is larger than threshold
@@ -1847,37 +2423,62 @@ def get_place_names():
                 and "ele" not in feature["tags"]
                 and (lake_node or area >= lake_ele_size)
             ):
-                # Check that name coordinate is not on lake's island
-                if lake_node:
-                    if not inside_multipolygon(lake_node, feature["coordinates"]):
-                        lake_node = None
-                    else:
-                        feature["extras"]["elevation"] = "Based on lake name position"
-
-                # If name coordinate cannot be used, try centroid
-                if lake_node is None:
-                    lake_node = polygon_centroid(feature["coordinates"][0])
-                    feature["extras"]["elevation"] = "Based on centroid"
-                    if not inside_multipolygon(lake_node, feature["coordinates"]):
-                        lake_node = None
-
-                # If all fail, just use coordinate of first node on lake perimeter
-                if lake_node is None:
-                    lake_node = feature["coordinates"][0][0]
-                    feature["extras"]["elevation"] = "Based on first node"
-
-                if lake_node:
-                    ele = get_elevation(lake_node)
-                    if ele:
-                        feature["tags"]["ele"] = str(int(round(ele)))
-                        create_point(lake_node, "", "elevation %.1f" % ele)
-                        lake_ele_count += 1
-                        message("\r\t%i " % lake_ele_count)
+                ele_lakes.append((feature, lake_node, area, prepared))
+
+    # With time budget, lakes with names are loaded first, then largest lakes
+
+    if ele_budget is not None:
+        ele_lakes.sort(key=lambda lake: (lake[1] is None, -lake[2]))
+
+    lap_ele = time.time()
+    deadline = elevation_deadline(len(ele_lakes), 0)
+    check_count = 0
+
+    for feature, lake_node, area, prepared in ele_lakes:
+        if deadline is not None and time.time() > deadline:
+            add_fixme(feature["tags"], "Please add elevation (not loaded)")
+            continue
+
+        check_count += 1
+
+        # Test name coordinate and centroid against lake in one batch
+        centroid = patch_centroid(feature, 0)
+        points = [point for point in [lake_node, centroid] if point]
+        inside = inside_prepared_multipolygon(points, prepared)
+
+        # Check that name coordinate is not on lake's island
+        if lake_node:
+            if not inside[0]:
+                lake_node = None
+            else:
+                feature["extras"]["elevation"] = "Based on lake name position"
+
+        # If name coordinate cannot be used, try centroid
+        if lake_node is None:
+            lake_node = centroid
+            feature["extras"]["elevation"] = "Based on centroid"
+            if not centroid or not inside[-1]:
+                lake_node = None
+
+        # If all fail, just use coordinate of first node on lake perimeter
+        if lake_node is None:
+            lake_node = feature["coordinates"][0][0]
+            feature["extras"]["elevation"] = "Based on first node"
+
+        if lake_node:
+            ele = get_elevation(lake_node)
+            if ele:
+                feature["tags"]["ele"] = str(int(round(ele)))
+                create_point(lake_node, "", "elevation %.1f" % ele)
+                lake_ele_count += 1
+                message("\r\t%i " % lake_ele_count)
+
+    ele_time += time.time() - lap_ele
 
     # Create lake centroid nodes for debugging
     for feature in features:
         if feature["object"] in ["Innsjø", "InnsjøRegulert"]:
-            centroid = polygon_centroid(feature["coordinates"][0])
+            centroid = patch_centroid(feature, 0)
             create_point(centroid, feature["gml_id"], "centroid")
 
     # Get glacier names
@@ -1901,58 +2502,164 @@ def get_place_names():
     message("\r\t%i place names found\n" % name_count)
     if lake_ele:
         message("\t%i lake elevations found\n" % lake_ele_count)
+        if ele_budget is not None:
+            message(
+                "\t%i of %i lakes checked within time budget (%i%%)\n"
+                % (
+                    check_count,
+                    len(ele_lakes),
+                    100 * check_count / max(len(ele_lakes), 1),
+                )
+            )
     message("\tRun time %s\n" % (timeformat(time.time() - lap)))
 
 
-# Get name from NVE Innsjødatabasen
-# API reference: https://gis3.nve.no/map/rest/services/Innsjodatabase2/MapServer
+# Get url for query of lakes in municipality in NVE Innsjødatabasen
+# Pages are ordered by lake id to give stable paging.
 
 
-def get_nve_lakes():
-    message("Load lake data from NVE...\n")
+def nve_url(parameters):
+    # 	Alternative url:
+    # 	url = "https://gis3.nve.no/map/rest/services/Innsjodatabase2/MapServer/find?" + \
+    # 			"searchText=%s&contains=true&searchFields=kommNr&layers=5&returnGeometry=false&returnUnformattedValues=true&f=pjson&resultOffset=%i&resultRecordCount=1000&orderByFields=areal_km2%20DESC" \
+    # 			% (municipality_id, nve_lake_count)
+
+    # 	url = "https://gis3.nve.no/map/rest/services/Innsjodatabase2/MapServer/5/query?" + \
+    # 			"where=kommNr%%3D%%27%s%%27&outFields=vatnLnr%%2Cnavn%%2Choyde%%2Careal_km2%%2CmagasinNr&returnGeometry=false&resultOffset=%i&resultRecordCount=1000&f=json" \
+    # 				% (municipality_id, nve_lake_count)
+
+    return (
+        "https://nve.geodataonline.no/arcgis/rest/services/Innsjodatabase2/MapServer/5/query?"
+        + "where=kommNr%%3D%%27%s%%27&returnGeometry=false&f=json&" % municipality_id
+        + parameters
+    )
+
+
+# Load one page of lakes from NVE
+
+
+def load_nve_page(offset):
+    url = nve_url(
+        "outFields=vatnLnr%%2Cnavn%%2Choyde%%2Careal_km2%%2CmagasinNr"
+        "&orderByFields=vatnLnr&resultOffset=%i&resultRecordCount=%i"
+        % (offset, nve_page_size)
+    )
+    file = http_client.request(url)
+    lake_data = json.load(file)
+    file.close()
+    return lake_data
+
+
+# Add lakes from NVE query result or snapshot to lakes dict.
+# Lakes in other municipalities are skipped if the municipality is included.
+
+
+def parse_nve_lakes(lake_data, lakes):
+    for lake_result in lake_data["features"]:
+        lake = lake_result["attributes"]
+        if "kommNr" in lake and str(lake["kommNr"]) != municipality_id:
+            continue
+        entry = {
+            "name": lake["navn"],
+            "ele": lake["hoyde"],
+            "area": lake["areal_km2"],
+            "mag_id": lake["magasinNr"],
+        }
+        lakes[str(lake["vatnLnr"])] = entry
+
+
+# Load all lakes in municipality from NVE.
+# The number of lakes is queried first, then all pages are loaded concurrently.
+
+
+def fetch_nve_lakes():
+    file = http_client.request(nve_url("returnCountOnly=true"))
+    lake_count = json.load(file)["count"]
+    file.close()
+
+    offsets = list(range(0, lake_count, nve_page_size))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nve_threads) as executor:
+        pages = list(executor.map(load_nve_page, offsets))
 
-    n50_lake_count = 0
-    nve_lake_count = 0
-    more_lakes = True
     lakes = {}
+    for lake_data in pages:
+        parse_nve_lakes(lake_data, lakes)
 
-    # Paging results (default 1000 lakes)
+    # Lakes added after the count query
 
-    while more_lakes:
-        # 		Alternative url:
-        # 		url = "https://gis3.nve.no/map/rest/services/Innsjodatabase2/MapServer/find?" + \
-        # 				"searchText=%s&contains=true&searchFields=kommNr&layers=5&returnGeometry=false&returnUnformattedValues=true&f=pjson&resultOffset=%i&resultRecordCount=1000&orderByFields=areal_km2%20DESC" \
-        # 				% (municipality_id, nve_lake_count)
+    offset = len(offsets) * nve_page_size
+    while pages and "exceededTransferLimit" in pages[-1]:
+        pages = [load_nve_page(offset)]
+        parse_nve_lakes(pages[0], lakes)
+        offset += nve_page_size
 
-        # 		url = "https://gis3.nve.no/map/rest/services/Innsjodatabase2/MapServer/5/query?" + \
-        # 				"where=kommNr%%3D%%27%s%%27&outFields=vatnLnr%%2Cnavn%%2Choyde%%2Careal_km2%%2CmagasinNr&returnGeometry=false&resultOffset=%i&resultRecordCount=1000&f=json" \
-        # 					% (municipality_id, nve_lake_count)
+    return lakes
 
-        url = (
-            "https://nve.geodataonline.no/arcgis/rest/services/Innsjodatabase2/MapServer/5/query?"
-            + "where=kommNr%%3D%%27%s%%27&outFields=vatnLnr%%2Cnavn%%2Choyde%%2Careal_km2%%2CmagasinNr&returnGeometry=false&resultOffset=%i&resultRecordCount=1000&f=json"
-            % (municipality_id, nve_lake_count)
-        )
 
-        request = urllib.request.Request(url, headers=header)
-        file = urllib.request.urlopen(request)
-        lake_data = json.load(file)
-        file.close()
+# Load NVE lakes from snapshot file.
+# The file contains the json result of a query, or a list of such results (pages).
 
-        for lake_result in lake_data["features"]:
-            lake = lake_result["attributes"]
-            entry = {
-                "name": lake["navn"],
-                "ele": lake["hoyde"],
-                "area": lake["areal_km2"],
-                "mag_id": lake["magasinNr"],
-            }
-            lakes[str(lake["vatnLnr"])] = entry
 
-        nve_lake_count += len(lake_data["features"])
+def load_nve_snapshot(filename):
+    file = osmfile.open_file(filename, encoding="utf-8")
+    snapshot = json.load(file)
+    file.close()
+
+    if isinstance(snapshot, dict):
+        snapshot = [snapshot]
+
+    lakes = {}
+    for lake_data in snapshot:
+        parse_nve_lakes(lake_data, lakes)
+
+    return lakes
+
 
-        if "exceededTransferLimit" not in lake_data:
-            more_lakes = False
+# Load lakes in municipality from NVE Innsjødatabasen.
+# The lakes are cached per municipality and refreshed when older than nve_lakes_age
+# days or when -refresh is given. A local snapshot file may be given with -nve.
+
+
+def load_nve_lakes():
+    nve_filename = cache_filename("nve_%s.pickle" % municipality_id)
+    cache = load_pickle(nve_filename)
+
+    if nve_snapshot:
+        lakes = load_nve_snapshot(nve_snapshot)
+        message("\tLoaded from snapshot file '%s'\n" % nve_snapshot)
+
+    elif (
+        cache
+        and not refresh_cache
+        and time.time() - cache["time"] < nve_lakes_age * 24 * 3600
+    ):
+        lakes = cache["lakes"]
+        message("\tUsing cached NVE lakes\n")
+
+    else:
+        try:
+            lakes = fetch_nve_lakes()
+            save_pickle(nve_filename, {"time": time.time(), "lakes": lakes})
+        except urllib.error.URLError as e:
+            if cache:
+                message("\t*** NVE not available, using cache: %s\n" % e.reason)
+                lakes = cache["lakes"]
+            else:
+                raise
+
+    return lakes
+
+
+# Get name from NVE Innsjødatabasen
+# API reference: https://gis3.nve.no/map/rest/services/Innsjodatabase2/MapServer
+
+
+def get_nve_lakes():
+    message("Load lake data from NVE...\n")
+
+    n50_lake_count = 0
+    lakes = prefetched("nve_lakes", load_nve_lakes)
+    nve_lake_count = len(lakes)
 
     # Update lake info
 
@@ -1981,120 +2688,596 @@ def get_nve_lakes():
     )
 
 
-# Save geojson file for reviewing raw input data from GML file
+# Get properties of feature for geojson and GeoPackage files
+
+
+def feature_properties(feature):
+    properties = dict(feature["extras"])
+    properties.update(feature["tags"])
+    properties["gml_id"] = feature.get("gml_id", None)
+    return properties
+
 
+# Save feature to geojson file (and GeoPackage file) for reviewing raw input data
+# from GML file
 
-def save_geojson(filename):
+
+def save_raw_feature(feature, layer):
+    properties = feature_properties(feature)
+
+    geojson_file.write_feature(feature["type"], feature["coordinates"], properties)
+    if geopackage_file:
+        geopackage_file.write_feature(
+            layer, feature["type"], feature["coordinates"], properties
+        )
+
+
+# Save GeoPackage file with features, segments and islands for reviewing output in
+# GIS tools. Segments are included if they are used in the OSM file.
+
+
+def save_geopackage(filename):
     message("Save to '%s' file...\n" % filename)
 
-    json_features = {"type": "FeatureCollection", "features": []}
+    gpkg_file = geopackage.GeopackageWriter(filename)
 
-    for feature_list in [features, segments]:
-        for feature in feature_list:
-            entry = {
-                "type": "Feature",
-                "geometry": {
-                    "type": feature["type"],
-                    "coordinates": feature["coordinates"],
-                },
-                "properties": dict(
-                    feature["extras"].items()
-                    + feature["tags"].items()
-                    + {"gml_id": gml_id}.items()
-                ),
+    for feature in features:
+        properties = feature_properties(feature)
+        gpkg_file.write_feature(
+            "features", feature["type"], feature["coordinates"], properties
+        )
+
+        if feature["type"] == "Polygon" and "place" in feature["tags"]:
+            patches = feature["coordinates"]
+            if patches and isinstance(patches[0], tuple):
+                patches = [patches]  # Single patch
+            gpkg_file.write_feature("islands", "Polygon", patches, properties)
+
+    for segment in segments:
+        if segment["used"] > 0 or debug:
+            properties = feature_properties(segment)
+            gpkg_file.write_feature(
+                "segments", segment["type"], segment["coordinates"], properties
+            )
+
+            if (
+                "place" in segment["tags"]
+                and segment["coordinates"][0] == segment["coordinates"][-1]
+            ):
+                gpkg_file.write_feature(
+                    "islands", "Polygon", [segment["coordinates"]], properties
+                )
+
+    gpkg_file.close()
+
+    message(
+        "\t%i features saved to %i layers\n" % (gpkg_file.count, len(gpkg_file.layers))
+    )
+
+
+# Options which must be unchanged for a checkpoint to be resumed
+
+
+def checkpoint_options():
+    return {
+        "municipality": municipality_id,
+        "category": data_category,
+        "debug": debug,
+        "tag": n50_tags,
+        "stream": turn_stream,
+        "ele": lake_ele,
+        "noname": no_name,
+        "nonve": no_nve,
+        "nonode": no_node,
+        "nve": nve_snapshot,
+        "budget": ele_budget,
+    }
+
+
+# Save pipeline state to checkpoint file after completed stages.
+# Without stages, only elevations loaded so far are updated, together with the state
+# of the last completed stages. May be called from several stages at the same time.
+# The file is only saved with the -resume option.
+
+
+def save_checkpoint(stages=None):
+    global checkpoint_state, checkpoint_time
+
+    with checkpoint_lock:
+        if stages:
+            completed_stages.extend(stages)
+        if not resume:
+            return
+
+        if stages:
+            state = {
+                "features": features,
+                "segments": segments,
+                "nodes": nodes,
+                "object_count": object_count,
+                "ele_time": ele_time,
             }
+            checkpoint_state = pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+        checkpoint = {
+            "version": version,
+            "options": checkpoint_options(),
+            "stages": completed_stages,
+            "state": checkpoint_state,
+            "elevations": dict(elevations),  # Copy, other stages may add elevations
+        }
+
+        file = gzip.open(checkpoint_filename + ".tmp", "wb", compresslevel=1)
+        pickle.dump(checkpoint, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.close()
+        os.replace(checkpoint_filename + ".tmp", checkpoint_filename)
 
-            json_features["features"].append(entry)
+        checkpoint_time = time.time()
 
-    file = open(filename, "w")
-    json.dump(json_features, file, indent=2)
+
+# Load pipeline state from checkpoint file, to resume after last completed stage
+
+
+def load_checkpoint():
+    global features, segments, nodes, object_count, ele_time
+    global completed_stages, checkpoint_state
+
+    if not os.path.isfile(checkpoint_filename):
+        message("No checkpoint file '%s' to resume\n" % checkpoint_filename)
+        return
+
+    file = gzip.open(checkpoint_filename, "rb")
+    checkpoint = pickle.load(file)
     file.close()
 
-    message("\t%i features saved\n" % len(features))
+    if (
+        checkpoint["version"] != version
+        or checkpoint["options"] != checkpoint_options()
+    ):
+        message("*** Checkpoint from other version or options, not resumed\n")
+        return
 
+    elevations.update(checkpoint["elevations"])
+    completed_stages = checkpoint["stages"]
+    checkpoint_state = checkpoint["state"]
 
-# Indent XML output
+    if completed_stages:
+        state = pickle.loads(checkpoint_state)
+        features = state["features"]
+        segments = state["segments"]
+        nodes = state["nodes"]
+        object_count = state["object_count"]
+        ele_time = state["ele_time"]
 
+    message(
+        "Resume after stage '%s' (%i elevations loaded)\n"
+        % (completed_stages[-1] if completed_stages else "-", len(elevations))
+    )
 
-def indent_tree(elem, level=0):
-    i = "\n" + level * "  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent_tree(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
 
+# Run fetch function in background thread.
+# Returns result or exception, together with messages from the function.
 
-# Save osm file
 
+def prefetch_worker(function):
+    thread_id = threading.get_ident()
+    deferred_messages[thread_id] = []
+    try:
+        return (function(), None, deferred_messages[thread_id])
+    except Exception as e:
+        return (None, e, deferred_messages[thread_id])
+    finally:
+        del deferred_messages[thread_id]
+
+
+# Start background fetches of data which do not depend on the N50 data, so that
+# they overlap with loading and decomposing the N50 data.
+# Data for stages already completed (resume) is not fetched.
+
+
+def start_prefetch():
+    fetches = []
+    if data_category == "BygningerOgAnlegg" and "load_n50_data" not in completed_stages:
+        fetches.append(("building_types", fetch_building_types))
+    if data_category == "Arealdekke" and not json_output:
+        if not no_nve and "get_nve_lakes" not in completed_stages:
+            fetches.append(("nve_lakes", load_nve_lakes))
+        if not no_name and "get_place_names" not in completed_stages:
+            fetches.append(("ssr_places", load_ssr_places))
+
+    if fetches:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(fetches))
+        for name, function in fetches:
+            prefetch_jobs[name] = executor.submit(prefetch_worker, function)
+        executor.shutdown(wait=False)
+
+
+# Get result of background fetch, waiting for it if needed.
+# The function is called directly if the data was not prefetched.
+
+
+def prefetched(name, function):
+    if name not in prefetch_jobs:
+        return function()
+
+    result, error, output = prefetch_jobs.pop(name).result()
+    for text in output:
+        message(text)
+    if error:
+        raise error
+
+    return result
+
+
+# Run function of stage in its own thread.
+# Messages are kept if output is deferred, and returned together with any exception.
+
+
+def stage_worker(name, function, deferred, results):
+    thread_id = threading.get_ident()
+    if deferred:
+        deferred_messages[thread_id] = []
+
+    error = None
+    try:
+        function()
+    except BaseException as e:
+        error = e
+
+    results.put((name, error, deferred_messages.pop(thread_id, None)))
+
+
+# Run stages of the pipeline. Each stage is (name, function, inputs, outputs).
+# A stage is started as soon as all its inputs have been produced by other stages,
+# so that independent stages overlap. Inputs which are not produced by any stage
+# are ignored (optional stages not in the pipeline).
+# Only one stage at a time outputs messages directly. Messages from other stages are
+# output when they have completed and the direct stage has completed.
+# The checkpoint is only saved when no stage is running, to get a consistent state.
+
+
+def run_stages(stages):
+    producers = {}
+    for name, function, inputs, outputs in stages:
+        for output in outputs:
+            producers[output] = name
+
+    done = set(completed_stages)
+    pending = [stage for stage in stages if stage[0] not in done]
+    running = set()
+    finished = []  # Completed stages not yet saved to checkpoint
+    deferred_output = []  # Messages from completed stages waiting for output
+    live_stage = None  # Stage with direct output of messages
+    stage_times = {}
+    results = queue.Queue()
+
+    while pending or running:
+        # Start all stages with available inputs
+
+        for stage in pending[:]:
+            name, function, inputs, outputs = stage
+            if all(data not in producers or producers[data] in done for data in inputs):
+                pending.remove(stage)
+                running.add(name)
+                deferred = live_stage is not None
+                if not deferred:
+                    live_stage = name
+                stage_times[name] = [time.time(), None]
+                thread = threading.Thread(
+                    target=stage_worker,
+                    args=(name, function, deferred, results),
+                    daemon=True,
+                )
+                thread.start()
+
+        if not running:
+            sys.exit(
+                "*** Missing input for stages: %s\n" % [stage[0] for stage in pending]
+            )
+
+        # Wait for next stage to complete
+
+        name, error, output = results.get()
+        running.remove(name)
+        stage_times[name][1] = time.time()
+
+        if output:
+            deferred_output.append(output)
+        if name == live_stage:
+            live_stage = None
+        if live_stage is None or error:
+            for output in deferred_output:
+                message("".join(output))
+            deferred_output = []
+
+        if error:
+            raise error
+
+        done.add(name)
+        finished.append(name)
+
+        # Save state when no other stage is running. Also save N50 cache after
+        # decomposition of polygons.
+
+        if not running:
+            save_checkpoint(finished)
+            if "split_polygons" in finished and use_cache:
+                save_n50_cache()
+            finished = []
+
+    message_critical_path(stages, stage_times, producers)
+
+
+# Output critical path of stages, i.e. the chain of stages which determined total
+# run time. Starting with the last stage, the input stage which completed last is
+# followed backwards.
+
+
+def message_critical_path(stages, stage_times, producers):
+    if not stage_times:
+        return
+
+    stage_inputs = {}
+    for name, function, inputs, outputs in stages:
+        stage_inputs[name] = inputs
+
+    path = []
+    name = max(stage_times, key=lambda stage: stage_times[stage][1])
+    while name:
+        path.insert(0, name)
+        previous = [
+            producers[data]
+            for data in stage_inputs[name]
+            if data in producers and producers[data] in stage_times
+        ]
+        if previous:
+            name = max(previous, key=lambda stage: stage_times[stage][1])
+        else:
+            name = None
+
+    message(
+        "Critical path: %s\n"
+        % " > ".join(
+            "%s %s" % (stage, timeformat(stage_times[stage][1] - stage_times[stage][0]))
+            for stage in path
+        )
+    )
+
+    stage_time = sum(end - start for start, end in stage_times.values())
+    elapsed = max(end for start, end in stage_times.values()) - min(
+        start for start, end in stage_times.values()
+    )
+    message(
+        "\tStages run time %s, elapsed %s\n"
+        % (timeformat(stage_time), timeformat(elapsed))
+    )
+
+
+# Get identity of N50 zip file at Kartverket, or None if not available.
+# Together with program version and options used during parsing it is used as the key
+# for the N50 cache.
+
+
+def n50_cache_key():
+    url = n50_url(n50_filename(municipality_id, municipality_name))
+    try:
+        file = http_client.request(url, method="HEAD")
+    except urllib.error.URLError:
+        return None
+    file.close()
+
+    if not (file.headers["ETag"] or file.headers["Last-Modified"]):
+        return None
+
+    return {
+        "url": url,
+        "etag": file.headers["ETag"],
+        "modified": file.headers["Last-Modified"],
+        "length": file.headers["Content-Length"],
+        "version": version,
+        "category": data_category,
+        "debug": debug,
+        "tag": n50_tags,
+    }
+
+
+# Get full filename of file in cache folder, creating the folder if needed
+
+
+def cache_filename(filename):
+    folder = os.path.expanduser(cache_folder)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, filename)
+
+
+# Load pickled data from file, or None if file is missing or not readable
+
+
+def load_pickle(filename):
+    if not os.path.isfile(filename):
+        return None
+
+    file = open(filename, "rb")
+    try:
+        data = pickle.load(file)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        data = None
+    file.close()
+
+    return data
+
+
+# Save pickled data to file, replacing any existing file in one step
+
+
+def save_pickle(filename, data):
+    file = open(filename + ".tmp", "wb")
+    pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+    file.close()
+    os.replace(filename + ".tmp", filename)
+
+
+# Get filename of N50 cache for municipality and category
 
-def save_osm(filename):
-    message("Save to '%s' file...\n" % filename)
+
+def n50_cache_filename():
+    return cache_filename("n50_%s_%s.cache" % (municipality_id, data_category))
+
+
+# Load parsed and decomposed N50 data from cache, if N50 file and options are unchanged.
+# Stages up to split_polygons are marked as completed.
+
+
+def load_n50_cache():
+    global features, segments, object_count
+
+    cache_key = n50_cache_key()
+    filename = n50_cache_filename()
+
+    if cache_key is None or not os.path.isfile(filename):
+        return
+
+    file = open(filename, "rb")
+    if file.readline() != cache_format or pickle.load(file) != cache_key:
+        file.close()
+        return
+
+    lap = time.time()
+    state = pickle.load(file)
+    file.close()
+
+    features = state["features"]
+    segments = state["segments"]
+    object_count = state["object_count"]
+
+    message("Load parsed N50 data from cache...\n")
+    message("\t%i feature objects, %i segments\n" % (len(features), len(segments)))
+    message("\tRun time %s\n" % (timeformat(time.time() - lap)))
+
+    completed_stages.append("load_n50_data")
+    save_checkpoint(["split_polygons"])
+
+
+# Save parsed and decomposed N50 data to cache
+
+
+def save_n50_cache():
+    cache_key = n50_cache_key()
+    if cache_key is None:
+        return
+
+    filename = n50_cache_filename()
+
+    state = {
+        "features": features,
+        "segments": segments,
+        "object_count": object_count,
+    }
+
+    file = open(filename + ".tmp", "wb")
+    file.write(cache_format)
+    pickle.dump(cache_key, file, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    file.close()
+    os.replace(filename + ".tmp", filename)
+
+
+# Get tags of element as list of (key, value), including debug tags
+
+
+def element_tags(element):
+    tags = list(element["tags"].items())
+    if debug:
+        tags += [(key.upper(), value) for key, value in element["extras"].items()]
+    return tags
+
+
+# Check if polygon may be output as the way of its single segment, to avoid relation
+
+
+def single_segment_polygon(feature):
+    return (
+        len(feature["members"]) == 1
+        and len(feature["members"][0]) == 1
+        and not (
+            "natural" in feature["tags"]
+            and "natural" in segments[feature["members"][0][0]]["tags"]
+        )
+    )
+
+
+# Save osm file, or several files (such as OSM file and element store) in one pass.
+# Elements are streamed to the file: Ways are written before their new nodes, and
+# polygons with only one segment get their tags on the way of the segment.
+
+
+def save_osm(filenames):
+    message("Save to '%s' file...\n" % "', '".join(filenames))
 
     osm_node_ids = {}  # Will contain osm_id of each common node
     relation_count = 0
     way_count = 0
     node_count = 0
 
-    osm_root = ET.Element(
-        "osm", version="0.6", generator="n50osm v" + version, upload="false"
+    osm_file = osmfile.open_writers(
+        filenames,
+        {"version": "0.6", "generator": "n50osm v" + version, "upload": "false"},
+        indent=indent_output,
+        processes=output_processes,
     )
     osm_id = -1000
 
+    # Polygons which will be output as the way of their single segment
+
+    segment_polygons = {}
+    for feature in features:
+        if (
+            feature["object"] != "Havflate"
+            and feature["type"] == "Polygon"
+            and single_segment_polygon(feature)
+        ):
+            segment_polygons.setdefault(feature["members"][0][0], []).append(feature)
+
     # Common nodes
 
     for node in nodes:
         osm_id -= 1
-        osm_node = ET.Element(
-            "node", id=str(osm_id), action="modify", lat=str(node[1]), lon=str(node[0])
+        osm_file.write_node(
+            {"id": osm_id, "action": "modify", "lat": node[1], "lon": node[0]}
         )
-        osm_root.append(osm_node)
         osm_node_ids[node] = osm_id
         node_count += 1
 
     # Ways used by relations
 
-    for segment in segments:
+    for i, segment in enumerate(segments):
         if segment["used"] > 0 or debug:  # or segment['object'] == "Kystkontur":
             osm_id -= 1
-            osm_feature = ET.Element("way", id=str(osm_id), action="modify")
-            osm_root.append(osm_feature)
+            way_id = osm_id
             segment["osm_id"] = osm_id
-            segment["etree"] = osm_feature
             way_count += 1
 
+            refs = []
+            new_nodes = []
             for node in segment["coordinates"]:
                 if node in nodes:
-                    osm_nd = ET.Element("nd", ref=str(osm_node_ids[node]))
+                    refs.append(osm_node_ids[node])
                 else:
                     osm_id -= 1
-                    osm_node = ET.Element(
-                        "node",
-                        id=str(osm_id),
-                        action="modify",
-                        lat=str(node[1]),
-                        lon=str(node[0]),
-                    )
-                    osm_root.append(osm_node)
-                    osm_nd = ET.Element("nd", ref=str(osm_id))
-                    node_count += 1
-                osm_feature.append(osm_nd)
+                    refs.append(osm_id)
+                    new_nodes.append((osm_id, node))
 
-            for key, value in iter(segment["tags"].items()):
-                osm_tag = ET.Element("tag", k=key, v=value)
-                osm_feature.append(osm_tag)
+            tags = element_tags(segment)
+            for feature in segment_polygons.get(i, []):
+                tags += element_tags(feature)
 
-            if debug:
-                for key, value in iter(segment["extras"].items()):
-                    osm_tag = ET.Element("tag", k=key.upper(), v=value)
-                    osm_feature.append(osm_tag)
+            osm_file.write_way({"id": way_id, "action": "modify"}, refs, tags)
+
+            for node_id, node in new_nodes:
+                osm_file.write_node(
+                    {"id": node_id, "action": "modify", "lat": node[1], "lon": node[0]}
+                )
+                node_count += 1
 
     # The main objects
 
@@ -2104,88 +3287,66 @@ def save_osm(filename):
 
         if feature["type"] == "Point":
             osm_id -= 1
-            osm_feature = ET.Element(
-                "node",
-                id=str(osm_id),
-                action="modify",
-                lat=str(feature["coordinates"][1]),
-                lon=str(feature["coordinates"][0]),
+            osm_file.write_node(
+                {
+                    "id": osm_id,
+                    "action": "modify",
+                    "lat": feature["coordinates"][1],
+                    "lon": feature["coordinates"][0],
+                },
+                element_tags(feature),
             )
-            osm_root.append(osm_feature)
             node_count += 1
 
         elif feature["type"] in "LineString":
             osm_id -= 1
-            osm_feature = ET.Element("way", id=str(osm_id), action="modify")
-            osm_root.append(osm_feature)
+            way_id = osm_id
             way_count += 1
 
+            refs = []
+            new_nodes = []
             for node in feature["coordinates"]:
                 if node in nodes:
-                    osm_nd = ET.Element("nd", ref=str(osm_node_ids[node]))
+                    refs.append(osm_node_ids[node])
                 else:
                     osm_id -= 1
-                    osm_node = ET.Element(
-                        "node",
-                        id=str(osm_id),
-                        action="modify",
-                        lat=str(node[1]),
-                        lon=str(node[0]),
-                    )
-                    osm_root.append(osm_node)
-                    osm_nd = ET.Element("nd", ref=str(osm_id))
-                    node_count += 1
-                osm_feature.append(osm_nd)
+                    refs.append(osm_id)
+                    new_nodes.append((osm_id, node))
 
-        elif feature["type"] == "Polygon":
-            # Output way if possible to avoid relation
-            if (
-                len(feature["members"]) == 1
-                and len(feature["members"][0]) == 1
-                and not (
-                    "natural" in feature["tags"]
-                    and "natural" in segments[feature["members"][0][0]]["tags"]
+            osm_file.write_way(
+                {"id": way_id, "action": "modify"}, refs, element_tags(feature)
+            )
+
+            for node_id, node in new_nodes:
+                osm_file.write_node(
+                    {"id": node_id, "action": "modify", "lat": node[1], "lon": node[0]}
                 )
-            ):
-                osm_feature = segments[feature["members"][0][0]]["etree"]
+                node_count += 1
 
-            else:
-                osm_id -= 1
-                osm_feature = ET.Element("relation", id=str(osm_id), action="modify")
-                osm_root.append(osm_feature)
-                relation_count += 1
-                role = "outer"
-
-                for patch in feature["members"]:
-                    for member in patch:
-                        osm_member = ET.Element(
-                            "member",
-                            type="way",
-                            ref=str(segments[member]["osm_id"]),
-                            role=role,
-                        )
-                        osm_feature.append(osm_member)
-                    role = "inner"
+        elif feature["type"] == "Polygon":
+            if single_segment_polygon(feature):
+                continue  # Already output with tags on way of segment
 
-                osm_tag = ET.Element("tag", k="type", v="multipolygon")
-                osm_feature.append(osm_tag)
+            osm_id -= 1
+            relation_count += 1
+            members = []
+            role = "outer"
 
-        else:
-            message("\t*** UNKNOWN GEOMETRY: %s\n" % feature["type"])
+            for patch in feature["members"]:
+                for member in patch:
+                    members.append(("way", segments[member]["osm_id"], role))
+                role = "inner"
 
-        for key, value in iter(feature["tags"].items()):
-            osm_tag = ET.Element("tag", k=key, v=value)
-            osm_feature.append(osm_tag)
+            osm_file.write_relation(
+                {"id": osm_id, "action": "modify"},
+                members,
+                [("type", "multipolygon")] + element_tags(feature),
+            )
 
-        if debug:
-            for key, value in iter(feature["extras"].items()):
-                osm_tag = ET.Element("tag", k=key.upper(), v=value)
-                osm_feature.append(osm_tag)
+        else:
+            message("\t*** UNKNOWN GEOMETRY: %s\n" % feature["type"])
 
-    osm_root.set("upload", "false")
-    indent_tree(osm_root)
-    osm_tree = ET.ElementTree(osm_root)
-    osm_tree.write(filename, encoding="utf-8", method="xml", xml_declaration=True)
+    osm_file.close()
 
     message(
         "\t%i relations, %i ways, %i nodes saved\n"
@@ -2197,6 +3358,7 @@ def save_osm(filename):
 
 if __name__ == "__main__":
     start_time = time.time()
+    deferred_messages = {}  # Messages from background fetches and stages, per thread
     message("\n-- n50osm v%s --\n" % version)
 
     features = []  # All geometry and tags
@@ -2205,16 +3367,39 @@ if __name__ == "__main__":
         set()
     )  # Common nodes at intersections, including start/end nodes of segments [lon,lat]
     building_tags = {}  # Conversion table from building type to osm tag
+    prefetch_jobs = {}  # Background fetches of data for later stages
+    checkpoint_lock = threading.Lock()  # Checkpoint saved from several stages
     object_count = {}  # Count loaded object types
 
     debug = False  # Include debug tags and unused segments
     n50_tags = False  # Include property tags from N50 in output
     json_output = False  # Output complete and unprocessed geometry in geojson format
+    json_sequence = False  # Output geojson as newline delimited sequence (GeoJSONSeq)
+    geojson_file = None  # Geojson file written while loading N50 data
+    gpkg_output = False  # Also output GeoPackage file
+    store_output = False  # Also output SQLite element store for n50merge
+    geopackage_file = None  # GeoPackage file written while loading N50 data
     turn_stream = False  # Load elevation data to check direction of streams
     lake_ele = False  # Load elevation for lakes
     no_name = False  # Do not load SSR place names
     no_nve = False  # Do not load NVE lake data
     no_node = False  # Do not merge common nodes at intersections
+    indent_output = True  # Indent OSM output file
+    pbf_output = False  # Output OSM file in PBF format
+    output_processes = min(os.cpu_count() or 1, 8)  # Processes formatting OSM XML
+    compression = ""  # Extension of compressed output files (.gz, .bz2 or .xz)
+    ele_budget = None  # Time budget in seconds for elevation api (streams and lakes)
+    ele_time = 0.0  # Time used by elevation api so far
+    elevations = {}  # Already fetched elevations from api
+    ele_count = 0  # Numbr of api calls during program execution
+    retry_count = 0  # Number of retry to api
+    resume = False  # Save checkpoints and resume from last completed stage
+    use_cache = True  # Use cache of parsed and decomposed N50 data
+    refresh_cache = False  # Refresh cached data from GitHub, GeoNorge and NVE
+    nve_snapshot = None  # Local file with NVE lakes instead of api
+    completed_stages = []  # Stages saved to checkpoint
+    checkpoint_state = None  # Pickled state of last completed stage
+    checkpoint_time = time.time()  # Time of last checkpoint
 
     # Parse parameters
 
@@ -2222,15 +3407,30 @@ if __name__ == "__main__":
         message("Please provide 1) municipality, and 2) data category parameter.\n")
         message("Data categories: %s\n" % ", ".join(data_categories))
         message(
-            "Options: -debug, -tag, -geojson, -stream, -ele, -noname, -nonve,"
-            " -nonode\n\n"
+            "Options: -debug, -tag, -geojson, -geojsonseq, -stream, -ele,"
+            " -budget <minutes>, -noname, -nonve, -nve <file>, -nonode, -noindent,"
+            " -processes <number>, -pbf, -compress <gz|bz2|xz>, -gpkg, -sqlite,"
+            " -resume, -nocache, -refresh, -record <folder>, -replay <folder>,"
+            " -latency <seconds>\n\n"
         )
         sys.exit()
 
+    # Record or replay responses from servers
+
+    http_client.fixture_options(sys.argv)
+    cache_folder = http_client.fixture_cache_folder(cache_folder)
+    if http_client.fixture_mode:
+        message(
+            "Fixtures:\t%s '%s'\n"
+            % (http_client.fixture_mode.capitalize(), http_client.fixture_folder)
+        )
+
     # Get municipality
 
     municipality_query = sys.argv[1]
-    [municipality_id, municipality_name] = get_municipality_name(municipality_query)
+    [municipality_id, municipality_name] = municipality.get_municipality_name(
+        municipality_query, cache_folder, "-refresh" in sys.argv
+    )
     if municipality_id is None:
         sys.exit("Municipality '%s' not found\n" % municipality_query)
     else:
@@ -2255,6 +3455,13 @@ if __name__ == "__main__":
         n50_tags = True
     if "-geojson" in sys.argv or "-json" in sys.argv:
         json_output = True
+    if "-geojsonseq" in sys.argv:
+        json_output = True
+        json_sequence = True
+    if "-gpkg" in sys.argv:
+        gpkg_output = True
+    if "-sqlite" in sys.argv:
+        store_output = True
     if "-stream" in sys.argv or "-bekk" in sys.argv:
         turn_stream = True
     if "-ele" in sys.argv or "-høyde" in sys.argv:
@@ -2265,6 +3472,49 @@ if __name__ == "__main__":
         no_nve = True
     if "-nonode" in sys.argv:
         no_node = True
+    if "-noindent" in sys.argv:
+        indent_output = False
+    if "-pbf" in sys.argv:
+        pbf_output = True
+    if "-compress" in sys.argv:
+        index = sys.argv.index("-compress")
+        if (
+            index + 1 < len(sys.argv)
+            and "." + sys.argv[index + 1] in osmfile.compressors
+        ):
+            compression = "." + sys.argv[index + 1]
+        else:
+            sys.exit("Please provide gz, bz2 or xz for -compress option\n")
+    if "-processes" in sys.argv:
+        index = sys.argv.index("-processes")
+        if (
+            index + 1 < len(sys.argv)
+            and sys.argv[index + 1].isdigit()
+            and int(sys.argv[index + 1]) > 0
+        ):
+            output_processes = int(sys.argv[index + 1])
+        else:
+            sys.exit("Please provide number of processes for -processes option\n")
+    if "-resume" in sys.argv:
+        resume = True
+    if "-nocache" in sys.argv:
+        use_cache = False
+    if "-refresh" in sys.argv:
+        refresh_cache = True
+    if "-budget" in sys.argv:
+        index = sys.argv.index("-budget")
+        if index + 1 < len(sys.argv) and sys.argv[index + 1].replace(".", "").isdigit():
+            ele_budget = float(sys.argv[index + 1]) * 60
+            message("Elevation budget:\t%s\n" % timeformat(ele_budget))
+        else:
+            sys.exit("Please provide number of minutes for -budget option\n")
+    if "-nve" in sys.argv:
+        index = sys.argv.index("-nve")
+        if index + 1 < len(sys.argv) and os.path.isfile(sys.argv[index + 1]):
+            nve_snapshot = sys.argv[index + 1]
+            message("NVE snapshot:\t%s\n" % nve_snapshot)
+        else:
+            sys.exit("Please provide NVE snapshot file for -nve option\n")
 
     if not turn_stream or not lake_ele:
         message("*** Remember -stream and -ele options before importing.\n")
@@ -2274,30 +3524,102 @@ if __name__ == "__main__":
         municipality_name.replace(" ", "_"),
         data_category,
     )
+    checkpoint_filename = output_filename + ".checkpoint"
 
     # Process data
 
-    if data_category == "BygningerOgAnlegg":
-        load_building_types()
+    if json_output:
+        if json_sequence:
+            json_filename = output_filename + ".geojsonl" + compression
+        else:
+            json_filename = output_filename + ".geojson" + compression
+        message("Save to '%s' file while loading\n" % json_filename)
 
-    load_n50_data(municipality_id, municipality_name, data_category)
+        geojson_file = osmfile.GeojsonWriter(json_filename, sequence=json_sequence)
+        if gpkg_output:
+            message("Save to '%s' file while loading\n" % (output_filename + ".gpkg"))
+            geopackage_file = geopackage.GeopackageWriter(output_filename + ".gpkg")
+
+        start_prefetch()
+        load_n50_data(municipality_id, municipality_name, data_category)
+
+        geojson_file.close()
+        if geopackage_file:
+            geopackage_file.close()
 
-    if json_output:
-        save_geojson(output_filename + ".geojson")
     else:
-        split_polygons()
+        # Stages of the pipeline, with data produced by earlier stages as inputs.
+        # Stages with available inputs run at the same time, for example elevations
+        # for streams during get_nve_lakes, find_islands and get_place_names.
+
+        stages = [
+            (
+                "load_n50_data",
+                lambda: load_n50_data(
+                    municipality_id, municipality_name, data_category
+                ),
+                [],
+                ["n50"],
+            ),
+            ("split_polygons", split_polygons, ["n50"], ["polygons"]),
+        ]
         if data_category == "Arealdekke":
             if turn_stream:
-                fix_stream_direction()  # Note: Slow api
+                # Note: Slow api
+                stages.append(
+                    (
+                        "fix_stream_direction",
+                        fix_stream_direction,
+                        ["polygons"],
+                        ["streams"],
+                    )
+                )
             if not no_nve:
-                get_nve_lakes()
-            find_islands()  # Note: "Havflate" is removed at the end of this process
+                stages.append(("get_nve_lakes", get_nve_lakes, ["polygons"], ["nve"]))
+            # Note: "Havflate" is removed from features at the end of this process,
+            # so it waits for get_nve_lakes, which loops features
+            stages.append(
+                ("find_islands", find_islands, ["polygons", "nve"], ["islands"])
+            )
             if not no_name:
-                get_place_names()
-        match_nodes()
-        save_osm(output_filename + ".osm")
+                # Lake elevations are loaded after streams, so that only one stage
+                # at a time uses the elevation api, ele_count and ele_time
+                inputs = ["islands", "nve"]
+                if lake_ele:
+                    inputs.append("streams")
+                stages.append(("get_place_names", get_place_names, inputs, ["names"]))
+        stages.append(
+            (
+                "match_nodes",
+                match_nodes,
+                ["polygons", "streams", "nve", "islands", "names"],
+                ["nodes"],
+            )
+        )
+
+        if resume:
+            load_checkpoint()
+        start_prefetch()
+        if not completed_stages and use_cache:
+            load_n50_cache()
+
+        run_stages(stages)
+
+        if pbf_output:
+            osm_filenames = [output_filename + ".osm.pbf"]  # Already compressed
+        else:
+            osm_filenames = [output_filename + ".osm" + compression]
+        if store_output:
+            osm_filenames.append(output_filename + ".osm.db")
+        save_osm(osm_filenames)
+        if gpkg_output:
+            save_geopackage(output_filename + ".gpkg")
+        if os.path.isfile(checkpoint_filename):
+            os.remove(checkpoint_filename)
 
     duration = time.time() - start_time
+    for line in http_client.get_statistics():
+        message("\t%s\n" % line)
     message(
         "\tTotal run time %s (%i features per second)\n\n"
         % (timeformat(duration), int(len(features) / duration))
@@ -0,0 +1,861 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Streaming writer of OSM files, used by n50osm.py and n50merge.py.
+# Elements are written directly to the file in the order given, so that the complete
+# OSM tree is never built in memory. The output is identical to ElementTree output of
+# the same elements, with or without indentation as produced by indent_tree().
+# The OSM PBF format is also supported, with a minimal protobuf encoder.
+# XML elements may be formatted in chunks by a pool of processes, with the same output.
+# Files with extension .gz, .bz2 or .xz are compressed while writing.
+# Elements may also be saved to an indexed SQLite element store (extension .db),
+# which n50merge.py may query instead of parsing an OSM file. Several files may be
+# written in one pass.
+# Also a streaming writer of GeoJSON files.
+
+
+import zlib
+import struct
+import calendar
+import time
+import tempfile
+import shutil
+import gzip
+import bz2
+import lzma
+import json
+import sqlite3
+import os
+import collections
+import concurrent.futures
+import multiprocessing
+
+
+compressors = {".gz": gzip, ".bz2": bz2, ".xz": lzma}  # Compression per extension
+
+chunk_size = 5000  # Elements per chunk when XML is formatted by several processes
+
+start_method = "forkserver"  # Processes are not forked from the running threads
+if start_method not in multiprocessing.get_all_start_methods():
+    start_method = "spawn"
+
+
+# Open file for reading or writing, compressed according to extension of filename.
+# Text mode is default, as for open().
+
+
+def open_file(filename, mode="r", encoding=None, errors=None):
+    for extension, compressor in compressors.items():
+        if filename.endswith(extension):
+            if "b" not in mode:
+                mode += "t"
+            return compressor.open(filename, mode, encoding=encoding, errors=errors)
+
+    return open(filename, mode, encoding=encoding, errors=errors)
+
+
+# Get filename without extension for compression, and the extension ("" if none)
+
+
+def split_compression(filename):
+    for extension in compressors:
+        if filename.endswith(extension):
+            return (filename[: -len(extension)], extension)
+    return (filename, "")
+
+
+# Escape attribute value as ElementTree does
+
+
+def escape_attribute(text):
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    if '"' in text:
+        text = text.replace('"', "&quot;")
+    if "\r" in text:
+        text = text.replace("\r", "&#13;")
+    if "\n" in text:
+        text = text.replace("\n", "&#10;")
+    if "\t" in text:
+        text = text.replace("\t", "&#09;")
+    return text
+
+
+# Get start of XML element with attributes, without closing bracket
+
+
+def start_tag(name, attributes):
+    return "<%s%s" % (
+        name,
+        "".join(
+            ' %s="%s"' % (key, escape_attribute(str(value)))
+            for key, value in attributes.items()
+        ),
+    )
+
+
+# Format one element with children (start tags without closing bracket)
+
+
+def format_element(name, attributes, children, indent):
+    output = []
+    if indent:
+        output.append("\n  ")
+    output.append(start_tag(name, attributes))
+
+    if children:
+        output.append(">")
+        for child in children:
+            if indent:
+                output.append("\n    ")
+            output.append(child)
+            output.append(" />")
+        if indent:
+            output.append("\n  ")
+        output.append("</%s>" % name)
+    else:
+        output.append(" />")
+
+    return "".join(output)
+
+
+# Format list of elements given as (name, attributes, refs or members, tags).
+# Used directly and by worker processes, which return the encoded chunk.
+
+
+def format_elements(elements, indent):
+    output = []
+    for name, attributes, members, tags in elements:
+        if name == "way":
+            children = [start_tag("nd", {"ref": ref}) for ref in members]
+        elif name == "relation":
+            children = [
+                start_tag("member", {"type": member_type, "ref": ref, "role": role})
+                for member_type, ref, role in members
+            ]
+        else:
+            children = []
+        children += [start_tag("tag", {"k": key, "v": value}) for key, value in tags]
+
+        output.append(format_element(name, attributes, children, indent))
+
+    return "".join(output)
+
+
+def format_chunk(elements, indent):
+    return format_elements(elements, indent).encode("utf-8", "xmlcharrefreplace")
+
+
+# Streaming writer of OSM XML file.
+# Attributes are dicts, tags are lists of (key, value) and members are lists of
+# (type, ref, role).
+# With more than one process, elements are collected in chunks which are formatted
+# by a process pool and written in the original order. Ids and all other content
+# are given by the caller, so the output is identical.
+
+
+class XmlWriter:
+    def __init__(self, filename, root_attributes, indent=True, processes=1):
+        self.file = open_file(
+            filename, "w", encoding="utf-8", errors="xmlcharrefreplace"
+        )
+        self.indent = indent
+        self.root = start_tag("osm", root_attributes)
+        self.count = 0
+
+        self.processes = processes
+        self.pending = []  # Elements not yet formatted
+        self.chunks = collections.deque()  # Chunks being formatted, in output order
+        self.executor = None  # Process pool, started for the first full chunk
+
+        self.file.write("<?xml version='1.0' encoding='utf-8'?>\n")
+
+    # Write one element, or collect it for formatting by process pool
+
+    def write_element(self, element):
+        if self.count == 0:
+            self.file.write(self.root + ">")
+        self.count += 1
+
+        if self.processes > 1:
+            self.pending.append(element)
+            if len(self.pending) >= chunk_size:
+                self.submit_chunk()
+        else:
+            self.file.write(format_elements([element], self.indent))
+
+    # Start formatting of collected elements, and write chunks which are done.
+    # At most two chunks per process are kept waiting, to limit memory.
+
+    def submit_chunk(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context(start_method)
+            )
+
+        self.chunks.append(
+            self.executor.submit(format_chunk, self.pending, self.indent)
+        )
+        self.pending = []
+
+        while self.chunks and (
+            len(self.chunks) > 2 * self.processes or self.chunks[0].done()
+        ):
+            self.write_chunk(self.chunks.popleft().result())
+
+    def write_chunk(self, data):
+        self.file.flush()
+        self.file.buffer.write(data)
+
+    def write_node(self, attributes, tags=[]):
+        self.write_element(("node", attributes, [], tags))
+
+    def write_way(self, attributes, refs, tags=[]):
+        self.write_element(("way", attributes, refs, tags))
+
+    def write_relation(self, attributes, members, tags=[]):
+        self.write_element(("relation", attributes, members, tags))
+
+    def close(self):
+        while self.chunks:
+            self.write_chunk(self.chunks.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.pending:
+            self.file.write(format_elements(self.pending, self.indent))
+
+        if self.count == 0:
+            self.file.write(self.root + " />")
+        elif self.indent:
+            self.file.write("\n</osm>\n")
+        else:
+            self.file.write("</osm>")
+        self.file.close()
+
+
+# Protobuf encoding of unsigned or negative integer as varint
+
+
+def varint(value):
+    value &= 0xFFFFFFFFFFFFFFFF  # Negative numbers as 64 bit two's complement
+    output = bytearray()
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+    return bytes(output)
+
+
+# Protobuf encoding of signed integer (sint32/sint64)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+# Protobuf field with integer value
+
+
+def pb_int(number, value):
+    return varint(number << 3) + varint(value)
+
+
+# Protobuf field with bytes, string or embedded message
+
+
+def pb_bytes(number, data):
+    return varint(number << 3 | 2) + varint(len(data)) + data
+
+
+# Protobuf packed field of integers. Signed values are zigzag encoded, and optionally
+# delta coded.
+
+
+def pb_packed(number, values, signed=False, delta=False):
+    if not values:
+        return b""
+    if delta:
+        values = [value - previous for value, previous in zip(values, [0] + values)]
+    if signed:
+        values = [zigzag(value) for value in values]
+    return pb_bytes(number, b"".join(varint(value) for value in values))
+
+
+# Get seconds since epoch from OSM timestamp
+
+
+def osm_timestamp(text):
+    return calendar.timegm(time.strptime(text, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+# Get metadata of element from attributes as (version, timestamp, changeset, uid,
+# user), or None if the element has no metadata (new element)
+
+
+def element_info(attributes):
+    if "version" not in attributes:
+        return None
+    return (
+        int(attributes["version"]),
+        osm_timestamp(attributes["timestamp"]) if "timestamp" in attributes else 0,
+        int(attributes.get("changeset", 0)),
+        int(attributes.get("uid", 0)),
+        attributes.get("user", ""),
+    )
+
+
+# Streaming writer of OSM PBF file, with dense nodes and zlib compressed blocks.
+# Nodes are written first, while ways and relations are kept in temporary files
+# until the file is closed, so that the output has nodes, ways and relations in
+# that order. The action attribute is not supported by the PBF format.
+
+
+class PbfWriter:
+    block_size = 8000  # Elements per block
+
+    def __init__(self, filename, root_attributes, indent=True):
+        self.file = open_file(filename, "wb")
+        self.way_file = tempfile.TemporaryFile()
+        self.relation_file = tempfile.TemporaryFile()
+        self.nodes = []
+        self.ways = []
+        self.relations = []
+        self.count = 0
+
+        header = pb_bytes(4, b"OsmSchema-V0.6") + pb_bytes(4, b"DenseNodes")
+        if "generator" in root_attributes:
+            header += pb_bytes(16, root_attributes["generator"].encode("utf-8"))
+        self.write_blob(self.file, "OSMHeader", header)
+
+    # Write blob with header to file
+
+    def write_blob(self, file, blob_type, data):
+        blob = pb_int(2, len(data)) + pb_bytes(3, zlib.compress(data))
+        header = pb_bytes(1, blob_type.encode("utf-8")) + pb_int(3, len(blob))
+        file.write(struct.pack(">I", len(header)))
+        file.write(header)
+        file.write(blob)
+
+    # Write primitive block with one group of elements, including string table
+
+    def write_block(self, file, group, strings):
+        string_table = b"".join(pb_bytes(1, text.encode("utf-8")) for text in strings)
+        block = pb_bytes(1, string_table) + pb_bytes(2, group)
+        self.write_blob(file, "OSMData", block)
+
+    # Get index of string in string table of block (index 0 is reserved)
+
+    def string_index(self, string_ids, strings, text):
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text)
+        return string_ids[text]
+
+    # Encode Info message of way or relation
+
+    def info_message(self, info, string_ids, strings):
+        if info is None:
+            return b""
+        version, timestamp, changeset, uid, user = info
+        return pb_bytes(
+            4,
+            pb_int(1, version)
+            + pb_int(2, timestamp)
+            + pb_int(3, changeset)
+            + pb_int(4, uid)
+            + pb_int(5, self.string_index(string_ids, strings, user)),
+        )
+
+    def write_nodes(self):
+        if not self.nodes:
+            return
+
+        strings = [""]
+        string_ids = {"": 0}
+        keys_vals = []
+        for node in self.nodes:
+            for key, value in node[3]:
+                keys_vals.append(self.string_index(string_ids, strings, key))
+                keys_vals.append(self.string_index(string_ids, strings, value))
+            keys_vals.append(0)
+        if not any(node[3] for node in self.nodes):
+            keys_vals = []
+
+        dense = pb_packed(1, [node[0] for node in self.nodes], signed=True, delta=True)
+
+        if any(node[4] for node in self.nodes):
+            infos = [node[4] or (0, 0, 0, 0, "") for node in self.nodes]
+            dense += pb_bytes(
+                5,
+                pb_packed(1, [info[0] for info in infos])
+                + pb_packed(2, [info[1] for info in infos], signed=True, delta=True)
+                + pb_packed(3, [info[2] for info in infos], signed=True, delta=True)
+                + pb_packed(4, [info[3] for info in infos], signed=True, delta=True)
+                + pb_packed(
+                    5,
+                    [self.string_index(string_ids, strings, info[4]) for info in infos],
+                    signed=True,
+                    delta=True,
+                ),
+            )
+
+        dense += pb_packed(8, [node[1] for node in self.nodes], signed=True, delta=True)
+        dense += pb_packed(9, [node[2] for node in self.nodes], signed=True, delta=True)
+        dense += pb_packed(10, keys_vals)
+
+        self.write_block(self.file, pb_bytes(2, dense), strings)
+        self.nodes = []
+
+    def write_ways(self):
+        if not self.ways:
+            return
+
+        strings = [""]
+        string_ids = {"": 0}
+        group = []
+        for way_id, refs, tags, info in self.ways:
+            keys = [self.string_index(string_ids, strings, key) for key, value in tags]
+            values = [
+                self.string_index(string_ids, strings, value) for key, value in tags
+            ]
+            way = (
+                pb_int(1, way_id)
+                + pb_packed(2, keys)
+                + pb_packed(3, values)
+                + self.info_message(info, string_ids, strings)
+                + pb_packed(8, refs, signed=True, delta=True)
+            )
+            group.append(pb_bytes(3, way))
+
+        self.write_block(self.way_file, b"".join(group), strings)
+        self.ways = []
+
+    def write_relations(self):
+        if not self.relations:
+            return
+
+        member_types = {"node": 0, "way": 1, "relation": 2}
+        strings = [""]
+        string_ids = {"": 0}
+        group = []
+        for relation_id, members, tags, info in self.relations:
+            keys = [self.string_index(string_ids, strings, key) for key, value in tags]
+            values = [
+                self.string_index(string_ids, strings, value) for key, value in tags
+            ]
+            relation = (
+                pb_int(1, relation_id)
+                + pb_packed(2, keys)
+                + pb_packed(3, values)
+                + self.info_message(info, string_ids, strings)
+                + pb_packed(
+                    8,
+                    [
+                        self.string_index(string_ids, strings, role)
+                        for member_type, ref, role in members
+                    ],
+                )
+                + pb_packed(
+                    9,
+                    [int(ref) for member_type, ref, role in members],
+                    signed=True,
+                    delta=True,
+                )
+                + pb_packed(
+                    10,
+                    [member_types[member_type] for member_type, ref, role in members],
+                )
+            )
+            group.append(pb_bytes(4, relation))
+
+        self.write_block(self.relation_file, b"".join(group), strings)
+        self.relations = []
+
+    def write_node(self, attributes, tags=[]):
+        self.nodes.append(
+            (
+                int(attributes["id"]),
+                round(float(attributes["lat"]) * 10000000),  # Granularity 100 nanodeg
+                round(float(attributes["lon"]) * 10000000),
+                tags,
+                element_info(attributes),
+            )
+        )
+        self.count += 1
+        if len(self.nodes) >= self.block_size:
+            self.write_nodes()
+
+    def write_way(self, attributes, refs, tags=[]):
+        self.ways.append(
+            (
+                int(attributes["id"]),
+                [int(ref) for ref in refs],
+                tags,
+                element_info(attributes),
+            )
+        )
+        self.count += 1
+        if len(self.ways) >= self.block_size:
+            self.write_ways()
+
+    def write_relation(self, attributes, members, tags=[]):
+        self.relations.append(
+            (int(attributes["id"]), members, tags, element_info(attributes))
+        )
+        self.count += 1
+        if len(self.relations) >= self.block_size:
+            self.write_relations()
+
+    def close(self):
+        self.write_nodes()
+        self.write_ways()
+        self.write_relations()
+
+        for file in [self.way_file, self.relation_file]:
+            file.seek(0)
+            shutil.copyfileobj(file, self.file)
+            file.close()
+
+        self.file.close()
+
+
+# Tables of SQLite element store. The seq column gives the order of elements as
+# written, across all element types. Only id, action and coordinates are kept as
+# attributes, since the store is made for import files (no version etc).
+
+store_tables = [
+    "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE nodes (id INTEGER PRIMARY KEY, seq INTEGER, action TEXT,"
+    " lat REAL, lon REAL)",
+    "CREATE TABLE ways (id INTEGER PRIMARY KEY, seq INTEGER, action TEXT)",
+    "CREATE TABLE way_nodes (way_id INTEGER, sequence INTEGER, node_id INTEGER,"
+    " PRIMARY KEY (way_id, sequence)) WITHOUT ROWID",
+    "CREATE TABLE relations (id INTEGER PRIMARY KEY, seq INTEGER, action TEXT)",
+    "CREATE TABLE members (relation_id INTEGER, sequence INTEGER, type TEXT,"
+    " ref INTEGER, role TEXT, PRIMARY KEY (relation_id, sequence)) WITHOUT ROWID",
+    "CREATE TABLE tags (type TEXT, id INTEGER, sequence INTEGER, key TEXT,"
+    " value TEXT, PRIMARY KEY (type, id, sequence)) WITHOUT ROWID",
+]
+
+# Indexes for queries by node, member and tag, created after all inserts
+
+store_indexes = [
+    "CREATE INDEX way_nodes_node ON way_nodes (node_id)",
+    "CREATE INDEX members_ref ON members (type, ref)",
+    "CREATE INDEX tags_key ON tags (key, value)",
+]
+
+
+# Streaming writer of SQLite element store.
+# Rows are inserted in batches inside one transaction. The file is written to a
+# temporary file, which replaces filename when closed.
+
+
+class StoreWriter:
+    def __init__(self, filename, root_attributes, indent=True, batch_size=10000):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.count = 0
+        if os.path.isfile(filename + ".tmp"):
+            os.remove(filename + ".tmp")
+
+        self.db = sqlite3.connect(filename + ".tmp", isolation_level=None)
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("BEGIN")
+        for table in store_tables:
+            self.db.execute(table)
+        self.db.executemany(
+            "INSERT INTO meta VALUES (?, ?)", list(root_attributes.items())
+        )
+
+        self.rows = {}  # Pending rows per table
+        for table in ["nodes", "ways", "way_nodes", "relations", "members", "tags"]:
+            self.rows[table] = []
+
+    def add_rows(self, table, rows):
+        self.rows[table].extend(rows)
+        if len(self.rows[table]) >= self.batch_size:
+            self.flush(table)
+
+    def flush(self, table):
+        if self.rows[table]:
+            self.db.executemany(
+                "INSERT INTO %s VALUES (%s)"
+                % (table, ", ".join(["?"] * len(self.rows[table][0]))),
+                self.rows[table],
+            )
+            self.rows[table] = []
+
+    def add_tags(self, element_type, element_id, tags):
+        self.add_rows(
+            "tags",
+            [
+                (element_type, element_id, i, key, value)
+                for i, (key, value) in enumerate(tags)
+            ],
+        )
+
+    def write_node(self, attributes, tags=[]):
+        self.count += 1
+        node_id = int(attributes["id"])
+        self.add_rows(
+            "nodes",
+            [
+                (
+                    node_id,
+                    self.count,
+                    attributes.get("action", None),
+                    float(attributes["lat"]),
+                    float(attributes["lon"]),
+                )
+            ],
+        )
+        self.add_tags("node", node_id, tags)
+
+    def write_way(self, attributes, refs, tags=[]):
+        self.count += 1
+        way_id = int(attributes["id"])
+        self.add_rows("ways", [(way_id, self.count, attributes.get("action", None))])
+        self.add_rows(
+            "way_nodes", [(way_id, i, int(ref)) for i, ref in enumerate(refs)]
+        )
+        self.add_tags("way", way_id, tags)
+
+    def write_relation(self, attributes, members, tags=[]):
+        self.count += 1
+        relation_id = int(attributes["id"])
+        self.add_rows(
+            "relations", [(relation_id, self.count, attributes.get("action", None))]
+        )
+        self.add_rows(
+            "members",
+            [
+                (relation_id, i, member_type, int(ref), role)
+                for i, (member_type, ref, role) in enumerate(members)
+            ],
+        )
+        self.add_tags("relation", relation_id, tags)
+
+    def close(self):
+        for table in self.rows:
+            self.flush(table)
+        for index in store_indexes:
+            self.db.execute(index)
+
+        self.db.execute("COMMIT")
+        self.db.close()
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+# Open SQLite element store for reading
+
+
+def open_store(filename):
+    return sqlite3.connect("file:%s?mode=ro" % filename, uri=True)
+
+
+# Get rows of store table grouped by element id, for elements with id in id_table
+# (or all elements). Rows are ordered by sequence within each element.
+
+
+def store_rows(db, query, parameters, id_column, id_table):
+    if id_table:
+        query += " %s %s IN (SELECT id FROM %s)" % (
+            "AND" if "WHERE" in query else "WHERE",
+            id_column,
+            id_table,
+        )
+
+    rows = {}
+    for row in db.execute(query + " ORDER BY %s, sequence" % id_column, parameters):
+        if row[0] not in rows:
+            rows[row[0]] = []
+        rows[row[0]].append(row[1:])
+    return rows
+
+
+# Get elements of one type from element store, ordered as written.
+# Optionally only elements with id in given (temporary) table.
+# Each element is a tuple of (seq, attributes, refs or members, tags), with id's as
+# strings like in OSM files.
+
+
+def store_elements(db, element_type, id_table=None):
+    table = {"node": "nodes", "way": "ways", "relation": "relations"}[element_type]
+    columns = "id, seq, action"
+    if element_type == "node":
+        columns += ", lat, lon"
+    query = "SELECT %s FROM %s" % (columns, table)
+    if id_table:
+        query += " WHERE id IN (SELECT id FROM %s)" % id_table
+
+    tags = store_rows(
+        db,
+        "SELECT id, key, value FROM tags WHERE type = ?",
+        (element_type,),
+        "id",
+        id_table,
+    )
+    if element_type == "way":
+        members = store_rows(
+            db,
+            "SELECT way_id, node_id FROM way_nodes",
+            (),
+            "way_id",
+            id_table,
+        )
+    elif element_type == "relation":
+        members = store_rows(
+            db,
+            "SELECT relation_id, type, ref, role FROM members",
+            (),
+            "relation_id",
+            id_table,
+        )
+
+    for row in db.execute(query + " ORDER BY seq"):
+        element_id = row[0]
+        attributes = {"id": str(element_id)}
+        if row[2] is not None:
+            attributes["action"] = row[2]
+
+        if element_type == "node":
+            attributes["lat"] = str(row[3])
+            attributes["lon"] = str(row[4])
+            element_members = []
+        elif element_type == "way":
+            element_members = [str(ref) for (ref,) in members.get(element_id, [])]
+        else:
+            element_members = [
+                (member_type, str(ref), role)
+                for member_type, ref, role in members.get(element_id, [])
+            ]
+
+        yield (row[1], attributes, element_members, tags.get(element_id, []))
+
+
+# Open streaming writer for OSM file. PBF format is used if the filename ends with
+# ".pbf", an SQLite element store if it ends with ".db", else XML, formatted by the
+# given number of processes.
+
+
+def open_writer(filename, root_attributes, indent=True, processes=1):
+    if filename.endswith(".pbf"):
+        return PbfWriter(filename, root_attributes, indent)
+    elif filename.endswith(".db"):
+        return StoreWriter(filename, root_attributes, indent)
+    else:
+        return XmlWriter(filename, root_attributes, indent, processes)
+
+
+# Writer which forwards all elements to several writers, so that the same elements
+# are saved to several files in one pass
+
+
+class TeeWriter:
+    def __init__(self, writers):
+        self.writers = writers
+
+    def write_node(self, attributes, tags=[]):
+        for writer in self.writers:
+            writer.write_node(attributes, tags)
+
+    def write_way(self, attributes, refs, tags=[]):
+        for writer in self.writers:
+            writer.write_way(attributes, refs, tags)
+
+    def write_relation(self, attributes, members, tags=[]):
+        for writer in self.writers:
+            writer.write_relation(attributes, members, tags)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+# Open streaming writer for one or more OSM files, formatted as in open_writer()
+
+
+def open_writers(filenames, root_attributes, indent=True, processes=1):
+    writers = [
+        open_writer(filename, root_attributes, indent, processes)
+        for filename in filenames
+    ]
+    if len(writers) == 1:
+        return writers[0]
+    else:
+        return TeeWriter(writers)
+
+
+# Get (type, attributes, refs or members, tags) of ElementTree node, way or relation
+
+
+def element_data(element):
+    tags = [(tag.attrib["k"], tag.attrib["v"]) for tag in element.iter("tag")]
+
+    if element.tag == "way":
+        members = [nd.attrib["ref"] for nd in element.iter("nd")]
+    elif element.tag == "relation":
+        members = [
+            (member.attrib["type"], member.attrib["ref"], member.attrib["role"])
+            for member in element.iter("member")
+        ]
+    else:
+        members = []
+
+    return (element.tag, dict(element.attrib), members, tags)
+
+
+# Write one element given as (type, attributes, refs or members, tags) to writer
+
+
+def write_data(osm_file, data):
+    element_type, attributes, members, tags = data
+
+    if element_type == "node":
+        osm_file.write_node(attributes, tags)
+    elif element_type == "way":
+        osm_file.write_way(attributes, members, tags)
+    elif element_type == "relation":
+        osm_file.write_relation(attributes, members, tags)
+
+
+# Streaming writer of GeoJSON files.
+# Features are written one by one, either in a FeatureCollection with one feature per
+# line, or as a newline delimited GeoJSON text sequence (GeoJSONSeq) if sequence is
+# True, which other tools may read line by line.
+
+
+class GeojsonWriter:
+    def __init__(self, filename, sequence=False):
+        self.file = open_file(filename, "w", encoding="utf-8")
+        self.sequence = sequence
+        self.count = 0
+
+        if not sequence:
+            self.file.write('{"type": "FeatureCollection", "features": [\n')
+
+    # Write feature with geometry type, coordinates and properties (dict)
+
+    def write_feature(self, geometry_type, coordinates, properties):
+        feature = {
+            "type": "Feature",
+            "geometry": {"type": geometry_type, "coordinates": coordinates},
+            "properties": properties,
+        }
+        if self.count > 0 and not self.sequence:
+            self.file.write(",\n")
+        json.dump(feature, self.file, ensure_ascii=False)
+        if self.sequence:
+            self.file.write("\n")
+        self.count += 1
+
+    def close(self):
+        if not self.sequence:
+            self.file.write("\n]}\n")
+        self.file.close()
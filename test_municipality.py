@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Test of the municipality registry in municipality.py.
+# GeoNorge is replaced by a local HTTP server with the same JSON format, and the
+# registry is cached in a temporary folder.
+# Run with: python3 -m unittest test_municipality.py
+
+
+import contextlib
+import http.server
+import io
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import municipality
+
+
+counties = [
+    {
+        "fylkesnummer": "46",
+        "fylkesnavn": "Vestland",
+        "kommuner": [
+            {"kommunenummer": "4601", "kommunenavnNorsk": "Bergen"},
+            {"kommunenummer": "4640", "kommunenavnNorsk": "Sogndal"},
+        ],
+    },
+    {
+        "fylkesnummer": "31",
+        "fylkesnavn": "Østfold",
+        "kommuner": [{"kommunenummer": "3114", "kommunenavnNorsk": "Våler"}],
+    },
+    {
+        "fylkesnummer": "34",
+        "fylkesnavn": "Innlandet",
+        "kommuner": [{"kommunenummer": "3419", "kommunenavnNorsk": "Våler"}],
+    },
+    {
+        "fylkesnummer": "18",
+        "fylkesnavn": "Nordland",
+        "kommuner": [{"kommunenummer": "1813", "kommunenavnNorsk": "Brønnøy"}],
+    },
+    {
+        "fylkesnummer": "56",
+        "fylkesnavn": "Finnmark",
+        "kommuner": [
+            {
+                "kommunenummer": "5622",
+                "kommunenavnNorsk": "Guovdageaidnu - Kautokeino",
+            }
+        ],
+    },
+]
+
+# Single municipalities, with bbox. 5001 is not in the bulk registry.
+
+municipalities = {
+    "4601": {
+        "kommunenummer": "4601",
+        "kommunenavnNorsk": "Bergen",
+        "fylkesnummer": "46",
+        "fylkesnavn": "Vestland",
+        "avgrensningsboks": {
+            "type": "Polygon",
+            "coordinates": [
+                [[5.1, 60.2], [5.1, 60.6], [5.7, 60.6], [5.7, 60.2], [5.1, 60.2]]
+            ],
+        },
+    },
+    "5001": {
+        "kommunenummer": "5001",
+        "kommunenavnNorsk": "Trondheim",
+        "fylkesnummer": "50",
+        "fylkesnavn": "Trøndelag",
+        "avgrensningsboks": {
+            "type": "Polygon",
+            "coordinates": [
+                [[10.0, 63.3], [10.0, 63.5], [10.7, 63.5], [10.7, 63.3], [10.0, 63.3]]
+            ],
+        },
+    },
+}
+
+
+# GeoNorge replacement. Paths of all requests are kept in requests.
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append(self.path)
+        if self.path == "/fylkerkommuner":
+            result = counties
+        elif self.path[len("/kommuner/") :] in municipalities:
+            result = municipalities[self.path[len("/kommuner/") :]]
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RegistryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.cache_folder = self.folder.name + "/"
+        self.url = "http://127.0.0.1:%i/" % self.server.server_port
+        municipality.registry_url = self.url + "fylkerkommuner"
+        municipality.municipality_url = self.url + "kommuner/"
+        municipality.registry = None
+        Handler.requests = []
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def cached_registry(self):
+        file = open(
+            os.path.join(self.folder.name, "municipalities.json"), encoding="utf-8"
+        )
+        registry = json.load(file)
+        file.close()
+        return registry
+
+    def get_name(self, query):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return municipality.get_municipality_name(query, self.cache_folder)
+
+    def test_bulk_registry(self):
+        registry = municipality.load_registry(self.cache_folder)
+        self.assertEqual(Handler.requests, ["/fylkerkommuner"])
+        self.assertEqual(len(registry), 6)
+        self.assertEqual(registry["1813"]["file_name"], "Bronnoy")
+        self.assertEqual(registry["1813"]["county"], "Nordland")
+        self.assertIsNone(registry["4601"]["bbox"])
+        self.assertEqual(self.cached_registry(), registry)
+
+    def test_name_lookup(self):
+        self.assertEqual(self.get_name("4640"), ("4640", "Sogndal"))
+        self.assertEqual(self.get_name("bergen"), ("4601", "Bergen"))
+        self.assertEqual(self.get_name("Bronnoy"), ("1813", "Brønnøy"))
+        self.assertEqual(self.get_name("Kautokeino")[0], "5622")
+        self.assertEqual(self.get_name("Sogndl"), ("4640", "Sogndal"))  # Fuzzy
+        with self.assertRaises(SystemExit) as context:
+            self.get_name("Våler")
+        self.assertIn("3114 Våler, 3419 Våler", str(context.exception))
+        self.assertEqual(Handler.requests, ["/fylkerkommuner"])
+
+    def test_offline(self):
+        municipality.load_registry(self.cache_folder)
+        municipality.registry = None
+        municipality.registry_url = "http://127.0.0.1:1/fylkerkommuner"
+        self.assertEqual(self.get_name("Bergen"), ("4601", "Bergen"))
+
+    def test_bbox(self):
+        bergen = municipality.get_municipality("4601", self.cache_folder)
+        self.assertEqual(bergen["bbox"], [[5.1, 60.2], [5.7, 60.6]])
+        self.assertEqual(self.cached_registry()["4601"]["bbox"], bergen["bbox"])
+
+        # Bbox is kept in registry and when the registry is refreshed
+
+        municipality.get_municipality("4601", self.cache_folder)
+        municipality.load_registry(self.cache_folder, refresh=True)
+        self.assertEqual(municipality.registry["4601"]["bbox"], bergen["bbox"])
+        self.assertEqual(
+            Handler.requests, ["/fylkerkommuner", "/kommuner/4601", "/fylkerkommuner"]
+        )
+
+    def test_municipality_not_in_registry(self):
+        self.assertEqual(self.get_name("5001"), ("5001", "Trondheim"))
+        self.assertEqual(
+            municipality.registry["5001"]["bbox"], [[10.0, 63.3], [10.7, 63.5]]
+        )
+        with self.assertRaises(SystemExit):
+            self.get_name("5099")
+
+
+if __name__ == "__main__":
+    unittest.main()
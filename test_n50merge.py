@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Test of splitting N50 import files in n50merge.py.
+# The same elements are saved as an OSM file and as an SQLite element store, and the
+# parts from split_n50 and split_store must be identical.
+# Run with: python3 -m unittest test_n50merge.py
+
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import n50merge
+import osmfile
+
+
+# Node with id and coordinates
+
+
+def node(node_id, lon, lat, tags=[]):
+    return ("node", {"id": str(node_id), "lat": str(lat), "lon": str(lon)}, [], tags)
+
+
+# Closed way through the given nodes
+
+
+def way(way_id, node_ids, tags=[]):
+    refs = [str(node_id) for node_id in node_ids + node_ids[:1]]
+    return ("way", {"id": str(way_id)}, refs, tags)
+
+
+# Island relation with outer ways
+
+
+def island(relation_id, way_ids):
+    members = [("way", str(way_id), "outer") for way_id in way_ids]
+    tags = [("place", "island"), ("type", "multipolygon")]
+    return ("relation", {"id": str(relation_id)}, members, tags)
+
+
+# Test elements. The lake -101 is connected to islands -201, -202 and -203 through a
+# chain of shared ways. Island -203 comes before -202, so that it is only found when
+# the islands are collected until no more are found.
+
+elements = (
+    [node(-i, 10 + i / 100, 60 + (i % 3) / 100) for i in range(1, 25)]
+    + [node(-25, 10.5, 60.5, [("natural", "peak"), ("name", "Toppen")])]
+    + [
+        way(-101, [-1, -2, -3], [("natural", "water")]),
+        way(-102, [-4, -5, -6]),
+        way(-103, [-7, -8, -9]),
+        way(-104, [-10, -11, -12]),
+        way(-105, [-13, -14, -15], [("natural", "wood")]),
+        way(-106, [-16, -17, -18], [("landuse", "meadow")]),
+        way(-107, [-19, -20, -21], [("natural", "coastline")]),
+        way(-108, [-22, -23, -24]),
+        island(-201, [-101, -102]),
+        island(-203, [-103, -104]),
+        island(-202, [-102, -103]),
+        island(-204, [-107, -108]),
+        (
+            "relation",
+            {"id": "-205"},
+            [("way", "-105", "outer")],
+            [("natural", "wood"), ("type", "multipolygon")],
+        ),
+    ]
+)
+
+
+class SplitTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.folder.name, "test.osm")
+        osm_file = osmfile.open_writers(
+            [self.filename, self.filename + ".db"], {"version": "0.6"}
+        )
+        for element_type, attributes, members, tags in elements:
+            if element_type == "node":
+                osm_file.write_node(attributes, tags)
+            elif element_type == "way":
+                osm_file.write_way(attributes, members, tags)
+            else:
+                osm_file.write_relation(attributes, members, tags)
+        osm_file.close()
+
+        n50merge.n50_nodes = {}
+        n50merge.n50_ways = {}
+        n50merge.n50_relations = {}
+        n50merge.n50_elements = []
+        n50merge.n50_store = None
+        n50merge.filename = self.filename
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    # Split with split_n50 or split_store and return content of each part
+
+    def split(self, store):
+        name = "store" if store else "xml"
+        n50merge.output_filename = os.path.join(self.folder.name, name + "_merged.osm")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            if store:
+                db = osmfile.open_store(self.filename + ".db")
+                n50merge.split_store(db)
+                db.close()
+            else:
+                n50merge.load_n50()
+                n50merge.split_n50()
+
+        parts = {}
+        for part in n50merge.n50_parts:
+            file = open(os.path.join(self.folder.name, "%s_%s.osm" % (name, part)))
+            parts[part] = file.read()
+            file.close()
+        return parts
+
+    def test_split_store_as_split_n50(self):
+        xml_parts = self.split(False)
+        store_parts = self.split(True)
+        for part in n50merge.n50_parts:
+            self.assertEqual(store_parts[part], xml_parts[part], part)
+
+    def test_island_chain(self):
+        parts = self.split(True)
+        for relation_id in ["-201", "-202", "-203"]:
+            self.assertIn('<relation id="%s"' % relation_id, parts["water"])
+        self.assertIn('<way id="-104"', parts["water"])
+        self.assertNotIn('<relation id="-204"', parts["water"])
+        self.assertIn('<relation id="-204"', parts["coastline"])
+        self.assertIn('<relation id="-205"', parts["wood"])
+        self.assertIn('<way id="-106"', parts["landuse"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Test of the cached and batch geometry calculations in n50osm.py.
+# Cached geometry must follow changes of coordinates, and area, centroid and bbox of
+# patches calculated in one batch with NumPy must be identical to the results from
+# polygon_area, polygon_centroid and get_bbox.
+# Run with: python3 -m unittest test_n50osm.py
+
+
+import contextlib
+import io
+import math
+import random
+import unittest
+
+import n50osm
+
+
+# Irregular ring around a centre, with coordinates rounded to 7 decimals like N50.
+# Clockwise rings are used for inner patches.
+
+
+def make_ring(rng, lon, lat, radius, count, clockwise=False):
+    ring = []
+    for i in range(count):
+        angle = 2 * math.pi * i / count
+        if clockwise:
+            angle = -angle
+        r = radius * rng.uniform(0.5, 1.0)
+        ring.append(
+            (
+                round(lon + 2 * r * math.cos(angle), 7),
+                round(lat + r * math.sin(angle), 7),
+            )
+        )
+    ring.append(ring[0])
+    return ring
+
+
+# Polygon features spread over Norway, from small buildings to large lakes
+
+
+def make_features(seed):
+    rng = random.Random(seed)
+    features = []
+    for i in range(300):
+        lon = rng.uniform(4.5, 31.0)
+        lat = rng.uniform(58.0, 71.0)
+        radius = rng.choice([0.0001, 0.001, 0.01, 0.1])
+        count = rng.choice([3, 4, 5, 12, 100, 2000])
+        polygon = [make_ring(rng, lon, lat, radius, count)]
+        for j in range(rng.choice([0, 0, 1, 3])):
+            polygon.append(
+                make_ring(rng, lon, lat, radius / 10, rng.choice([3, 8, 50]), True)
+            )
+        features.append({"type": "Polygon", "coordinates": polygon})
+
+    # Not closed, degenerate and single node patches
+
+    features.append(
+        {
+            "type": "Polygon",
+            "coordinates": [
+                [(10.0, 60.0), (10.1, 60.0), (10.1, 60.1)],
+                [(10.0, 60.0), (10.1, 60.1), (10.0, 60.0)],
+                [(10.0, 60.0)],
+            ],
+        }
+    )
+    return features
+
+
+class GeometryCacheTest(unittest.TestCase):
+    def assert_geometry(self, element):
+        self.assertEqual(
+            n50osm.element_bbox(element), n50osm.get_bbox(element["coordinates"], 0)
+        )
+        if element["type"] == "Polygon":
+            for i, patch in enumerate(element["coordinates"]):
+                self.assertEqual(
+                    n50osm.patch_area(element, i), n50osm.polygon_area(patch)
+                )
+                self.assertEqual(
+                    n50osm.patch_bbox(element, i), n50osm.get_bbox(patch, 0)
+                )
+                self.assertEqual(
+                    n50osm.patch_centroid(element, i), n50osm.polygon_centroid(patch)
+                )
+
+    def test_replaced_coordinates(self):
+        rng = random.Random(3)
+        feature = {
+            "type": "Polygon",
+            "coordinates": [
+                make_ring(rng, 10.0, 60.0, 0.01, 12),
+                make_ring(rng, 10.0, 60.0, 0.001, 5, True),
+            ],
+        }
+        self.assert_geometry(feature)
+
+        feature["coordinates"][1] = make_ring(rng, 10.0, 60.0, 0.002, 8, True)
+        self.assert_geometry(feature)
+
+        feature["coordinates"] = [make_ring(rng, 11.0, 61.0, 0.1, 20)]
+        self.assert_geometry(feature)
+
+        line = {"type": "LineString", "coordinates": [(10.0, 60.0), (10.5, 60.5)]}
+        self.assert_geometry(line)
+        line["coordinates"] = [(10.0, 60.0), (10.2, 60.1)]
+        self.assert_geometry(line)
+        n50osm.reverse_geometry(line)
+        self.assert_geometry(line)
+
+    # Nodes are removed from a stream and a lake segment where they cross, and an
+    # auxiliary line is simplified. Each change reduces the bbox.
+
+    def test_match_nodes(self):
+        stream = {
+            "object": "ElvBekk",
+            "type": "LineString",
+            "coordinates": [(10.0, 60.0), (10.1, 60.2), (10.2, 60.1)],
+        }
+        lake_edge = {
+            "object": "Innsjøkant",
+            "type": "LineString",
+            "coordinates": [(10.05, 60.1), (10.1, 60.2), (10.15, 60.1)],
+            "used": 1,
+        }
+        auxiliary = {
+            "object": "FiktivDelelinje",
+            "type": "LineString",
+            "coordinates": [(11.0, 61.0), (11.1, 61.2), (11.2, 61.1)],
+            "used": 1,
+        }
+        n50osm.features = [stream]
+        n50osm.segments = [lake_edge, auxiliary]
+        n50osm.nodes = set()
+        n50osm.no_node = False
+        n50osm.debug = False
+        n50osm.deferred_messages = {}
+        for element in n50osm.features + n50osm.segments:
+            n50osm.element_bbox(element)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            n50osm.match_nodes()
+
+        self.assertEqual(n50osm.delete_count, 1)
+        for element in n50osm.features + n50osm.segments:
+            self.assertEqual(len(element["coordinates"]), 2)
+            self.assertEqual(
+                element["geometry"]["bbox"][1][1], element["coordinates"][1][1]
+            )
+            self.assert_geometry(element)
+
+
+@unittest.skipIf(n50osm.np is None, "NumPy not installed")
+class BatchGeometryTest(unittest.TestCase):
+    def test_patch_kernels(self):
+        features = make_features(1)
+        n50osm.batch_patch_geometry(features)
+
+        for feature in features:
+            for i, patch in enumerate(feature["coordinates"]):
+                cache = n50osm.geometry_cache(feature, i)
+                if len(patch) < 2:
+                    self.assertNotIn("area", cache)
+                    continue
+
+                self.assertEqual(cache["area"], n50osm.polygon_area(patch))
+                self.assertEqual(cache["bbox"], n50osm.get_bbox(patch, 0))
+
+                if patch[0] != patch[-1]:
+                    self.assertIsNone(cache["centroid"])
+                elif "centroid" in cache:
+                    self.assertEqual(cache["centroid"], n50osm.polygon_centroid(patch))
+                else:
+                    with self.assertRaises(ZeroDivisionError):  # Degenerate
+                        n50osm.polygon_centroid(patch)
+
+    def test_cached_accessors(self):
+        batch_features = make_features(2)
+        scalar_features = make_features(2)
+        n50osm.batch_patch_geometry(batch_features)
+
+        for batch, scalar in zip(batch_features, scalar_features):
+            for i, patch in enumerate(scalar["coordinates"]):
+                if len(patch) > 1 and patch[0] == patch[-1]:
+                    self.assertEqual(
+                        n50osm.patch_area(batch, i), n50osm.patch_area(scalar, i)
+                    )
+                    self.assertEqual(
+                        n50osm.patch_bbox(batch, i), n50osm.patch_bbox(scalar, i)
+                    )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# Round trip test of the OSM PBF writer in osmfile.py.
+# The same elements are written through XmlWriter and PbfWriter, and the PBF file is
+# decoded with a small protobuf decoder and compared with the XML file.
+# Run with: python3 -m unittest test_osmfile.py
+
+
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+import xml.etree.ElementTree as ET
+
+import osmfile
+
+# Test elements as (type, attributes, refs or members, tags).
+# Includes negative ids, elements without tags, metadata and non-ASCII tag values.
+
+elements = [
+    ("node", {"id": "-1", "lat": "59.9138688", "lon": "10.7522454"}, [], []),
+    (
+        "node",
+        {"id": "-2", "lat": "-33.8567844", "lon": "-151.2152967"},
+        [],
+        [("name", "Søndre Æsøy"), ("natural", "peak")],
+    ),
+    ("node", {"id": "-3", "lat": "69.6492047", "lon": "18.9553238"}, [], []),
+    (
+        "node",
+        {
+            "id": "123456789012",
+            "lat": "0.0000001",
+            "lon": "-0.0000001",
+            "version": "3",
+            "timestamp": "2021-05-17T12:34:56Z",
+            "changeset": "104000000",
+            "uid": "4711",
+            "user": "Kåre",
+        },
+        [],
+        [("name", "東京"), ("ele", "12")],
+    ),
+    ("node", {"id": "-5", "lat": "60", "lon": "5.3"}, [], [("fixme", "")]),
+    ("way", {"id": "-10"}, ["-1", "-2", "-3", "-1"], [("natural", "water")]),
+    ("way", {"id": "-11"}, ["-3", "123456789012"], []),
+    (
+        "way",
+        {
+            "id": "987654321",
+            "version": "12",
+            "timestamp": "2010-01-01T00:00:00Z",
+            "changeset": "3",
+            "uid": "1",
+            "user": "Ærlig",
+        },
+        ["123456789012", "-5"],
+        [("waterway", "stream"), ("name", "Bækken")],
+    ),
+    (
+        "relation",
+        {"id": "-20"},
+        [("way", "-10", "outer"), ("way", "-11", ""), ("node", "-2", "admin_centre")],
+        [("type", "multipolygon"), ("name", "Øvre Ålvatnet")],
+    ),
+    ("relation", {"id": "-21"}, [("relation", "-20", "subarea")], []),
+    (
+        "relation",
+        {"id": "5", "version": "1", "user": "", "uid": "0"},
+        [("way", "987654321", "main_stream")],
+        [("type", "waterway")],
+    ),
+]
+
+
+# Decode protobuf varint at position, returning value and next position
+
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return (value, position)
+
+
+# Decode protobuf message into list of (field number, value).
+# Varints are given as unsigned integers and length delimited fields as bytes.
+
+
+def read_message(data):
+    fields = []
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, wire_type = (key >> 3, key & 7)
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 2:
+            length, position = read_varint(data, position)
+            value = data[position : position + length]
+            position += length
+        else:
+            raise ValueError("Unsupported wire type %i" % wire_type)
+        fields.append((number, value))
+    return fields
+
+
+# Get signed int64 from unsigned varint value (two's complement)
+
+
+def signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+# Decode zigzag encoded sint64
+
+
+def unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+# Decode packed repeated integers, optionally zigzag and delta coded
+
+
+def read_packed(data, zigzag=False, delta=False):
+    values = []
+    position = 0
+    previous = 0
+    while position < len(data):
+        value, position = read_varint(data, position)
+        if zigzag:
+            value = unzigzag(value)
+        if delta:
+            value += previous
+            previous = value
+        values.append(value)
+    return values
+
+
+# Get all values of one field of a decoded message
+
+
+def field_values(fields, number):
+    return [value for field_number, value in fields if field_number == number]
+
+
+def first_value(fields, number, default):
+    values = field_values(fields, number)
+    return values[0] if values else default
+
+
+# Decode metadata of Info message as attributes dict
+
+
+def read_info(data, strings):
+    info = read_message(data)
+    return {
+        "version": str(first_value(info, 1, 0)),
+        "timestamp": first_value(info, 2, 0),
+        "changeset": str(first_value(info, 3, 0)),
+        "uid": str(first_value(info, 4, 0)),
+        "user": strings[first_value(info, 5, 0)],
+    }
+
+
+# Decode blocks of PBF file into list of (blob type, decoded block)
+
+
+def read_blobs(filename):
+    blobs = []
+    with open(filename, "rb") as file:
+        while True:
+            length = file.read(4)
+            if not length:
+                break
+            header = read_message(file.read(struct.unpack(">I", length)[0]))
+            blob_type = first_value(header, 1, b"").decode("utf-8")
+            blob = read_message(file.read(first_value(header, 3, 0)))
+            data = zlib.decompress(first_value(blob, 3, b""))
+            assert len(data) == first_value(blob, 2, 0)
+            blobs.append((blob_type, read_message(data)))
+    return blobs
+
+
+# Decode dense nodes of primitive group into list of elements
+
+
+def read_dense_nodes(dense, strings, granularity, lat_offset, lon_offset):
+    dense = read_message(dense)
+    ids = read_packed(first_value(dense, 1, b""), zigzag=True, delta=True)
+    lats = read_packed(first_value(dense, 8, b""), zigzag=True, delta=True)
+    lons = read_packed(first_value(dense, 9, b""), zigzag=True, delta=True)
+    keys_vals = read_packed(first_value(dense, 10, b""))
+
+    # Nodes without metadata have version 0 when other nodes in the block have metadata
+
+    infos = [None] * len(ids)
+    if field_values(dense, 5):
+        dense_info = read_message(first_value(dense, 5, b""))
+        versions = read_packed(first_value(dense_info, 1, b""))
+        timestamps = read_packed(first_value(dense_info, 2, b""), True, True)
+        changesets = read_packed(first_value(dense_info, 3, b""), True, True)
+        uids = read_packed(first_value(dense_info, 4, b""), True, True)
+        users = read_packed(first_value(dense_info, 5, b""), True, True)
+        infos = [
+            (
+                {
+                    "version": str(versions[i]),
+                    "timestamp": timestamps[i],
+                    "changeset": str(changesets[i]),
+                    "uid": str(uids[i]),
+                    "user": strings[users[i]],
+                }
+                if versions[i] > 0
+                else None
+            )
+            for i in range(len(ids))
+        ]
+
+    nodes = []
+    position = 0
+    for i, node_id in enumerate(ids):
+        tags = []
+        while keys_vals and keys_vals[position] != 0:
+            key, value = keys_vals[position : position + 2]
+            tags.append((strings[key], strings[value]))
+            position += 2
+        position += 1
+        lat = (lat_offset + granularity * lats[i]) / 1e9
+        lon = (lon_offset + granularity * lons[i]) / 1e9
+        nodes.append(("node", node_id, (lat, lon), tags, infos[i]))
+    return nodes
+
+
+# Decode PBF file into list of (type, id, coordinates/refs/members, tags, info)
+
+
+def read_pbf(filename):
+    member_types = ["node", "way", "relation"]
+    blobs = read_blobs(filename)
+    assert blobs[0][0] == "OSMHeader"
+    header = blobs[0][1]
+    assert b"DenseNodes" in field_values(header, 4)
+
+    elements = []
+    for blob_type, block in blobs[1:]:
+        assert blob_type == "OSMData"
+        strings = [
+            text.decode("utf-8")
+            for text in field_values(read_message(first_value(block, 1, b"")), 1)
+        ]
+        granularity = first_value(block, 17, 100)
+        lat_offset = signed(first_value(block, 19, 0))
+        lon_offset = signed(first_value(block, 20, 0))
+
+        for group in field_values(block, 2):
+            group = read_message(group)
+            for dense in field_values(group, 2):
+                elements += read_dense_nodes(
+                    dense, strings, granularity, lat_offset, lon_offset
+                )
+
+            for way in field_values(group, 3):
+                way = read_message(way)
+                keys = read_packed(first_value(way, 2, b""))
+                values = read_packed(first_value(way, 3, b""))
+                info = field_values(way, 4)
+                elements.append(
+                    (
+                        "way",
+                        signed(first_value(way, 1, 0)),
+                        read_packed(first_value(way, 8, b""), zigzag=True, delta=True),
+                        [(strings[k], strings[v]) for k, v in zip(keys, values)],
+                        read_info(info[0], strings) if info else None,
+                    )
+                )
+
+            for relation in field_values(group, 4):
+                relation = read_message(relation)
+                keys = read_packed(first_value(relation, 2, b""))
+                values = read_packed(first_value(relation, 3, b""))
+                roles = read_packed(first_value(relation, 8, b""))
+                refs = read_packed(first_value(relation, 9, b""), True, True)
+                types = read_packed(first_value(relation, 10, b""))
+                info = field_values(relation, 4)
+                elements.append(
+                    (
+                        "relation",
+                        signed(first_value(relation, 1, 0)),
+                        [
+                            (member_types[t], ref, strings[role])
+                            for t, ref, role in zip(types, refs, roles)
+                        ],
+                        [(strings[k], strings[v]) for k, v in zip(keys, values)],
+                        read_info(info[0], strings) if info else None,
+                    )
+                )
+
+    return elements
+
+
+# Read XML file into the same form as read_pbf()
+
+
+def read_xml(filename):
+    elements = []
+    for element in ET.parse(filename).getroot():
+        attributes = element.attrib
+        tags = [(tag.attrib["k"], tag.attrib["v"]) for tag in element.iter("tag")]
+        info = None
+        if "version" in attributes:
+            info = {
+                "version": attributes["version"],
+                "timestamp": (
+                    osmfile.osm_timestamp(attributes["timestamp"])
+                    if "timestamp" in attributes
+                    else 0
+                ),
+                "changeset": attributes.get("changeset", "0"),
+                "uid": attributes.get("uid", "0"),
+                "user": attributes.get("user", ""),
+            }
+
+        if element.tag == "node":
+            content = (float(attributes["lat"]), float(attributes["lon"]))
+        elif element.tag == "way":
+            content = [int(nd.attrib["ref"]) for nd in element.iter("nd")]
+        else:
+            content = [
+                (
+                    member.attrib["type"],
+                    int(member.attrib["ref"]),
+                    member.attrib["role"],
+                )
+                for member in element.iter("member")
+            ]
+        elements.append((element.tag, int(attributes["id"]), content, tags, info))
+    return elements
+
+
+# Write test elements to writer
+
+
+def write_elements(osm_file):
+    for element_type, attributes, members, tags in elements:
+        if element_type == "node":
+            osm_file.write_node(attributes, tags)
+        elif element_type == "way":
+            osm_file.write_way(attributes, members, tags)
+        else:
+            osm_file.write_relation(attributes, members, tags)
+    osm_file.close()
+
+
+class PbfRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.xml_filename = os.path.join(self.folder.name, "test.osm")
+        self.pbf_filename = os.path.join(self.folder.name, "test.osm.pbf")
+        write_elements(osmfile.XmlWriter(self.xml_filename, {"version": "0.6"}))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    # Compare decoded PBF with XML. Coordinates are compared at the 100 nanodegree
+    # granularity of the PBF file.
+
+    def check_round_trip(self, block_size):
+        osm_file = osmfile.PbfWriter(
+            self.pbf_filename, {"version": "0.6", "generator": "test"}
+        )
+        osm_file.block_size = block_size
+        write_elements(osm_file)
+
+        xml_elements = read_xml(self.xml_filename)
+        pbf_elements = read_pbf(self.pbf_filename)
+        self.assertEqual(len(pbf_elements), len(xml_elements))
+
+        for xml_element, pbf_element in zip(xml_elements, pbf_elements):
+            self.assertEqual(pbf_element[:2], xml_element[:2])
+            if xml_element[0] == "node":
+                for pbf_degrees, xml_degrees in zip(pbf_element[2], xml_element[2]):
+                    self.assertEqual(round(pbf_degrees * 1e7), round(xml_degrees * 1e7))
+            else:
+                self.assertEqual(pbf_element[2], xml_element[2])
+            self.assertEqual(pbf_element[3], xml_element[3])
+            self.assertEqual(pbf_element[4], xml_element[4])
+
+    def test_one_block(self):
+        self.check_round_trip(8000)
+
+    def test_several_blocks(self):
+        self.check_round_trip(2)
+
+    def test_single_element_blocks(self):
+        self.check_round_trip(1)
+
+
+class ProtobufTest(unittest.TestCase):
+    def test_varint(self):
+        for value in [0, 1, 127, 128, 300, 2**31, 2**63 - 1]:
+            self.assertEqual(read_varint(osmfile.varint(value), 0)[0], value)
+        self.assertEqual(signed(read_varint(osmfile.varint(-1), 0)[0]), -1)
+        self.assertEqual(len(osmfile.varint(-1)), 10)
+
+    def test_zigzag(self):
+        for value in [0, -1, 1, -2, 2**40, -(2**40), 2**62, -(2**63)]:
+            self.assertEqual(unzigzag(osmfile.zigzag(value)), value)
+
+    def test_packed_delta(self):
+        values = [-5, -3, 100, 7, 123456789012, -123456789012]
+        data = read_message(osmfile.pb_packed(8, values, signed=True, delta=True))
+        self.assertEqual(data[0][0], 8)
+        self.assertEqual(read_packed(data[0][1], zigzag=True, delta=True), values)
+
+
+if __name__ == "__main__":
+    unittest.main()